@@ -0,0 +1,17 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA_DIR = os.path.join(ROOT_DIR, "test_data")
+
+
+def load_fixture(name):
+    """
+    :param name: file name in the test_data directory
+    :return: the unpickled fixture, usually a requests.response.content object
+    """
+    with open(os.path.join(TEST_DATA_DIR, name), "rb") as fixture_file:
+        return pickle.load(fixture_file)
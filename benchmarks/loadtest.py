@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test of get_category and get_offer_information against the local stand-in server.
+
+Usage::
+
+    python -m benchmarks.loadtest --concurrency 1 4 16 --pages 5 --latency 0.05 --jitter 0.02
+"""
+
+import argparse
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from benchmarks.server import StandInServer
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, percent):
+    """
+    :param values: sorted list of numbers
+    :param percent: 0-100
+    :return: the nearest-rank percentile, None for an empty list
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percent / 100.0 * len(values) + 0.5)) - 1)]
+
+
+def run(server, concurrency, offers_limit):
+    """
+    Scrapes one search with :meth:`otodom.category.get_category` and its offers with
+    :meth:`otodom.offer.get_offer_information`, fetching ``concurrency`` offers at a time.
+
+    :param server: the running :class:`benchmarks.server.StandInServer`
+    :param concurrency: number of offers fetched at a time
+    :param offers_limit: scrape at most this many offers, all if 0. The offers are parsed without the parse memo.
+    :rtype: dict
+    :return: throughput and latency statistics of the run
+    """
+    from otodom.category import get_category
+    from otodom.offer import PARSE_MEMO_SIZE, get_offer_information, set_parse_memo_size
+
+    def scrape(offer):
+        started = time.time()
+        try:
+            get_offer_information(offer['detail_url'], context=offer)
+            return time.time() - started, None
+        except Exception as error:
+            return time.time() - started, error
+
+    category_requests = server.requests_count["category"]
+    category_start = time.time()
+    try:
+        offers = get_category("wynajem", "mieszkanie", "gda")
+    except Exception as error:
+        print("Category scraping failed: {0!r}".format(error))
+        offers = []
+    category_duration = time.time() - category_start
+    pages = server.requests_count["category"] - category_requests
+    offers = offers[:offers_limit] if offers_limit else offers
+
+    # the stand-in serves the same offer markup for every offer, with the parse memo the run would mostly measure
+    # memo hits instead of parsing
+    set_parse_memo_size(0)
+    pool = ThreadPool(concurrency)
+    offers_start = time.time()
+    try:
+        results = pool.map(scrape, offers)
+    finally:
+        pool.close()
+        set_parse_memo_size(PARSE_MEMO_SIZE)
+    offers_duration = time.time() - offers_start
+
+    latencies = sorted(latency for latency, _ in results)
+    stats = {
+        'concurrency': concurrency,
+        'pages': pages,
+        'pages_per_second': pages / category_duration,
+        'offers': len(offers),
+        'errors': sum(1 for _, error in results if error is not None),
+        'offers_per_second': len(offers) / offers_duration if offers_duration else 0,
+    }
+    stats.update(('p{0}'.format(percent), percentile(latencies, percent) or 0) for percent in PERCENTILES)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the scraper against a local otodom stand-in.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16],
+                        help="numbers of offers fetched at a time, one run per value")
+    parser.add_argument("--pages", type=int, default=3, help="number of pages in the search")
+    parser.add_argument("--offers-limit", type=int, default=0, help="scrape at most this many offers per run")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximal random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    args = parser.parse_args(argv)
+
+    server = StandInServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, pages=args.pages)
+    # otodom reads the base url on import, so it may only be imported once the environment is set
+    os.environ['OTODOM_BASE_URL'] = server.url
+
+    print("{0:>11} {1:>6} {2:>9} {3:>7} {4:>7} {5:>9} {6:>8} {7:>8} {8:>8}".format(
+        "concurrency", "pages", "pages/s", "offers", "errors", "offers/s", "p50", "p90", "p99"))
+    with server:
+        for concurrency in args.concurrency:
+            stats = run(server, concurrency, args.offers_limit)
+            print("{concurrency:>11} {pages:>6} {pages_per_second:>9.1f} {offers:>7} {errors:>7} "
+                  "{offers_per_second:>9.1f} {p50:>7.3f}s {p90:>7.3f}s {p99:>7.3f}s".format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Parser benchmarks over the test_data fixtures.
+
+Usage::
+
+    python -m benchmarks.run                  # print ops/s and peak memory of every benchmark
+    python -m benchmarks.run -k offer         # only benchmarks with "offer" in the name
+    python -m benchmarks.run --save           # store the results as the new baseline
+    python -m benchmarks.run --compare        # fail if any benchmark got slower than the baseline allows
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import otodom.bloom as bloom
+import otodom.category as category
+import otodom.dedup as dedup
+import otodom.geo as geo
+import otodom.history as history
+import otodom.offer as offer
+import otodom.store as store
+import otodom.utils as utils
+from benchmarks.fixtures import load_fixture
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+MIN_RUN_TIME = 0.2
+REPEAT = 3
+DEFAULT_TOLERANCE = 0.25
+
+OFFER_EXTRACTORS = [
+    offer.get_offer_facebook_description,
+    offer.get_offer_floor,
+    offer.get_offer_total_floors,
+    offer.get_offer_apartment_details,
+    offer.get_offer_additional_assets,
+    offer.get_offer_description,
+    offer.get_offer_poster_name,
+    offer.get_offer_photos_links,
+    offer.get_offer_video_link,
+    offer.get_offer_3d_walkaround_link,
+    offer.get_offer_geographical_coordinates,
+    offer.get_offer_details,
+    offer.get_offer_title,
+    offer.get_offer_address,
+]
+
+OFFER_DATES = ["01.02.2017", "15.11.2016", "28.02.2018", "03.07.2017"] * 8
+OFFER_AVAILABLE_FROM = [u"1 lipca 2017", u"15 września 2016", u"3 maja 2018", u"28 lutego 2017"] * 8
+
+
+def parse_offer_values():
+    for date in OFFER_DATES:
+        offer.parse_date_to_timestamp(date)
+    for date in OFFER_AVAILABLE_FROM:
+        offer.parse_available_from(date)
+
+
+def import_offer_and_category():
+    # a fresh interpreter, the time includes its startup
+    subprocess.check_call([sys.executable, "-c", "import otodom.offer, otodom.category"])
+
+
+STORE_QUERY = {
+    'city': 'gdansk_40',
+    '[filter_float_price:to]': 3000,
+    '[filter_enum_rooms_num][]': ['2'],
+    '[filter_enum_extras_types][]': ['balcony'],
+}
+
+
+def get_offer_store(size=20000, seed=0):
+    generator = random.Random(seed)
+    return store.OfferStore({
+        'offer_id': str(offer_id),
+        'price': generator.randint(1000, 6000),
+        'surface': generator.uniform(20, 120),
+        'rooms': generator.randint(1, 6),
+        'floor': generator.randint(0, 12),
+        'city': generator.choice([u"Gdańsk", u"Gdynia", u"Sopot"]),
+        'additional_assets': {'balcony': generator.random() < 0.4},
+    } for offer_id in range(size))
+
+
+def get_geo_index(size=50000, seed=0):
+    generator = random.Random(seed)
+    geo_index = geo.GeoIndex()
+    for point in range(size):
+        geo_index.insert(generator.uniform(54.3, 54.6), generator.uniform(18.4, 18.8), point)
+    return geo_index
+
+
+def get_price_history(size=20000, changes=5, seed=0):
+    generator = random.Random(seed)
+    price_history = history.PriceHistory()
+    for offer_id in range(size):
+        timestamp = generator.randint(1500000000, 1500000000 + 10 * history.WEEK)
+        for _ in range(changes):
+            price_history.record(str(offer_id), generator.randint(1000, 6000), timestamp=timestamp)
+            timestamp += generator.randint(history.DAY, 3 * history.WEEK)
+    return price_history
+
+
+def record_prices(size=1000):
+    price_history = history.PriceHistory()
+    for offer_id in range(size):
+        price_history.record(str(offer_id), 3000, timestamp=1500000000)
+        price_history.record(str(offer_id), 3000, timestamp=1500000000 + history.DAY)
+    return price_history
+
+
+def get_duplicate_index(offer_markup, size=500, seed=0):
+    generator = random.Random(seed)
+    words = offer.parse_offer_markup(offer_markup)['description'].split()
+    duplicates = dedup.DuplicateIndex()
+    for offer_id in range(size):
+        duplicates.add({'offer_id': str(offer_id), 'description': " ".join(generator.sample(words, 40))})
+    return duplicates
+
+
+def get_bloom_filter(size=100000):
+    seen = bloom.BloomFilter(capacity=size)
+    for offer_id in range(size):
+        seen.add(str(offer_id))
+    return seen
+
+
+def parse_offer_markup(markup):
+    offer.set_parse_memo_size(0)
+    return offer.parse_offer_markup(markup)
+
+
+def parse_offer_markup_memoized(markup):
+    # only the first call parses, the rest are served from the memo
+    if not offer.get_parse_memo_stats()['maxsize']:
+        offer.set_parse_memo_size(offer.PARSE_MEMO_SIZE)
+    return offer.parse_offer_markup(markup)
+
+
+def iter_category_offers(markup, chunk_size=16384):
+    chunks = (markup[start:start + chunk_size] for start in range(0, len(markup), chunk_size))
+    return list(category.iter_category_offers(chunks))
+
+
+def first_category_offer(markup, chunk_size=16384):
+    chunks = (markup[start:start + chunk_size] for start in range(0, len(markup), chunk_size))
+    return next(category.iter_category_offers(chunks))
+
+
+def get_benchmarks():
+    """
+    :rtype: list(tuple(string, callable))
+    :return: benchmark names with argumentless callables running them
+    """
+    category_markup = load_fixture("markup_offers")
+    offer_markup = load_fixture("offer")
+    offer_parser = BeautifulSoup(offer_markup, "html.parser")
+    offer_store = get_offer_store()
+    geo_index = get_geo_index()
+    price_history = get_price_history()
+    duplicates = get_duplicate_index(offer_markup)
+    offer_details = offer.parse_offer_markup(offer_markup)
+    seen = get_bloom_filter()
+
+    benchmarks = [
+        ("parse_category_content", lambda: category.parse_category_content(category_markup)),
+        ("scan_category_content", lambda: category.scan_category_content(category_markup)),
+        ("iter_category_offers", lambda: iter_category_offers(category_markup)),
+        ("first_category_offer", lambda: first_category_offer(category_markup)),
+        ("get_category_number_of_pages", lambda: category.get_category_number_of_pages(category_markup)),
+        ("get_csrf_token", lambda: utils.get_csrf_token(category_markup)),
+        ("get_offer_ninja_pv", lambda: offer.get_offer_ninja_pv(offer_markup)),
+        ("get_offer_fingerprint", lambda: offer.get_offer_fingerprint(offer_markup)),
+        ("parse_offer_values", parse_offer_values),
+        ("parse_offer_markup", lambda: parse_offer_markup(offer_markup)),
+        ("offer_store_query", lambda: offer_store.query(**STORE_QUERY)),
+        ("geo_index_within_radius", lambda: geo_index.within_radius(54.45, 18.6, 1.0)),
+        ("geo_index_nearest", lambda: geo_index.nearest(54.45, 18.6, 10)),
+        ("price_history_record", record_prices),
+        ("duplicate_index_find", lambda: duplicates.find_duplicates(offer_details)),
+        ("bloom_filter_contains", lambda: "48326376" in seen),
+        ("bloom_filter_add", lambda: seen.add("48326376")),
+        ("price_history_aggregate", lambda: price_history.aggregate(offer_store.get)),
+        ("parse_offer_markup_memoized", lambda: parse_offer_markup_memoized(offer_markup)),
+        ("import_offer_and_category", import_offer_and_category),
+    ]
+    benchmarks.extend(
+        (extractor.__name__, lambda extractor=extractor: extractor(offer_parser)) for extractor in OFFER_EXTRACTORS
+    )
+    return benchmarks
+
+
+def measure(func):
+    """
+    :param func: argumentless callable
+    :rtype: dict
+    :return: best ops/s out of REPEAT runs and the peak memory allocated by a single call, in bytes
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange() if hasattr(timer, "autorange") else (1, None)
+    while timer.timeit(number) < MIN_RUN_TIME:
+        number *= 2
+    best = min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'ops_per_second': 1 / best, 'peak_memory': peak_memory}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: dict, benchmark names mapped to :meth:`measure` results
+    :param baseline: dict, the stored baseline in the same format
+    :param tolerance: allowed relative drop of ops/s
+    :rtype: list(string)
+    :return: names of the benchmarks slower than the baseline allows
+    """
+    return [
+        name for name, result in results.items()
+        if name in baseline and result['ops_per_second'] < baseline[name]['ops_per_second'] * (1 - tolerance)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the otodom parsers over the test_data fixtures.")
+    parser.add_argument("-k", dest="keyword", default="", help="only run benchmarks containing this string")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="exit with an error on regressions")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="path to the baseline json file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative drop of ops/s when comparing, default %(default)s")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    print("{0:<40} {1:>14} {2:>14} {3:>10}".format("benchmark", "ops/s", "peak memory", "baseline"))
+    for name, func in get_benchmarks():
+        if args.keyword not in name:
+            continue
+        result = results[name] = measure(func)
+        change = ""
+        if name in baseline:
+            change = "{0:+.1%}".format(result['ops_per_second'] / baseline[name]['ops_per_second'] - 1)
+        print("{0:<40} {1:>14.1f} {2:>13.1f}K {3:>10}".format(
+            name, result['ops_per_second'], result['peak_memory'] / 1024.0, change))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: {0}".format(", ".join(sorted(regressions))))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for otodom.pl serving the test_data fixtures.
+
+Point the scraper at it with the OTODOM_BASE_URL environment variable::
+
+    python -m benchmarks.server --port 8000 --latency 0.05 --pages 5
+    OTODOM_BASE_URL=http://127.0.0.1:8000 python example.py
+"""
+
+import argparse
+import collections
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from benchmarks.fixtures import load_fixture
+
+OTODOM_URLS = [b"https://www.otodom.pl", b"http://www.otodom.pl"]
+
+AUTOSUGGEST_RESPONSE = [{"level": "CITY", "text": "<strong>Gda</strong>ńsk", "city_id": 40}]
+PHONE_RESPONSE = {"value": ["+48 500 600 700"]}
+JSON = "application/json"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.stand_in.handle(self)
+
+    def do_HEAD(self):
+        self.server.stand_in.handle(self)
+
+    def do_POST(self):
+        self.server.stand_in.handle(self)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(object):
+    """
+    Serves category pages, offer pages, the autosuggest json and the phone endpoint.
+
+    Every category url returns test_data/markup_offers with its pager set to ``pages``, every offer url returns
+    test_data/offer. Links in the served pages are rewritten to point at the stand-in.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, pages=3, seed=None,
+                 offers=None):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds added to every response
+        :param jitter: up to this many seconds are randomly added to the latency
+        :param error_rate: fraction of requests answered with HTTP 500
+        :param pages: number of pages reported by every category page
+        :param seed: seed for the latency jitter and errors
+        :param offers: number of offers kept on every category page, besides the promoted ones, all of them if None
+        """
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), StandInRequestHandler)
+        self._server.stand_in = self
+        self.url = "http://{0}:{1}".format(*self._server.server_address)
+        self.requests_count = collections.Counter()
+
+        base_url = self.url.encode("ascii")
+        category_markup, offer_markup = load_fixture("markup_offers"), load_fixture("offer")
+        for otodom_url in OTODOM_URLS:
+            category_markup = category_markup.replace(otodom_url, base_url)
+            offer_markup = offer_markup.replace(otodom_url, base_url)
+        if offers is not None:
+            listed = [match.span() for match in re.finditer(br"<article\b.*?</article>", category_markup, re.DOTALL)
+                      if b"promo_" not in match.group()[:match.group().find(b">")]]
+            for start, end in reversed(listed[offers:]):
+                category_markup = category_markup[:start] + category_markup[end:]
+        self.category_markup = re.sub(
+            br'(class="current">)\d+', lambda match: match.group(1) + str(pages).encode("ascii"), category_markup)
+        self.offer_markup = offer_markup
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def handle(self, handler):
+        with self._random_lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+        time.sleep(delay)
+
+        headers = {}
+        if handler.path.startswith("/ajax/geo6/autosuggest/"):
+            kind, body, content_type = "autosuggest", json.dumps(AUTOSUGGEST_RESPONSE).encode("utf-8"), JSON
+        elif handler.path.startswith("/ajax/misc/contact/phone/"):
+            kind, body, content_type = "phone", json.dumps(PHONE_RESPONSE).encode("utf-8"), JSON
+        elif handler.path.startswith("/oferta/"):
+            kind, body, content_type = "offer", self.offer_markup, "text/html; charset=utf-8"
+            headers["Set-Cookie"] = "PHPSESSID=standin; path=/"
+        else:
+            kind, body, content_type = "category", self.category_markup, "text/html; charset=utf-8"
+        status = 200
+        if failed:
+            status, body, content_type = 500, b"Internal Server Error", "text/plain"
+        with self._random_lock:
+            self.requests_count[kind] += 1
+
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(body)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local stand-in for otodom.pl.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximal random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument("--pages", type=int, default=3, help="number of pages in every search")
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.pages)
+    print("Serving otodom stand-in on {0}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,12 @@ import logging
 
 from otodom.category import get_category
 from otodom.offer import get_offer_information
+from otodom.sinks import open_sink
 
 log = logging.getLogger(__file__)
 
 SCRAPE_LIMIT = os.environ.get('SCRAPE_LIMIT', None)
+OUTPUT_PATH = os.environ.get('OUTPUT_PATH', None)
 
 if __name__ == '__main__':
     input_dict = {}
@@ -25,7 +27,15 @@ if __name__ == '__main__':
         parsed_category = parsed_category[:int(SCRAPE_LIMIT)]
         log.info("Scarping limit - {0}".format(len(parsed_category)))
 
+    # offers are written one by one as they are scraped, e.g. OUTPUT_PATH=offers.jsonl.gz
+    sink = open_sink(OUTPUT_PATH) if OUTPUT_PATH else None
+
     for offer in parsed_category:
         log.info("Scarping offer - {0}".format(offer['detail_url']))
         offer_detail = get_offer_information(offer['detail_url'], context=offer)
         log.info("Scraped offer - {0}".format(offer_detail))
+        if sink:
+            sink.write(offer_detail)
+
+    if sink:
+        sink.close()
@@ -4,6 +4,11 @@
 import os
 import sys
 
+if sys.version_info < (3, 3):
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
 version = '0.0.2'
 
 VERSION = tuple(map(int, version.split('.')))
@@ -20,7 +25,9 @@ if (2, 7) <= sys.version_info < (3, 7):
     if os.getenv('DEBUG'):
         logging.basicConfig(level=logging.INFO)
 
-BASE_URL = 'http://www.otodom.pl'
+# OTODOM_BASE_URL points the scraper at a different server, for example the stand-in from benchmarks/server.py
+BASE_URL = os.getenv('OTODOM_BASE_URL', 'http://www.otodom.pl')
+API_URL = os.getenv('OTODOM_BASE_URL', 'https://www.otodom.pl')
 
 WHITELISTED_DOMAINS = [
     'otodom.pl',
@@ -28,3 +35,6 @@ WHITELISTED_DOMAINS = [
     'otomoto.pl',
     'www.otomoto.pl'
 ]
+
+if os.getenv('OTODOM_BASE_URL'):
+    WHITELISTED_DOMAINS.append(urlparse(BASE_URL).hostname)
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+import zlib
+from multiprocessing import Pool
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, writers of the same archive aren't locked against each other there
+    fcntl = None
+try:
+    from __builtin__ import buffer
+except ImportError:
+    buffer = None
+
+log = logging.getLogger(__file__)
+
+DATA_FILE_NAME = "pages.dat"
+INDEX_FILE_NAME = "pages.idx"
+
+_opened_archives = {}
+
+
+class Archive(object):
+    """
+    An append-only store of raw pages, used to re-parse them later without accessing the network.
+
+    The archive is a directory with two files: a data file containing zlib compressed page bodies written one after
+    another and an index file containing one json line per page with its url, kind, fetch time, offset and length.
+    The data file is memory-mapped for reading, so the compressed bodies are never copied before decompression.
+    An archive can be shared between threads. Writers of the same archive take an exclusive lock on the data file
+    while appending, readers opened with read_only don't modify the files and can be used while pages are appended.
+    """
+
+    def __init__(self, path, read_only=False):
+        """
+        :param path: path to the archive directory, it will be created if it doesn't exist
+        :param read_only: only read the pages indexed when the archive is opened, without creating or repairing it
+        """
+        if not read_only and not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.read_only = read_only
+        self._data_file = open(os.path.join(path, DATA_FILE_NAME), "rb" if read_only else "ab+")
+        self._index_file = open(os.path.join(path, INDEX_FILE_NAME), "r" if read_only else "a+")
+        self._map = None
+        self._view = None
+        self._lock = threading.Lock()
+        self._lock_data_file()
+        try:
+            self._index_file.seek(0)
+            # a line without its newline is still being written
+            self.entries = [json.loads(line) for line in self._index_file if line.endswith("\n") and line.strip()]
+            if not read_only:
+                self._drop_unindexed_data()
+        finally:
+            self._unlock_data_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, url, content, kind="offer", fetched_at=None):
+        """
+        Stores a page body in the archive.
+
+        :param url: the url the page was fetched from
+        :param content: a requests.response.content object
+        :param kind: "offer" or "category", used by :meth:`scrape.archive.reparse_archive` to pick the parser
+        :param fetched_at: unix timestamp of the fetch, defaults to now
+        :rtype: dict
+        :return: the index entry of the stored page
+        """
+        if self.read_only:
+            raise IOError("The archive {0} was opened read only".format(self.path))
+        compressed = zlib.compress(content)
+        with self._lock:
+            self._lock_data_file()
+            try:
+                self._data_file.seek(0, os.SEEK_END)
+                entry = {
+                    'url': url,
+                    'kind': kind,
+                    'fetched_at': time.time() if fetched_at is None else fetched_at,
+                    'offset': self._data_file.tell(),
+                    'length': len(compressed),
+                }
+                # the data has to be written before the index line, so the index never points at a partial body
+                self._data_file.write(compressed)
+                self._data_file.flush()
+                self._index_file.write(json.dumps(entry) + "\n")
+                self._index_file.flush()
+            finally:
+                self._unlock_data_file()
+            self.entries.append(entry)
+        return entry
+
+    def read_compressed(self, entry):
+        """
+        :param entry: an index entry, see :meth:`scrape.archive.Archive.append`
+        :rtype: memoryview
+        :return: a zero-copy view of the compressed page body, a buffer on Python 2
+        """
+        end = entry['offset'] + entry['length']
+        with self._lock:
+            if self._view is None or len(self._view) < end:
+                self._remap()
+            if buffer is not None:
+                return buffer(self._view, entry['offset'], entry['length'])
+            return self._view[entry['offset']:end]
+
+    def read(self, entry):
+        """
+        :param entry: an index entry, see :meth:`scrape.archive.Archive.append`
+        :rtype: bytes
+        :return: the page body
+        """
+        return zlib.decompress(self.read_compressed(entry))
+
+    def get(self, url):
+        """
+        :param url: the url the page was fetched from
+        :rtype: bytes
+        :return: the most recently stored body for the url or None if it was never stored
+        """
+        for entry in reversed(self.entries):
+            if entry['url'] == url:
+                return self.read(entry)
+
+    def close(self):
+        self._unmap()
+        self._data_file.close()
+        self._index_file.close()
+
+    def _drop_unindexed_data(self):
+        size = self.entries[-1]['offset'] + self.entries[-1]['length'] if self.entries else 0
+        self._data_file.seek(0, os.SEEK_END)
+        if self._data_file.tell() > size:
+            # a body was written but its index line wasn't, it is dropped and overwritten by the next page
+            log.warning("Dropping {0} unindexed bytes of {1}".format(self._data_file.tell() - size, self.path))
+            self._data_file.truncate(size)
+
+    def _lock_data_file(self):
+        # readers don't lock, they only read the bodies indexed when they were opened
+        if fcntl is not None and not self.read_only:
+            fcntl.flock(self._data_file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_data_file(self):
+        if fcntl is not None and not self.read_only:
+            fcntl.flock(self._data_file.fileno(), fcntl.LOCK_UN)
+
+    def _remap(self):
+        # the previous mapping isn't closed, views returned from it may still be in use in other threads,
+        # it is released once they are garbage collected. Python 2 mmaps don't support memoryview, buffers are used.
+        self._map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = self._map if buffer is not None else memoryview(self._map)
+
+    def _unmap(self):
+        # buffers keep their mmap alive and would read a closed one, so on Python 2 it is closed once garbage collected
+        if isinstance(self._view, memoryview):
+            self._view.release()
+            self._map.close()
+        self._map, self._view = None, None
+
+
+def get_default_parsers():
+    from otodom.category import parse_category_content
+    from otodom.offer import parse_offer_markup
+    return {
+        'category': parse_category_content,
+        'offer': parse_offer_markup,
+    }
+
+
+def _reparse_entry(args):
+    path, entry, parser = args
+    # every worker process keeps its own mapping of the archive
+    if path not in _opened_archives:
+        _opened_archives[path] = Archive(path, read_only=True)
+    return entry, parser(_opened_archives[path].read(entry))
+
+
+def reparse_archive(path, kind="offer", parser=None, processes=None):
+    """
+    Runs the current parsers over the pages stored in the archive, without accessing the network.
+
+    :param path: path to the archive directory, see :class:`scrape.archive.Archive`
+    :param kind: only pages of this kind are parsed, "offer" or "category"
+    :param parser: a function taking the page body, defaults to :meth:`scrape.offer.parse_offer_markup` for offers and
+                    :meth:`scrape.category.parse_category_content` for categories
+    :param processes: number of worker processes, all cpus if None, 1 parses in the current process
+    :rtype: generator of tuple(dict, object)
+    :return: pairs of index entries and parser results, in archive order
+    """
+    parser = parser or get_default_parsers()[kind]
+    with Archive(path, read_only=True) as archive:
+        entries = [entry for entry in archive if entry['kind'] == kind]
+        if processes == 1:
+            for entry in entries:
+                yield entry, parser(archive.read(entry))
+            return
+    tasks = ((path, entry, parser) for entry in entries)
+    pool = Pool(processes)
+    try:
+        for result in pool.imap(_reparse_entry, tasks, chunksize=8):
+            yield result
+    finally:
+        pool.terminate()
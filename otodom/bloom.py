@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import os
+import struct
+import threading
+
+from otodom.lazy import LazyModule
+from otodom.store import get_offer_key
+
+hashlib = LazyModule('hashlib')
+
+log = logging.getLogger(__file__)
+
+# magic, format version, number of bits, number of hash functions, number of added keys
+HEADER = struct.Struct("<4sBQIQ")
+MAGIC = b"OTBF"
+VERSION = 1
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.01
+HASH = struct.Struct("<QQ")
+
+
+def get_bloom_size(capacity, error_rate):
+    """
+    :param capacity: the number of keys the filter is expected to hold
+    :param error_rate: the false positive rate at capacity, for example 0.01
+    :rtype: tuple(int, int)
+    :return: the optimal number of bits and number of hash functions
+    """
+    if capacity <= 0 or not 0 < error_rate < 1:
+        raise ValueError("capacity has to be positive and error_rate between 0 and 1")
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    num_bits += -num_bits % 8
+    return num_bits, max(1, int(round(num_bits / float(capacity) * math.log(2))))
+
+
+def _get_key_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if not isinstance(key, type(u"")):
+        key = u"{0}".format(key)
+    return key.encode("utf-8")
+
+
+class BloomFilter(object):
+    """
+    A compact set of seen keys, for example offer IDs, answering membership with a configurable false positive rate
+    and no false negatives. A million keys at a 1% error rate take about 1.2 MB, a fraction of a set of the strings.
+
+    The bits are kept in a bytearray, so the filter can be saved, loaded and merged with the filters of other workers
+    with the same capacity and error rate, see :meth:`scrape.bloom.BloomFilter.to_bytes`.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """
+        :param capacity: see :meth:`scrape.bloom.get_bloom_size`, more keys can be added at a higher error rate
+        :param error_rate: see :meth:`scrape.bloom.get_bloom_size`
+        """
+        self.num_bits, self.num_hashes = get_bloom_size(capacity, error_rate)
+        self.bits = bytearray(self.num_bits // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: bytes from :meth:`scrape.bloom.BloomFilter.to_bytes`
+        :rtype: :class:`scrape.bloom.BloomFilter`
+        :raises ValueError: if data isn't a serialized filter
+        """
+        if len(data) < HEADER.size:
+            raise ValueError("The data is not a serialized bloom filter")
+        magic, version, num_bits, num_hashes, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or len(data) - HEADER.size != num_bits // 8:
+            raise ValueError("The data is not a serialized bloom filter")
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.num_bits, bloom_filter.num_hashes, bloom_filter.count = num_bits, num_hashes, count
+        bloom_filter.bits = bytearray(data[HEADER.size:])
+        bloom_filter._lock = threading.Lock()
+        return bloom_filter
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a file written by :meth:`scrape.bloom.BloomFilter.save`
+        :rtype: :class:`scrape.bloom.BloomFilter`
+        """
+        with open(path, "rb") as bloom_file:
+            return cls.from_bytes(bloom_file.read())
+
+    def to_bytes(self):
+        """
+        :rtype: bytes
+        :return: the filter, with a header describing it
+        """
+        with self._lock:
+            return HEADER.pack(MAGIC, VERSION, self.num_bits, self.num_hashes, self.count) + bytes(self.bits)
+
+    def save(self, path):
+        """
+        Writes the filter to a file, replacing it at once, so readers never see a partially written filter.
+
+        :param path: path to the file
+        """
+        temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temporary_path, "wb") as bloom_file:
+            bloom_file.write(self.to_bytes())
+        os.rename(temporary_path, path)
+
+    def __len__(self):
+        return self.count
+
+    def _get_positions(self, key):
+        # double hashing, the k positions are derived from two 64 bit halves of a single digest
+        first, second = HASH.unpack(hashlib.md5(_get_key_bytes(key)).digest())
+        second |= 1
+        return [(first + index * second) % self.num_bits for index in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(key))
+
+    def add(self, key):
+        """
+        :param key: a string or any value formatted as one, for example an offer ID
+        :rtype: bool
+        :return: True if the key wasn't in the filter yet, False if it was or is a false positive
+        """
+        positions = self._get_positions(key)
+        with self._lock:
+            bits, added = self.bits, False
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not bits[position >> 3] & mask:
+                    bits[position >> 3] |= mask
+                    added = True
+            if added:
+                self.count += 1
+            return added
+
+    def update(self, other):
+        """
+        Adds the keys of another filter, for example one loaded from another worker.
+
+        :param other: a :class:`scrape.bloom.BloomFilter` with the same capacity and error rate
+        :raises ValueError: if the filters have different sizes
+        """
+        if (other.num_bits, other.num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError("Only filters with the same capacity and error rate can be merged")
+        other_bits = other.to_bytes()[HEADER.size:]
+        with self._lock:
+            self.bits = bytearray(byte | other_byte for byte, other_byte in zip(self.bits, bytearray(other_bits)))
+            # the keys added to both filters are counted twice, the count is an upper bound
+            self.count += other.count
+
+    def get_error_rate(self):
+        """
+        :rtype: float
+        :return: the expected false positive rate for the number of added keys
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / float(self.num_bits))) ** self.num_hashes
+
+    def filter(self, offers):
+        """
+        :param offers: an iterable of offer dictionaries, see :meth:`scrape.store.get_offer_key`
+        :rtype: generator of dict
+        :return: the offers that weren't seen before, all the offers are added. Offers without a key are always
+                 returned.
+        """
+        for offer in offers:
+            key = get_offer_key(offer)
+            if key is None or self.add(key):
+                yield offer
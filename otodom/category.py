@@ -2,20 +2,91 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import re
 import sys
-from bs4 import BeautifulSoup
 
 from otodom import WHITELISTED_DOMAINS
-from otodom.utils import get_response_for_url, get_url
+from otodom.checkpoint import get_search_key
+from otodom.instrumentation import span
+from otodom.lazy import BeautifulSoup
+from otodom.utils import SearchURL, _float, _int, get_response_for_url, get_url, iter_content_for_url
 
 if sys.version_info < (3, 3):
     from urlparse import urlparse
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
 else:
     from urllib.parse import urlparse
+    from html import unescape
 
 
 log = logging.getLogger(__file__)
 
+PROMOTED_FEATURED_NAMES = ("promo_vip", "promo_top_ads")
+
+# an element with the current class among others, like BeautifulSoup's find(class_="current")
+CURRENT_PATTERN = br'\bclass="(?:[^"]*\s)?current(?:\s[^"]*)?"[^>]*>\s*(?P<current>\d+)'
+SCAN_PATTERN = re.compile(
+    br'<article\s(?P<article>[^>]*\bclass="offer-item\b[^>]*)>'
+    br'|<a\s[^>]*?\bhref="(?P<href>[^"]*)"'
+    br'|' + CURRENT_PATTERN
+)
+SCAN_ATTRIBUTE_PATTERN = re.compile(br'\b(?P<name>data-item-id|data-featured-name)="(?P<value>[^"]*)"')
+STREAM_OFFER_PATTERN = re.compile(br'<article\s[^>]*\bclass="offer-item\b')
+STREAM_OUTSIDE_PATTERN = re.compile(
+    CURRENT_PATTERN + br'<'
+    br'|(?P<warning>\bsearch-location-extended-warning\b)'
+)
+ARTICLE_START, ARTICLE_END = b"<article", b"</article>"
+# markup kept between chunks when looking for the pages count and the search warning
+STREAM_OVERLAP = 128
+
+
+def get_category_offer_text(html_parser, class_, separator=None):
+    """
+    A method for getting the stripped text of a category offer element.
+
+    :param html_parser: a BeautifulSoup object
+    :param class_: the css class of the element
+    :param separator: if given, only the part of the text before the separator is returned
+    :rtype: string
+    :return: the stripped text, or empty string if the element is not present
+    """
+    element = html_parser.find(class_=class_)
+    if not element:
+        return ""
+    text = element.text
+    if separator:
+        text = text.split(separator)[0]
+    return text.strip()
+
+
+def get_category_offer_number(text, number_type):
+    """
+    A method for getting a number out of a category offer text like "2 900 zł" or "65,5 m²".
+
+    :param text: string, see :meth:`scrape.category.get_category_offer_text`
+    :param number_type: :meth:`scrape.utils._float` or :meth:`scrape.utils._int`
+    :rtype: float or int
+    :return: the number, or None if the text does not contain one
+    """
+    return number_type("".join(text.split()))
+
+
+def get_category_offer_location(html_parser):
+    """
+    A method for getting the location out of a category offer markup.
+
+    :param html_parser: a BeautifulSoup object
+    :rtype: string
+    :return: the location, for example 'Gdańsk, Wrzeszcz,  Antoniego Słonimskiego'
+    """
+    header = html_parser.find(class_="offer-item-header")
+    location = header.find("p") if header else None
+    if not location:
+        return ""
+    return location.text.split(": ", 1)[-1].strip()
+
 
 def parse_category_offer(offer_markup):
     """
@@ -43,6 +114,10 @@ def parse_category_offer(offer_markup):
         'detail_url': url,
         'offer_id': offer_id,
         'poster': poster.text.strip() if poster else "",
+        'price': get_category_offer_number(get_category_offer_text(html_parser, "offer-item-price", u"zł"), _float),
+        'surface': get_category_offer_number(get_category_offer_text(html_parser, "offer-item-area", u"m²"), _float),
+        'rooms': get_category_offer_number(get_category_offer_text(html_parser, "offer-item-rooms", " "), _int),
+        'location': get_category_offer_location(html_parser),
     }
 
 
@@ -53,14 +128,196 @@ def parse_category_content(markup):
     :param markup: a requests.response.content object
     :rtype: list(requests.response.content)
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
-    offers = html_parser.find_all(class_="offer-item")
-    parsed_offers = [
-        parse_category_offer(str(offer)) for offer in offers
-        if offer.attrs.get("data-featured-name") != "promo_vip" and
-        offer.attrs.get("data-featured-name") != "promo_top_ads"
-    ]
-    return parsed_offers
+    with span('category.parse', bytes=len(markup)):
+        html_parser = BeautifulSoup(markup, "html.parser")
+        offers = html_parser.find_all(class_="offer-item")
+        parsed_offers = [
+            parse_category_offer(str(offer)) for offer in offers
+            if offer.attrs.get("data-featured-name") not in PROMOTED_FEATURED_NAMES
+        ]
+        return parsed_offers
+
+
+def _scanned_value(value):
+    value = value.decode("utf-8")
+    return unescape(value) if "&" in value else value
+
+
+def scan_category_content(markup):
+    """
+    A method for getting the offers and the number of pages out of the markup without building a DOM.
+
+    It makes a single pass over the raw markup with a regular expression, so it is a lot faster than
+    :meth:`scrape.category.parse_category_content`, but it only extracts the fields needed for incremental polling.
+
+    :param markup: a requests.response.content object
+    :rtype: tuple(list(dict(string, string)), int)
+    :return: A list of offers, each containing 'detail_url', 'offer_id' and 'featured_name', and the number of pages,
+            see :meth:`scrape.category.get_category_number_of_pages`
+    """
+    if not isinstance(markup, bytes):
+        markup = markup.encode("utf-8")
+    with span('category.scan', bytes=len(markup)):
+        return _scan_category_content(markup)
+
+
+def _scan_category_content(markup):
+    offers, offer, pages_count = [], None, None
+    for match in SCAN_PATTERN.finditer(markup):
+        article, href, current = match.group("article", "href", "current")
+        if article is not None:
+            attributes = dict(SCAN_ATTRIBUTE_PATTERN.findall(article))
+            offer = {
+                'offer_id': _scanned_value(attributes.get(b"data-item-id", b"")) or None,
+                'featured_name': _scanned_value(attributes.get(b"data-featured-name", b"")),
+            }
+        elif href is not None:
+            if offer is None:
+                continue
+            # only the first link of an offer leads to its details
+            url = _scanned_value(href)
+            if url and urlparse(url).hostname in WHITELISTED_DOMAINS and \
+                    offer['featured_name'] not in PROMOTED_FEATURED_NAMES:
+                offer['detail_url'] = url
+                offers.append(offer)
+            offer = None
+        elif pages_count is None:
+            # the first one is the pages count, the same as in get_category_number_of_pages
+            pages_count = int(current)
+    return offers, 1 if pages_count is None else pages_count
+
+
+class CategoryStreamParser(object):
+    """
+    An incremental parser of a category page. The markup is fed in chunks, as they are downloaded, and every offer is
+    parsed as soon as its closing tag arrives, so only the current offer is kept in memory.
+    """
+
+    def __init__(self):
+        self.pages_count = 1
+        self.successful = True
+        self.size = 0
+        self._buffer = b""
+        self._in_offer = False
+        self._search_from = 0
+        self._outside = b""
+        self._found_pages_count = False
+
+    def feed(self, chunk):
+        """
+        :param chunk: the next part of the markup as bytes
+        :rtype: list(dict(string, string))
+        :return: the offers completed by the chunk, see :meth:`scrape.category.parse_category_offer`
+        """
+        self.size += len(chunk)
+        self._buffer += chunk
+        offers = []
+        while True:
+            if self._in_offer:
+                end = self._buffer.find(ARTICLE_END, self._search_from)
+                if end == -1:
+                    self._search_from = max(0, len(self._buffer) - len(ARTICLE_END) + 1)
+                    break
+                end += len(ARTICLE_END)
+                offer = self._parse_offer(self._buffer[:end])
+                if offer is not None:
+                    offers.append(offer)
+                self._buffer, self._in_offer = self._buffer[end:], False
+                continue
+            start = self._buffer.find(ARTICLE_START)
+            if start == -1:
+                # the end of the buffer might be the beginning of an article tag
+                self._scan_outside(len(self._buffer) - len(ARTICLE_START) + 1)
+                break
+            self._scan_outside(start)
+            tag_end = self._buffer.find(b">")
+            if tag_end == -1:
+                break
+            if STREAM_OFFER_PATTERN.match(self._buffer, 0, tag_end):
+                self._in_offer, self._search_from = True, tag_end
+            else:
+                self._scan_outside(tag_end + 1)
+        return offers
+
+    def close(self):
+        """
+        Processes the rest of the markup, an offer that wasn't closed is dropped.
+        """
+        if self._in_offer:
+            log.warning("Category markup ended inside of an offer")
+            self._buffer, self._in_offer = b"", False
+        self._scan_outside(len(self._buffer))
+
+    def _scan_outside(self, end):
+        if end <= 0:
+            return
+        # a part of the previously scanned markup is scanned again, in case a pattern was split between chunks
+        markup = self._outside + self._buffer[:end]
+        for match in STREAM_OUTSIDE_PATTERN.finditer(markup):
+            if match.group("current") is not None:
+                if not self._found_pages_count:
+                    self.pages_count, self._found_pages_count = int(match.group("current")), True
+            else:
+                self.successful = False
+        self._outside = markup[-STREAM_OVERLAP:]
+        self._buffer = self._buffer[end:]
+
+    def _parse_offer(self, markup):
+        featured_name = dict(SCAN_ATTRIBUTE_PATTERN.findall(markup[:markup.find(b">")])).get(b"data-featured-name")
+        if featured_name is not None and _scanned_value(featured_name) in PROMOTED_FEATURED_NAMES:
+            return None
+        return parse_category_offer(markup.decode("utf-8"))
+
+
+def iter_category_offers(chunks, parser=None, seen=None):
+    """
+    A method for parsing the offers out of a category markup while it is still being downloaded.
+
+    :param chunks: an iterable of bytes, for example from :meth:`scrape.utils.iter_content_for_url`
+    :param parser: an optional :class:`scrape.category.CategoryStreamParser`, it can be inspected for the number of
+                   pages after all the offers were consumed
+    :param seen: an optional container of offer IDs, for example a :class:`scrape.bloom.BloomFilter`, the offers in it
+                 are skipped, so only the offers that need a detail fetch are yielded
+    :rtype: generator of dict(string, string)
+    :return: the offers in the order of the markup, the same as :meth:`scrape.category.parse_category_content` returns
+    """
+    if parser is None:
+        parser = CategoryStreamParser()
+    for chunk in chunks:
+        for offer in parser.feed(chunk):
+            if seen is None or offer.get('offer_id') not in seen:
+                yield offer
+    parser.close()
+
+
+def stream_category_page(url, parser=None, seen=None):
+    """
+    A method for scraping a category page, offers are yielded as soon as they are downloaded.
+
+    :param url: the category page url, see :meth:`scrape.utils.get_url`
+    :param parser: see :meth:`scrape.category.iter_category_offers`
+    :param seen: see :meth:`scrape.category.iter_category_offers`
+    :rtype: generator of dict(string, string)
+    """
+    if parser is None:
+        parser = CategoryStreamParser()
+    with span('category.stream', url=url) as current:
+        for offer in iter_category_offers(iter_content_for_url(url), parser, seen):
+            yield offer
+        current.set(bytes=parser.size)
+
+
+def collect_chunks(chunks, collected):
+    """
+    Passes the chunks through, appending every one of them to collected, for example to archive a streamed page.
+
+    :param chunks: an iterable of bytes, see :meth:`scrape.category.iter_category_offers`
+    :param collected: a list the chunks are appended to
+    :rtype: generator of bytes
+    """
+    for chunk in chunks:
+        collected.append(chunk)
+        yield chunk
 
 
 def get_category_number_of_pages(markup):
@@ -70,15 +327,17 @@ def get_category_number_of_pages(markup):
     :param markup: a requests.response.content object
     :rtype: int
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
-    offers = html_parser.find(class_="current")
-    return int(offers.text) if offers else 1
+    with span('category.pages', bytes=len(markup)):
+        html_parser = BeautifulSoup(markup, "html.parser")
+        offers = html_parser.find(class_="current")
+        return int(offers.text) if offers else 1
 
 
 def was_category_search_successful(markup):
-    html_parser = BeautifulSoup(markup, "html.parser")
-    has_warning = bool(html_parser.find(class_="search-location-extended-warning"))
-    return not has_warning
+    with span('category.check', bytes=len(markup)):
+        html_parser = BeautifulSoup(markup, "html.parser")
+        has_warning = bool(html_parser.find(class_="search-location-extended-warning"))
+        return not has_warning
 
 
 def get_category_number_of_pages_from_parameters(main_category, detail_category, region, **filters):
@@ -104,7 +363,7 @@ def get_distinct_category_page(page, main_category, detail_category, region, **f
     return parsed_content
 
 
-def get_category(main_category, detail_category, region, **filters):
+def get_category(main_category, detail_category, region, archive=None, checkpoint=None, stream=False, **filters):
     """
     Scrape OtoDom search results based on supplied parameters.
 
@@ -115,6 +374,11 @@ def get_category(main_category, detail_category, region, **filters):
                     location is established using OtoDom's API, just as it would happen when typing something into the
                     search bar. Empty string returns results for the whole country. Will be ignored if either 'city',
                     'region', '[district_id]' or '[street_id]' is present in the filters.
+    :param archive: an optional :class:`scrape.archive.Archive`, the raw category pages will be stored in it
+    :param checkpoint: an optional :class:`scrape.checkpoint.Checkpoint`, completed pages are recorded in it and
+                    aren't fetched again when the search is repeated
+    :param stream: if True, the offers are parsed while the pages are downloaded, see
+                   :meth:`scrape.category.iter_category_offers`
     :param filters: the following dict contains every possible filter with examples of its values, but can be empty:
 
     ::
@@ -169,22 +433,57 @@ def get_category(main_category, detail_category, region, **filters):
         'detail_url' - a link to the offer
         'offer_id' - the internal otodom's offer ID, not to be mistaken with the '[id]' field from the input_dict
         'poster' - a piece of information about the poster. Could either be a name of the agency or "Oferta prywatna"
+        'price' - the price shown on the search results page as float, None if not available
+        'surface' - the surface in square meters as float, None if not available
+        'rooms' - the number of rooms as int, None if not available
+        'location' - the location shown on the search results page, for example 'Gdańsk, Wrzeszcz'
     """
-    page, pages_count, parsed_content = 1, None, []
+    page, pages_count, parsed_content, search_url = 1, None, [], None
+    if checkpoint is not None:
+        search = get_search_key(main_category, detail_category, region, filters)
+        completed_pages = checkpoint.get_pages(search)
+    else:
+        completed_pages = {}
 
     while page == 1 or page <= pages_count:
-        url = get_url(main_category, detail_category, region, "?nrAdsPerPage=72", page, **filters)
-        content = get_response_for_url(url).content
-        if not was_category_search_successful(content):
+        if page in completed_pages:
+            pages_count, offers = completed_pages[page]
+            parsed_content.extend(offers)
+            page += 1
+            continue
+
+        if search_url is None:
+            search_url = SearchURL(main_category, detail_category, region, "?nrAdsPerPage=72", **filters)
+        url = search_url.url(page)
+        log.info(url)
+        if stream:
+            parser, chunks = CategoryStreamParser(), []
+            chunks_iterator = iter_content_for_url(url)
+            if archive is not None:
+                chunks_iterator = collect_chunks(chunks_iterator, chunks)
+            offers = list(iter_category_offers(chunks_iterator, parser))
+            content, successful, page_pages_count = b"".join(chunks), parser.successful, parser.pages_count
+        else:
+            content = get_response_for_url(url).content
+            successful = was_category_search_successful(content)
+        if archive is not None:
+            archive.append(url, content, kind="category")
+        if not successful:
             log.warning("Search for category wasn't successful", url)
             return []
 
-        parsed_content.extend(parse_category_content(content))
+        if not stream:
+            offers = parse_category_content(content)
+        parsed_content.extend(offers)
 
         if page == 1:
-            pages_count = get_category_number_of_pages(content)
-            if page == pages_count:
-                break
+            pages_count = page_pages_count if stream else get_category_number_of_pages(content)
+
+        if checkpoint is not None:
+            checkpoint.save_page(search, page, pages_count, offers)
+
+        if page == pages_count:
+            break
 
         page += 1
 
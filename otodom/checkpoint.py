@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from otodom.lazy import LazyModule
+
+json = LazyModule('json')
+pickle = LazyModule('pickle')
+sqlite3 = LazyModule('sqlite3')
+
+log = logging.getLogger(__file__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS category_pages (
+    search TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    pages_count INTEGER NOT NULL,
+    offers BLOB NOT NULL,
+    PRIMARY KEY (search, page)
+);
+CREATE TABLE IF NOT EXISTS offers (
+    batch TEXT NOT NULL,
+    offer_id TEXT NOT NULL,
+    result BLOB NOT NULL,
+    PRIMARY KEY (batch, offer_id)
+);
+"""
+
+
+def get_search_key(main_category, detail_category, region, filters):
+    """
+    This method builds a string identifying a search, used as the checkpoint key.
+
+    :param main_category: see :meth:`scrape.category.get_category` for reference
+    :param detail_category: see :meth:`scrape.category.get_category` for reference
+    :param region: see :meth:`scrape.category.get_category` for reference
+    :param filters: dict, see :meth:`scrape.category.get_category` for reference
+    :rtype: string
+    """
+    return json.dumps([main_category, detail_category, region, filters], sort_keys=True)
+
+
+class Checkpoint(object):
+    """
+    A local sqlite store recording the completed category pages of each search and the completed offers of each
+    batch, so a restarted sweep can resume where it stopped without fetching anything twice.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the sqlite database file, it will be created if it doesn't exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def _execute(self, query, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def get_pages(self, search):
+        """
+        :param search: string, see :meth:`scrape.checkpoint.get_search_key`
+        :rtype: dict(int, tuple(int, list(dict)))
+        :return: completed page numbers mapped to the number of pages and the offers found on them
+        """
+        rows = self._execute("SELECT page, pages_count, offers FROM category_pages WHERE search = ?", (search,))
+        return {page: (pages_count, pickle.loads(offers)) for page, pages_count, offers in rows}
+
+    def get_last_page(self, search):
+        """
+        :param search: string, see :meth:`scrape.checkpoint.get_search_key`
+        :rtype: int
+        :return: the last completed page of the search, 0 if none was completed
+        """
+        return self._execute("SELECT MAX(page) FROM category_pages WHERE search = ?", (search,))[0][0] or 0
+
+    def save_page(self, search, page, pages_count, offers):
+        """
+        Marks a category page as completed.
+
+        :param search: string, see :meth:`scrape.checkpoint.get_search_key`
+        :param page: page number
+        :param pages_count: number of pages in the search
+        :param offers: list of offers found on the page, see :meth:`scrape.category.parse_category_content`
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO category_pages (search, page, pages_count, offers) VALUES (?, ?, ?, ?)",
+            (search, page, pages_count, sqlite3.Binary(pickle.dumps(offers, protocol=2)))
+        )
+
+    def get_offers(self, batch):
+        """
+        :param batch: string identifying the batch of offers
+        :rtype: dict(string, dict)
+        :return: completed offer ids mapped to the scraped offer details
+        """
+        rows = self._execute("SELECT offer_id, result FROM offers WHERE batch = ?", (batch,))
+        return {offer_id: pickle.loads(result) for offer_id, result in rows}
+
+    def save_offer(self, batch, offer_id, result):
+        """
+        Marks an offer as completed.
+
+        :param batch: string identifying the batch of offers
+        :param offer_id: the internal otodom's offer ID, see :meth:`scrape.category.get_category`
+        :param result: the scraped offer details, see :meth:`scrape.offer.get_offer_information`
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO offers (batch, offer_id, result) VALUES (?, ?, ?)",
+            (batch, offer_id, sqlite3.Binary(pickle.dumps(result, protocol=2)))
+        )
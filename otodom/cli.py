@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Command line interface scraping searches and their offers concurrently.
+
+Usage::
+
+    python -m otodom wynajem/mieszkanie/gda sprzedaz/dom/sopot --concurrency 8 --rate-limit 5 -o offers.jsonl.gz
+    python -m otodom --file searches.jsonl --limit 100 --profile profiles/
+
+Every line of a searches file is a json object with 'main_category', 'detail_category', 'region' and optionally
+'filters', see :meth:`otodom.category.get_category`.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+
+from otodom import metrics
+from otodom.sinks import FORMATS, open_sink
+
+log = logging.getLogger(__file__)
+
+
+class StageProfiler(object):
+    """
+    Profiles every call made through :meth:`run` and merges the statistics per stage.
+
+    Only one profiler can be active in a process on Python 3.12+, so the profiled calls are serialized, even when
+    they are made from many threads.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: the statistics of every stage are dumped to <directory>/<stage>.prof
+        """
+        self.directory = directory
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def run(self, stage, func, *args, **kwargs):
+        import cProfile
+        with self._lock:
+            profile = self.profiles.get(stage)
+            if profile is None:
+                profile = self.profiles[stage] = cProfile.Profile()
+            return profile.runcall(func, *args, **kwargs)
+
+    def dump(self):
+        import pstats
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for stage, profile in self.profiles.items():
+            path = os.path.join(self.directory, "{0}.prof".format(stage))
+            pstats.Stats(profile).dump_stats(path)
+            log.info("Profile of {0} written to {1}".format(stage, path))
+
+
+class NullProfiler(object):
+
+    def run(self, stage, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def dump(self):
+        pass
+
+
+def parse_search(value):
+    """
+    :param value: string in the "main_category/detail_category/region" format, region may be empty
+    :rtype: dict
+    """
+    parts = value.split("/")
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError("searches look like main_category/detail_category/region, got {0}".format(
+            value))
+    return {'main_category': parts[0], 'detail_category': parts[1], 'region': parts[2]}
+
+
+def parse_filter(value):
+    """
+    :param value: string in the "key=value" format, for example "[filter_float_price:to]=3000"
+    :rtype: tuple(string, string)
+    """
+    if "=" not in value:
+        raise argparse.ArgumentTypeError("filters look like key=value, got {0}".format(value))
+    return tuple(value.split("=", 1))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="otodom", description="Scrape otodom searches and their offers.")
+    parser.add_argument("searches", nargs="*", type=parse_search,
+                        help="searches in the main_category/detail_category/region format, e.g. wynajem/mieszkanie/gda")
+    parser.add_argument("-f", "--file", help="file with one json search per line")
+    parser.add_argument("--filter", dest="filters", action="append", type=parse_filter, default=[],
+                        help="filter applied to the searches given as arguments, e.g. [filter_float_price:to]=3000")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="number of concurrent requests")
+    parser.add_argument("--rate-limit", type=float, help="maximal number of requests per second")
+    parser.add_argument("--cache-dir", help="cache responses in this directory")
+    parser.add_argument("-o", "--output", help="output file, standard output if not given")
+    parser.add_argument("--format", choices=FORMATS, help="output format, guessed from the output file name")
+    parser.add_argument("--limit", type=int, help="scrape at most this many offers")
+    parser.add_argument("--categories-only", action="store_true",
+                        help="output the offers found in the searches without fetching their details")
+    parser.add_argument("--archive", help="store the raw pages in an archive in this directory")
+    parser.add_argument("--checkpoint", help="record progress in this file and resume from it")
+    parser.add_argument("--profile",
+                        help="dump cProfile statistics of every stage into this directory, profiled calls run one at a "
+                             "time")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    return parser
+
+
+def get_searches(args):
+    searches = [dict(search, filters=dict(args.filters)) for search in args.searches]
+    if args.file:
+        with open(args.file) as searches_file:
+            searches.extend(json.loads(line) for line in searches_file if line.strip())
+    return searches
+
+
+class StandardOutputSink(object):
+
+    def write(self, record):
+        sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def close(self):
+        sys.stdout.flush()
+
+
+def run(args):
+    """
+    Scrapes the searches and then the offers found in them, writing every scraped record to the output.
+
+    :rtype: dict
+    :return: counts of the scraped searches, offers and errors
+    """
+    if args.cache_dir:
+        # scrapper_helpers reads these when it is imported, which happens on the first request
+        os.environ['CACHE_DIR'] = args.cache_dir
+        os.environ['DEBUG'] = "1"
+
+    from otodom.archive import Archive
+    from otodom.category import get_category
+    from otodom.checkpoint import Checkpoint
+    from otodom.offer import get_offer_information
+    from otodom.utils import map_concurrently, set_rate_limit
+
+    set_rate_limit(args.rate_limit)
+    if args.metrics_port is not None:
+        metrics.install()
+        metrics.start_http_server(args.metrics_port)
+
+    profiler = StageProfiler(args.profile) if args.profile else NullProfiler()
+    archive = Archive(args.archive) if args.archive else None
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    sink = open_sink(args.output, args.format) if args.output else StandardOutputSink()
+    stats = {'searches': 0, 'offers': 0, 'errors': 0}
+    completed_offers = checkpoint.get_offers("cli") if checkpoint is not None else {}
+
+    def scrape_search(search):
+        try:
+            return profiler.run(
+                "category", get_category, search['main_category'], search['detail_category'], search['region'],
+                archive=archive, checkpoint=checkpoint, **search.get('filters', {}))
+        except Exception:
+            log.exception("Scraping search {0} failed".format(search))
+            return None
+
+    def scrape_offer(context):
+        if context['offer_id'] in completed_offers:
+            return completed_offers[context['offer_id']]
+        try:
+            result = profiler.run(
+                "offer", get_offer_information, context['detail_url'], context=context, archive=archive)
+        except Exception:
+            log.exception("Scraping offer {0} failed".format(context['detail_url']))
+            return None
+        if checkpoint is not None:
+            checkpoint.save_offer("cli", context['offer_id'], result)
+        return result
+
+    try:
+        searches = get_searches(args)
+        offers, seen = [], set()
+        for found in map_concurrently(scrape_search, searches, args.concurrency):
+            if found is None:
+                stats['errors'] += 1
+                continue
+            stats['searches'] += 1
+            for offer in found:
+                if offer['offer_id'] not in seen:
+                    seen.add(offer['offer_id'])
+                    offers.append(offer)
+        offers = offers[:args.limit] if args.limit is not None else offers
+        log.info("Found {0} offers in {1} searches".format(len(offers), len(searches)))
+
+        if args.categories_only:
+            for offer in offers:
+                sink.write(offer)
+                stats['offers'] += 1
+            return stats
+
+        from multiprocessing.pool import ThreadPool
+        concurrency = max(1, args.concurrency)
+        # the pool keeps finished results in an unbounded queue, so an offer is only submitted once fewer than
+        # 2 * concurrency are being scraped or waiting to be written, a slow sink then slows the fetchers down too
+        pending = threading.BoundedSemaphore(2 * concurrency)
+
+        def submitted(offers):
+            for offer in offers:
+                pending.acquire()
+                yield offer
+
+        pool = ThreadPool(concurrency)
+        try:
+            for result in pool.imap_unordered(scrape_offer, submitted(offers)):
+                try:
+                    if result is None:
+                        stats['errors'] += 1
+                        continue
+                    sink.write(result)
+                    stats['offers'] += 1
+                finally:
+                    pending.release()
+        finally:
+            pool.close()
+        return stats
+    finally:
+        sink.close()
+        profiler.dump()
+        if archive is not None:
+            archive.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if not args.searches and not args.file:
+        get_parser().error("give at least one search or a --file with searches")
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    stats = run(args)
+    log.info("Scraped {searches} searches and {offers} offers, {errors} errors".format(**stats))
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import random
+import re
+import threading
+import zlib
+
+from otodom.geo import get_numpy, haversine
+from otodom.store import get_indexed_values, get_offer_key
+
+log = logging.getLogger(__file__)
+
+# a Mersenne prime, so (a * x + b) of 31 bit values fits in 64 bits
+PRIME = (1 << 31) - 1
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 32
+DEFAULT_THRESHOLD = 0.7
+SHINGLE_SIZE = 3
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+# attribute tokens: about 100 meters of coordinates, 1 m² of surface and 5% of price
+COORDINATES_PRECISION = 3
+PRICE_STEP = math.log(1.05)
+# the limits two offers have to be within to be duplicates, when both of them have the value
+MAX_DISTANCE_KM = 0.3
+MAX_SURFACE_DIFFERENCE = 0.05
+MAX_PRICE_DIFFERENCE = 0.1
+
+
+def get_shingles(text, size=SHINGLE_SIZE):
+    """
+    :param text: a text, for example the offer description
+    :param size: the number of words in a shingle
+    :rtype: set(string)
+    :return: the lowercase word shingles of the text
+    """
+    words = WORD_PATTERN.findall((text or "").lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[index:index + size]) for index in range(len(words) - size + 1)}
+
+
+def get_offer_tokens(offer, size=SHINGLE_SIZE):
+    """
+    This method returns the set an offer is compared by: the shingles of its description, or of its title and
+    location when it has no description, like category search results, and coarse coordinates, surface, price and rooms
+    tokens.
+
+    :param offer: an offer dictionary, from :meth:`scrape.category.get_category` or
+                  :meth:`scrape.offer.get_offer_information`
+    :param size: see :meth:`scrape.dedup.get_shingles`
+    :rtype: set(string)
+    """
+    text = offer.get('description') or u" ".join(
+        offer.get(field) or u"" for field in ('title', 'location', 'address', 'poster'))
+    tokens = get_shingles(text, size)
+    values, _ = get_indexed_values(offer)
+    coordinates = offer.get('geographical_coordinates') or (None, None)
+    if coordinates[0] is not None and coordinates[1] is not None:
+        tokens.add(u"geo:{0:.{2}f}:{1:.{2}f}".format(coordinates[0], coordinates[1], COORDINATES_PRECISION))
+    if values['surface']:
+        tokens.add(u"surface:{0}".format(int(round(values['surface']))))
+    if values['price']:
+        tokens.add(u"price:{0}".format(int(round(math.log(values['price']) / PRICE_STEP))))
+    if values['rooms'] is not None:
+        tokens.add(u"rooms:{0}".format(values['rooms']))
+    return tokens
+
+
+class MinHasher(object):
+    """Computes MinHash signatures of sets of strings, with numpy if it is installed."""
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=1):
+        """
+        :param num_perm: the number of hash functions, the length of the signatures
+        :param seed: signatures are only comparable if they were computed with the same seed
+        """
+        generator = random.Random(seed)
+        self.num_perm = num_perm
+        self.coefficients = [(generator.randint(1, PRIME - 1), generator.randint(0, PRIME - 1))
+                             for _ in range(num_perm)]
+        numpy = self.numpy = get_numpy()
+        if numpy is not None:
+            self._a = numpy.array([a for a, _ in self.coefficients], dtype=numpy.uint64)
+            self._b = numpy.array([b for _, b in self.coefficients], dtype=numpy.uint64)
+
+    def signature(self, tokens):
+        """
+        :param tokens: a set of strings
+        :rtype: tuple(int)
+        :return: the signature, None if tokens is empty
+        """
+        hashes = [zlib.crc32(token.encode("utf-8")) % PRIME for token in tokens]
+        if not hashes:
+            return None
+        numpy = self.numpy
+        if numpy is not None:
+            values = numpy.array(hashes, dtype=numpy.uint64)
+            signature = ((numpy.outer(self._a, values) + self._b[:, None]) % PRIME).min(axis=1)
+            return tuple(int(value) for value in signature)
+        return tuple(min((a * value + b) % PRIME for value in hashes) for a, b in self.coefficients)
+
+
+def get_similarity(signature, other_signature):
+    """
+    :rtype: float
+    :return: the estimated Jaccard similarity of the sets the signatures were computed from
+    """
+    return sum(1 for value, other_value in zip(signature, other_signature) if value == other_value) / float(
+        len(signature))
+
+
+def are_attributes_compatible(offer, other_offer):
+    """
+    :rtype: bool
+    :return: False if the coordinates, surfaces or prices of the offers are too different for them to be the same flat
+    """
+    values, _ = get_indexed_values(offer)
+    other_values, _ = get_indexed_values(other_offer)
+    for field, max_difference in (('surface', MAX_SURFACE_DIFFERENCE), ('price', MAX_PRICE_DIFFERENCE)):
+        value, other_value = values[field], other_values[field]
+        if value and other_value and abs(value - other_value) > max_difference * max(value, other_value):
+            return False
+    coordinates = offer.get('geographical_coordinates') or (None, None)
+    other_coordinates = other_offer.get('geographical_coordinates') or (None, None)
+    if None not in coordinates and None not in other_coordinates:
+        return haversine(coordinates[0], coordinates[1], other_coordinates[0], other_coordinates[1]) <= MAX_DISTANCE_KM
+    return True
+
+
+class DuplicateIndex(object):
+    """
+    A locality sensitive hashing index of offer MinHash signatures. The signatures are split into bands, and offers
+    sharing any band are compared, so finding the duplicates of an offer doesn't depend on the number of indexed
+    offers. Offers are duplicates if their estimated similarity reaches the threshold and their attributes are
+    compatible, see :meth:`scrape.dedup.are_attributes_compatible`. Duplicates are collected into clusters, each
+    identified by the key of its first offer.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS, seed=1):
+        """
+        :param threshold: the minimal estimated Jaccard similarity of duplicates
+        :param num_perm: see :class:`scrape.dedup.MinHasher`
+        :param bands: the number of bands, num_perm has to be divisible by it. More bands find more candidates
+                      with a lower similarity, at the cost of more comparisons.
+        :param seed: see :class:`scrape.dedup.MinHasher`
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm has to be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, seed)
+        self._buckets = [{} for _ in range(bands)]
+        self._signatures = {}
+        self._offers = {}
+        self._parents = {}
+        self._numbers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key):
+        return key in self._signatures
+
+    def _get_bands(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows] for band in range(self.bands)]
+
+    def _get_cluster(self, key):
+        while self._parents[key] != key:
+            self._parents[key] = self._parents[self._parents[key]]
+            key = self._parents[key]
+        return key
+
+    def _find(self, offer, signature):
+        candidates = set()
+        for band, bucket in zip(self._get_bands(signature), self._buckets):
+            candidates.update(bucket.get(band, ()))
+        return sorted(
+            (key for key in candidates
+             if get_similarity(signature, self._signatures[key]) >= self.threshold and
+             are_attributes_compatible(offer, self._offers[key])),
+            key=lambda key: -get_similarity(signature, self._signatures[key]))
+
+    def find_duplicates(self, offer):
+        """
+        :param offer: an offer dictionary, see :meth:`scrape.dedup.get_offer_tokens`
+        :rtype: list
+        :return: the keys of the indexed offers the offer duplicates, the most similar first
+        """
+        signature = self.hasher.signature(get_offer_tokens(offer))
+        if signature is None:
+            return []
+        with self._lock:
+            return self._find(offer, signature)
+
+    def add(self, offer, key=None):
+        """
+        Indexes an offer.
+
+        :param offer: an offer dictionary, see :meth:`scrape.dedup.get_offer_tokens`
+        :param key: the key identifying the offer, by default :meth:`scrape.store.get_offer_key`
+        :raises ValueError: if the offer has no key
+        :return: the key of the cluster the offer duplicates, None if it is not a duplicate. Offers without any
+                 text or attributes are never duplicates.
+        """
+        key = get_offer_key(offer) if key is None else key
+        if key is None:
+            raise ValueError("The offer has no offer_id nor detail_url, pass its key")
+        signature = self.hasher.signature(get_offer_tokens(offer))
+        if signature is None:
+            return None
+        with self._lock:
+            if key in self._signatures:
+                cluster = self._get_cluster(key)
+                return cluster if cluster != key else None
+            duplicates = self._find(offer, signature)
+            self._signatures[key] = signature
+            self._offers[key] = {
+                field: offer.get(field) for field in ('price', 'surface', 'rooms', 'geographical_coordinates')}
+            for band, bucket in zip(self._get_bands(signature), self._buckets):
+                bucket.setdefault(band, []).append(key)
+            self._parents[key] = key
+            self._numbers[key] = len(self._numbers)
+            clusters = sorted({self._get_cluster(duplicate) for duplicate in duplicates}, key=self._numbers.get)
+            if not clusters:
+                return None
+            # the clusters joined by the offer are merged into the oldest one
+            for cluster in clusters:
+                self._parents[cluster] = clusters[0]
+            self._parents[key] = clusters[0]
+            return clusters[0]
+
+    def get_cluster(self, key):
+        """
+        :param key: the key of an indexed offer
+        :return: the key of the first offer of its cluster
+        """
+        with self._lock:
+            return self._get_cluster(key)
+
+    def get_clusters(self):
+        """
+        :rtype: list(list)
+        :return: the keys of the offers of every cluster with more than one offer, in the order they were added
+        """
+        with self._lock:
+            clusters = {}
+            for key in sorted(self._signatures, key=self._numbers.get):
+                clusters.setdefault(self._get_cluster(key), []).append(key)
+        return [keys for keys in clusters.values() if len(keys) > 1]
+
+    def filter(self, offers):
+        """
+        :param offers: an iterable of offer dictionaries
+        :rtype: generator of dict
+        :return: the offers that aren't duplicates of the offers indexed before them, all the offers are indexed
+        """
+        for offer in offers:
+            if self.add(offer) is None:
+                yield offer
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+import threading
+from array import array
+
+log = logging.getLogger(__file__)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# about 1.1 km of latitude, a few offers per cell in a dense city
+DEFAULT_CELL_SIZE = 0.01
+# the smallest cosine of latitude used for cell widths, so queries close to the poles stay bounded
+MIN_COSINE = 0.01
+
+_numpy = None
+
+
+def get_numpy():
+    """
+    :return: the numpy module, None if it is not installed
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """
+    :rtype: float
+    :return: the great-circle distance between the two points in kilometers
+    """
+    latitude, other_latitude = math.radians(latitude), math.radians(other_latitude)
+    a = math.sin((other_latitude - latitude) / 2) ** 2 + \
+        math.cos(latitude) * math.cos(other_latitude) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def haversine_many(latitude, longitude, latitudes, longitudes, numpy=None):
+    """
+    Computes the distances from a point to many points at once.
+
+    :param latitudes: a sequence of latitudes
+    :param longitudes: a sequence of longitudes
+    :param numpy: the numpy module to vectorize the computation with, the distances are computed one by one if None
+    :rtype: list(float) or numpy.ndarray
+    :return: the great-circle distances in kilometers
+    """
+    if numpy is None:
+        return [haversine(latitude, longitude, other_latitude, other_longitude)
+                for other_latitude, other_longitude in zip(latitudes, longitudes)]
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    a = numpy.sin((latitudes - latitude) / 2) ** 2 + \
+        math.cos(latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def get_offer_coordinates(offer):
+    """
+    :param offer: an offer dictionary from :meth:`scrape.offer.get_offer_information`
+    :rtype: tuple(float, float)
+    :return: the latitude and longitude, None if the offer has no coordinates
+    """
+    coordinates = offer.get('geographical_coordinates') or (None, None)
+    if coordinates[0] is None or coordinates[1] is None:
+        return None
+    return float(coordinates[0]), float(coordinates[1])
+
+
+class _Cell(object):
+
+    def __init__(self):
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.items = []
+
+
+class GeoIndex(object):
+    """
+    A spatial index of points, for example scraped offers, answering radius, bounding box and nearest neighbours
+    queries. The points are bucketed in a grid of cells of cell_size degrees, so a query only computes the distances
+    to the points in the cells around it, with numpy if it is installed. Points can be inserted at any time.
+    """
+
+    def __init__(self, offers=(), cell_size=DEFAULT_CELL_SIZE, use_numpy=None):
+        """
+        :param offers: offers to add, see :meth:`scrape.geo.GeoIndex.add`
+        :param cell_size: the size of the grid cells in degrees
+        :param use_numpy: whether the distances are computed with numpy, by default if it is installed
+        """
+        self.cell_size = float(cell_size)
+        self.numpy = get_numpy() if use_numpy is None or use_numpy else None
+        if use_numpy and self.numpy is None:
+            raise ImportError("use_numpy requires the numpy package, pip install numpy")
+        self._cells = {}
+        self._size = 0
+        self._bounds = None
+        self._lock = threading.Lock()
+        self.update(offers)
+
+    def __len__(self):
+        return self._size
+
+    def _get_cell_key(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size))
+
+    def insert(self, latitude, longitude, item):
+        """
+        :param latitude: float
+        :param longitude: float
+        :param item: any object returned by the queries, for example an offer
+        """
+        row, column = key = self._get_cell_key(latitude, longitude)
+        with self._lock:
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = _Cell()
+            cell.latitudes.append(latitude)
+            cell.longitudes.append(longitude)
+            cell.items.append(item)
+            self._size += 1
+            if self._bounds is None:
+                self._bounds = [row, row, column, column]
+            else:
+                bounds = self._bounds
+                bounds[:] = min(bounds[0], row), max(bounds[1], row), min(bounds[2], column), max(bounds[3], column)
+
+    def add(self, offer):
+        """
+        :param offer: an offer dictionary from :meth:`scrape.offer.get_offer_information`
+        :rtype: bool
+        :return: False if the offer has no coordinates and wasn't added
+        """
+        coordinates = get_offer_coordinates(offer)
+        if coordinates is None:
+            return False
+        self.insert(coordinates[0], coordinates[1], offer)
+        return True
+
+    def update(self, offers):
+        """
+        :param offers: an iterable of offers, see :meth:`scrape.geo.GeoIndex.add`
+        """
+        for offer in offers:
+            self.add(offer)
+
+    def _get_cells(self, south, west, north, east):
+        """Returns the cells intersecting the bounding box, looking up the smaller of the grid range and the grid."""
+        first_row, first_column = self._get_cell_key(south, west)
+        last_row, last_column = self._get_cell_key(north, east)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) <= len(self._cells):
+            cells = (self._cells.get((row, column))
+                     for row in range(first_row, last_row + 1) for column in range(first_column, last_column + 1))
+            return [cell for cell in cells if cell is not None]
+        return [cell for (row, column), cell in self._cells.items()
+                if first_row <= row <= last_row and first_column <= column <= last_column]
+
+    def _get_distances(self, latitude, longitude, cells):
+        latitudes, longitudes, items = array('d'), array('d'), []
+        for cell in cells:
+            latitudes.extend(cell.latitudes)
+            longitudes.extend(cell.longitudes)
+            items.extend(cell.items)
+        return haversine_many(latitude, longitude, latitudes, longitudes, self.numpy), items
+
+    def within_bbox(self, south, west, north, east):
+        """
+        :param south: the minimal latitude
+        :param west: the minimal longitude
+        :param north: the maximal latitude
+        :param east: the maximal longitude
+        :rtype: list
+        :return: the items inside the bounding box
+        """
+        with self._lock:
+            cells = self._get_cells(south, west, north, east)
+            return [item for cell in cells
+                    for item_latitude, item_longitude, item in zip(cell.latitudes, cell.longitudes, cell.items)
+                    if south <= item_latitude <= north and west <= item_longitude <= east]
+
+    def within_radius(self, latitude, longitude, radius):
+        """
+        :param latitude: float
+        :param longitude: float
+        :param radius: the distance in kilometers
+        :rtype: list(tuple(float, object))
+        :return: the distances in kilometers and the items not farther than radius, the nearest first
+        """
+        latitude_delta = radius / KM_PER_DEGREE
+        longitude_delta = radius / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), MIN_COSINE))
+        with self._lock:
+            cells = self._get_cells(latitude - latitude_delta, longitude - longitude_delta,
+                                    latitude + latitude_delta, longitude + longitude_delta)
+            distances, items = self._get_distances(latitude, longitude, cells)
+        if self.numpy is not None:
+            indexes = self.numpy.nonzero(distances <= radius)[0]
+            return sorted(((float(distances[index]), items[index]) for index in indexes), key=lambda pair: pair[0])
+        return sorted(((distance, item) for distance, item in zip(distances, items) if distance <= radius),
+                      key=lambda pair: pair[0])
+
+    def nearest(self, latitude, longitude, count=1):
+        """
+        :param latitude: float
+        :param longitude: float
+        :param count: the number of items to find
+        :rtype: list(tuple(float, object))
+        :return: the distances in kilometers and the nearest count items, the nearest first
+        """
+        with self._lock:
+            if not self._size or count <= 0:
+                return []
+            row, column = self._get_cell_key(latitude, longitude)
+            min_row, max_row, min_column, max_column = self._bounds
+            max_ring = max(row - min_row, max_row - row, column - min_column, max_column - column)
+            found = []
+            for ring in range(max_ring + 1):
+                # far from the points the rings are mostly empty, once a ring has more keys than the grid has cells,
+                # the cells left are scanned at once
+                scan_rest = 8 * ring > len(self._cells)
+                if scan_rest:
+                    cells = [cell for (cell_row, cell_column), cell in self._cells.items()
+                             if max(abs(cell_row - row), abs(cell_column - column)) >= ring]
+                else:
+                    cells = [self._cells.get(key) for key in _get_ring(row, column, ring)]
+                distances, items = self._get_distances(latitude, longitude, [cell for cell in cells if cell])
+                # the running number keeps the items, which might not be comparable, out of the comparisons
+                numbers = range(len(found), len(found) + len(items))
+                found.extend(zip((float(distance) for distance in distances), numbers, items))
+                if scan_rest:
+                    break
+                if len(found) < count:
+                    continue
+                # the points outside of the scanned rings are at least ring cells away, the cells being narrowest
+                # on the side farther from the equator
+                cosine = max(math.cos(math.radians(min(abs(latitude) + (ring + 1) * self.cell_size, 90))), MIN_COSINE)
+                if heapq.nsmallest(count, found)[-1][0] <= ring * self.cell_size * KM_PER_DEGREE * cosine:
+                    break
+            return [(distance, item) for distance, _, item in heapq.nsmallest(count, found)]
+
+
+def _get_ring(row, column, ring):
+    if ring == 0:
+        return [(row, column)]
+    keys = [(row - ring, column + offset) for offset in range(-ring, ring + 1)]
+    keys.extend((row + ring, column + offset) for offset in range(-ring, ring + 1))
+    keys.extend((row + offset, column - ring) for offset in range(-ring + 1, ring))
+    keys.extend((row + offset, column + ring) for offset in range(-ring + 1, ring))
+    return keys
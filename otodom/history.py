@@ -0,0 +1,381 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+
+from otodom.geo import get_numpy
+from otodom.lazy import LazyModule
+from otodom.store import get_indexed_values, get_offer_key
+
+json = LazyModule('json')
+
+log = logging.getLogger(__file__)
+
+# offer key index, unix timestamp, price (NaN once the offer is removed), currency index. Timestamps are doubles,
+# exact for whole seconds, since the array module of Python 2 has no 64 bit integer type.
+ROW = struct.Struct("<IddI")
+NAMES_SUFFIX = ".names"
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+# 1970-01-01 was a Thursday, weeks start on Mondays
+WEEK_OFFSET = 4 * DAY
+DEFAULT_CURRENCY = "PLN"
+REMOVED = float("nan")
+
+
+def get_period_start(timestamp, period=WEEK):
+    """
+    :param timestamp: unix timestamp
+    :param period: the length of the period in seconds, weeks start on Mondays
+    :rtype: int
+    :return: the unix timestamp of the start of the period containing timestamp
+    """
+    offset = WEEK_OFFSET if period == WEEK else 0
+    return int((timestamp - offset) // period * period + offset)
+
+
+def median(values):
+    """
+    :param values: a non-empty list of numbers
+    :rtype: float
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    return float(values[middle]) if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def mean(values):
+    """
+    :param values: a non-empty list of numbers
+    :rtype: float
+    """
+    return sum(values) / float(len(values))
+
+
+# the statistics aggregate can compute with numpy, by name
+STATISTICS = {
+    'count': len,
+    'min': min,
+    'max': max,
+    'mean': mean,
+    'median': median,
+}
+
+
+def _is_removed(price):
+    return price != price
+
+
+def _truncate(path, content, complete):
+    if complete != len(content):
+        # the last entry was not written completely, it is dropped and overwritten by the next one
+        log.warning("Dropping an incomplete entry of %s", path)
+        with open(path, "r+b") as truncated_file:
+            truncated_file.truncate(complete)
+
+
+class PriceHistory(object):
+    """
+    An append-only store of offer price changes. Only (offer, timestamp, price, currency) rows are kept, and a row is
+    only added when the price or the currency of the offer changed, so repeated sweeps cost nothing for stable offers.
+
+    The rows are held in typed arrays, one per column, and optionally appended to a file of fixed-size binary rows,
+    with the offer keys and currencies stored once in a names file next to it.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: path to the history file, it is created if it doesn't exist and loaded if it does, None keeps the
+                     history in memory only
+        """
+        self.path = path
+        self._names = []
+        self._name_indexes = {}
+        self._keys = array('I')
+        self._timestamps = array('d')
+        self._prices = array('d')
+        self._currencies = array('I')
+        self._rows_by_key = {}
+        self._lock = threading.Lock()
+        self._file = self._names_file = None
+        if path is not None:
+            self._load(path)
+            self._file = open(path, "ab")
+            self._names_file = open(path + NAMES_SUFFIX, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _load(self, path):
+        if os.path.exists(path + NAMES_SUFFIX):
+            with open(path + NAMES_SUFFIX, "rb") as names_file:
+                content = names_file.read()
+            complete = content.rfind(b"\n") + 1
+            _truncate(path + NAMES_SUFFIX, content, complete)
+            for line in content[:complete].splitlines():
+                self._add_name(json.loads(line.decode("utf-8")))
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as history_file:
+            content = history_file.read()
+        complete = len(content) - len(content) % ROW.size
+        _truncate(path, content, complete)
+        for offset in range(0, complete, ROW.size):
+            self._append(*ROW.unpack_from(content, offset))
+
+    def _add_name(self, name):
+        index = self._name_indexes.get(name)
+        if index is None:
+            index = self._name_indexes[name] = len(self._names)
+            self._names.append(name)
+            return index, True
+        return index, False
+
+    def _append(self, key, timestamp, price, currency):
+        self._rows_by_key.setdefault(key, []).append(len(self._keys))
+        self._keys.append(key)
+        self._timestamps.append(timestamp)
+        self._prices.append(price)
+        self._currencies.append(currency)
+
+    def _write_name(self, name):
+        if self._names_file is not None:
+            self._names_file.write(json.dumps(name).encode("utf-8") + b"\n")
+            self._names_file.flush()
+
+    def record(self, offer_id, price, currency=DEFAULT_CURRENCY, timestamp=None):
+        """
+        Records the price of an offer, if it differs from the last recorded one.
+
+        :param offer_id: the offer ID or any other string identifying the offer
+        :param price: the price as a number, None if the offer was removed
+        :param currency: the currency, for example 'PLN'
+        :param timestamp: unix timestamp of the observation, now if None
+        :rtype: bool
+        :return: True if a change was recorded
+        """
+        price = REMOVED if price is None else float(price)
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        with self._lock:
+            key, new_key = self._add_name(offer_id)
+            if new_key:
+                self._write_name(offer_id)
+            currency_index, new_currency = self._add_name(currency)
+            if new_currency:
+                self._write_name(currency)
+            rows = self._rows_by_key.get(key)
+            if rows:
+                last_price, last_currency = self._prices[rows[-1]], self._currencies[rows[-1]]
+                if (last_price == price or _is_removed(last_price) and _is_removed(price)) and \
+                        last_currency == currency_index:
+                    return False
+            elif _is_removed(price):
+                return False
+            self._append(key, timestamp, price, currency_index)
+            if self._file is not None:
+                self._file.write(ROW.pack(key, timestamp, price, currency_index))
+                self._file.flush()
+            return True
+
+    def record_offer(self, offer, timestamp=None):
+        """
+        :param offer: an offer dictionary, from :meth:`scrape.category.get_category` or
+                      :meth:`scrape.offer.get_offer_information`
+        :param timestamp: see :meth:`scrape.history.PriceHistory.record`
+        :rtype: bool
+        :return: True if a change was recorded
+        """
+        return self.record(get_offer_key(offer), offer.get('price'), offer.get('currency') or DEFAULT_CURRENCY,
+                           timestamp)
+
+    def record_removed(self, offer_id, timestamp=None):
+        """
+        Records that an offer is not listed any more, for example after :meth:`scrape.offer.check_offers_alive`.
+
+        :rtype: bool
+        :return: True if a change was recorded
+        """
+        return self.record(offer_id, None, timestamp=timestamp)
+
+    def get_history(self, offer_id):
+        """
+        :param offer_id: see :meth:`scrape.history.PriceHistory.record`
+        :rtype: list(tuple(int, float, string))
+        :return: the timestamps, prices and currencies of the changes, the price is None once the offer was removed
+        """
+        with self._lock:
+            rows = self._rows_by_key.get(self._name_indexes.get(offer_id), [])
+            return [self._get_change(row)[1:] for row in rows]
+
+    def get_price(self, offer_id, timestamp=None):
+        """
+        :param offer_id: see :meth:`scrape.history.PriceHistory.record`
+        :param timestamp: unix timestamp, now if None
+        :rtype: tuple(float, string)
+        :return: the price and currency at the given time, None if the offer was not listed then
+        """
+        history = [change for change in self.get_history(offer_id) if timestamp is None or change[0] <= timestamp]
+        if not history or history[-1][1] is None:
+            return None
+        return history[-1][1:]
+
+    def _get_change(self, row):
+        price = self._prices[row]
+        return (self._names[self._keys[row]], int(self._timestamps[row]), None if _is_removed(price) else price,
+                self._names[self._currencies[row]])
+
+    def _get_rows_between(self, start, end):
+        numpy = get_numpy()
+        if numpy is not None:
+            timestamps = numpy.frombuffer(self._timestamps, dtype=numpy.float64) if self._timestamps else \
+                numpy.zeros(0, dtype=numpy.float64)
+            mask = numpy.ones(len(timestamps), dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps < end
+            return numpy.nonzero(mask)[0].tolist()
+        return [row for row, timestamp in enumerate(self._timestamps)
+                if (start is None or timestamp >= start) and (end is None or timestamp < end)]
+
+    def get_changes(self, start=None, end=None):
+        """
+        :param start: unix timestamp, the first included second
+        :param end: unix timestamp, the first excluded second
+        :rtype: list(tuple(string, int, float, string))
+        :return: the offer IDs, timestamps, prices and currencies of the changes in the range, in the recorded order
+        """
+        with self._lock:
+            return [self._get_change(row) for row in self._get_rows_between(start, end)]
+
+    def aggregate(self, get_offer, start=None, end=None, period=WEEK, group_by="district", per_square_meter=True,
+                  currency=DEFAULT_CURRENCY, statistic="median"):
+        """
+        Aggregates the prices of the listed offers in every period, for example the median price per square meter
+        per district per week. An offer counts in a period with the last price it had in that period, from the
+        period its first price was recorded in until the period it was removed in.
+
+        :param get_offer: a callable returning the offer dictionary for an offer ID, or None, for example the get
+                          method of a :class:`scrape.store.OfferStore`
+        :param start: unix timestamp, by default the first change
+        :param end: unix timestamp, by default the last change
+        :param period: the length of the periods in seconds
+        :param group_by: the :meth:`scrape.store.get_indexed_values` field the offers are grouped by, for example
+                         'district', 'city' or 'rooms'
+        :param per_square_meter: whether prices are divided by the surface, offers without a surface are skipped then
+        :param currency: only prices in this currency are aggregated
+        :param statistic: one of :data:`STATISTICS`, computed for all the groups and periods at once with numpy if it
+                          is installed, or a callable aggregating a list of prices
+        :rtype: dict(tuple(object, int), float)
+        :return: the statistic for every group and period start
+        :raises ValueError: if statistic is neither callable nor one of :data:`STATISTICS`
+        """
+        if not callable(statistic) and statistic not in STATISTICS:
+            raise ValueError("Unknown statistic {0}, use one of {1} or a callable".format(
+                statistic, ", ".join(sorted(STATISTICS))))
+        with self._lock:
+            if not self._keys:
+                return {}
+            rows_by_key = dict(self._rows_by_key)
+            start = min(self._timestamps) if start is None else start
+            end = max(self._timestamps) if end is None else end
+            currency_index = self._name_indexes.get(currency)
+            changes = {key: [(self._timestamps[row], self._prices[row], self._currencies[row]) for row in rows]
+                       for key, rows in rows_by_key.items()}
+        first_period, last_period = get_period_start(start, period), get_period_start(end, period)
+        # the group, the first and the last period and the price of every listed span of an offer
+        spans = []
+        for key, key_changes in changes.items():
+            offer = get_offer(self._names[key])
+            if offer is None:
+                continue
+            offer_values, _ = get_indexed_values(offer)
+            surface = offer_values['surface']
+            if per_square_meter and not surface:
+                continue
+            group = offer_values.get(group_by)
+            # the price in effect at the end of every period, from the period of each change to the next change
+            for index, (timestamp, price, price_currency) in enumerate(key_changes):
+                if _is_removed(price) or price_currency != currency_index:
+                    continue
+                change_period = get_period_start(timestamp, period)
+                if index + 1 == len(key_changes):
+                    until_period = last_period
+                elif _is_removed(key_changes[index + 1][1]):
+                    # still listed in the period it was removed in
+                    until_period = get_period_start(key_changes[index + 1][0], period)
+                else:
+                    # the following price is the last one in its period, unless it is overridden too
+                    until_period = get_period_start(key_changes[index + 1][0], period) - period
+                change_period, until_period = max(change_period, first_period), min(until_period, last_period)
+                if change_period <= until_period:
+                    spans.append((group, change_period, until_period, price / surface if per_square_meter else price))
+        if not callable(statistic):
+            numpy = get_numpy()
+            if numpy is not None:
+                return _aggregate_spans(numpy, spans, period, statistic)
+            statistic = STATISTICS[statistic]
+        values = {}
+        for group, change_period, until_period, value in spans:
+            for period_start in range(change_period, until_period + 1, period):
+                values.setdefault((group, period_start), []).append(value)
+        return {group_period: statistic(group_values) for group_period, group_values in values.items()}
+
+    def close(self):
+        for opened_file in (self._file, self._names_file):
+            if opened_file is not None:
+                opened_file.close()
+        self._file = self._names_file = None
+
+
+def _aggregate_spans(numpy, spans, period, statistic):
+    """
+    Computes a statistic of :data:`STATISTICS` for every group and period the spans cover, without a Python loop over
+    the periods.
+    """
+    if not spans:
+        return {}
+    groups, group_ids = [], {}
+    for group, _, _, _ in spans:
+        if group not in group_ids:
+            group_ids[group] = len(groups)
+            groups.append(group)
+    span_groups = numpy.array([group_ids[group] for group, _, _, _ in spans], dtype=numpy.int64)
+    firsts = numpy.array([first for _, first, _, _ in spans], dtype=numpy.int64)
+    lasts = numpy.array([last for _, _, last, _ in spans], dtype=numpy.int64)
+    span_values = numpy.array([value for _, _, _, value in spans], dtype=numpy.float64)
+    # every span is repeated for each of its periods
+    counts = (lasts - firsts) // period + 1
+    rows = numpy.repeat(numpy.arange(len(spans)), counts)
+    offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    row_groups, row_periods, row_values = span_groups[rows], firsts[rows] + offsets * period, span_values[rows]
+    # sorted by group, period and value, so the values of every group and period are consecutive and sorted
+    order = numpy.lexsort((row_values, row_periods, row_groups))
+    row_groups, row_periods, row_values = row_groups[order], row_periods[order], row_values[order]
+    changed = (row_groups[1:] != row_groups[:-1]) | (row_periods[1:] != row_periods[:-1])
+    starts = numpy.concatenate(([0], numpy.nonzero(changed)[0] + 1))
+    sizes = numpy.diff(numpy.append(starts, len(row_values)))
+    if statistic == 'count':
+        results = sizes
+    elif statistic == 'min':
+        results = numpy.minimum.reduceat(row_values, starts)
+    elif statistic == 'max':
+        results = numpy.maximum.reduceat(row_values, starts)
+    elif statistic == 'mean':
+        results = numpy.add.reduceat(row_values, starts) / sizes
+    else:
+        results = (row_values[starts + (sizes - 1) // 2] + row_values[starts + sizes // 2]) / 2.0
+    cast = int if statistic == 'count' else float
+    return {(groups[group], int(period_start)): cast(result)
+            for group, period_start, result in zip(row_groups[starts], row_periods[starts], results)}
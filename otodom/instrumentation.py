@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+log = logging.getLogger(__file__)
+
+_hooks = ()
+
+
+def register_hook(hook):
+    """
+    Registers a function called with a dict describing every finished fetch or parse stage.
+
+    The dict always contains 'stage' (for example 'http.fetch' or 'offer.dom'), 'duration' in seconds and 'error'
+    (the raised exception or None). Depending on the stage it also contains 'url', 'bytes', 'status' and
+    'elapsed' (seconds until the response headers arrived, covering DNS, connect and server time).
+
+    :param hook: a callable taking a single dict
+    """
+    global _hooks
+    # the tuple is replaced instead of mutated, so spans running in other threads never see a partial update
+    _hooks = _hooks + (hook,)
+
+
+def unregister_hook(hook):
+    """
+    :param hook: a callable previously passed to :meth:`scrape.instrumentation.register_hook`
+    """
+    global _hooks
+    _hooks = tuple(registered for registered in _hooks if registered != hook)
+
+
+class Span(object):
+    """A context manager timing a single stage and reporting it to the registered hooks."""
+
+    def __init__(self, stage, hooks, info):
+        self.hooks = hooks
+        self.info = info
+        self.info['stage'] = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.info['duration'] = time.time() - self.start
+        self.info['error'] = exc_value
+        for hook in self.hooks:
+            try:
+                hook(self.info)
+            except Exception:
+                log.exception("Instrumentation hook {0} failed".format(hook))
+
+    def set(self, **info):
+        """Adds information about the stage, for example the response status or size."""
+        self.info.update(info)
+
+
+class NullSpan(object):
+    """A span used when no hooks are registered, it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, **info):
+    """
+    Times the stage in a with block and reports it to the registered hooks. Costs a single check when there are none.
+
+    :param stage: name of the stage, for example 'http.fetch'
+    :param info: information about the stage known upfront, for example the url
+    :rtype: :class:`scrape.instrumentation.Span`
+    """
+    hooks = _hooks
+    if not hooks:
+        return NULL_SPAN
+    return Span(stage, hooks, info)
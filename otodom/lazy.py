@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Helpers deferring the import of heavy dependencies until they are first used, so that ``import otodom`` stays cheap
+for short-lived processes.
+"""
+
+import functools
+import importlib
+import os
+import threading
+
+# the number of locks the keys of a cached function are spread over
+CACHING_LOCKS = 64
+
+
+class LazyModule(object):
+    """A module proxy importing the module on first attribute access."""
+
+    def __init__(self, name):
+        """
+        :param name: the full module name, for example 'scrapper_helpers.utils'
+        """
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        module = object.__getattribute__(self, '_module')
+        if module is None:
+            module = importlib.import_module(object.__getattribute__(self, '_name'))
+            object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __delattr__(self, attribute):
+        delattr(self._load(), attribute)
+
+    def __repr__(self):
+        return "<lazy module '{0}'>".format(object.__getattribute__(self, '_name'))
+
+
+metrics = LazyModule('otodom.metrics')
+
+
+def BeautifulSoup(*args, **kwargs):
+    """Builds a bs4.BeautifulSoup object, importing bs4 on first use."""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(*args, **kwargs)
+
+
+def caching(func):
+    """
+    The same as decorating with scrapper_helpers.utils.caching(key_func=key_sha1), but scrapper_helpers is imported on
+    the first call of the decorated function instead of when it is defined. The hits and misses are counted by
+    :data:`otodom.metrics.CACHE_HITS` and :data:`otodom.metrics.CACHE_MISSES`, labeled with the function name.
+
+    scrapper_helpers writes its cache files without any locking, so when the cache is enabled, calls with the same
+    arguments are serialized. Calls with different arguments run concurrently, unless their keys share one of the
+    CACHING_LOCKS locks.
+    """
+    decorated = []
+    locks = [threading.Lock() for _ in range(CACHING_LOCKS)]
+    lock = threading.Lock()
+
+    def get_decorated():
+        with lock:
+            if not decorated:
+                from scrapper_helpers.utils import CACHE_DIR, Cache, caching, key_sha1
+                # scrapper_helpers only caches when its DEBUG setting is on, otherwise it returns the function
+                enabled = caching(key_func=key_sha1)(func) is not func
+                if enabled and not os.path.isdir(CACHE_DIR):
+                    try:
+                        os.makedirs(CACHE_DIR)
+                    except OSError:
+                        # created by another process in the meantime
+                        pass
+                decorated.append((enabled, key_sha1, Cache))
+            return decorated[0]
+
+    @functools.wraps(func)
+    def lazily_decorated(*args, **kwargs):
+        enabled, key_func, cache = decorated[0] if decorated else get_decorated()
+        if not enabled:
+            return func(*args, **kwargs)
+        key = key_func(args, kwargs)
+        with locks[hash(key) % CACHING_LOCKS]:
+            # the same lookup as scrapper_helpers does, an empty cached value counts as a miss
+            response = cache.get(key)
+            if response:
+                metrics.CACHE_HITS.inc(cache=func.__name__)
+                return response
+            metrics.CACHE_MISSES.inc(cache=func.__name__)
+            response = func(*args, **kwargs)
+            cache.set(key, response)
+            return response
+
+    return lazily_decorated
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import os
+import sys
+import threading
+
+from otodom.instrumentation import register_hook, unregister_hook
+
+if sys.version_info < (3, 0):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__file__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(
+        name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """A base class for metrics, keeping one value per combination of label values."""
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: the metric name, for example 'otodom_requests_total'
+        :param documentation: the help text
+        :param labelnames: names of the labels, their values are passed as keyword arguments when updating the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """
+        :rtype: list(tuple(string, string, float))
+        :return: sample names with formatted labels and values
+        """
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def get(self, **labels):
+        """
+        :return: the current value for the given labels
+        """
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def exposition(self):
+        """
+        :rtype: string
+        :return: the metric in the Prometheus text format
+        """
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.documentation),
+            "# TYPE {0} {1}".format(self.name, self.type_name),
+        ]
+        lines.extend("{0}{1} {2}".format(name, labels, _format_value(value)) for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A metric that only goes up, for example the number of requests."""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A metric that can go up and down, for example a queue depth."""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """A metric counting observations in buckets, for example parse durations."""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the buckets, +Inf is added automatically
+        """
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            values = self._values[key]
+            values['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            values['sum'] += value
+            values['count'] += 1
+
+    def get(self, **labels):
+        """
+        :rtype: dict
+        :return: the non-cumulative bucket counts, sum and count of the observations for the given labels
+        """
+        with self._lock:
+            values = self._values.get(self._key(labels))
+            return dict(values, buckets=list(values['buckets'])) if values else None
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, values['buckets']):
+                    cumulative += count
+                    samples.append((self.name + "_bucket",
+                                    _format_labels(self.labelnames, key, [("le", _format_value(bound))]), cumulative))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((self.name + "_sum", labels, values['sum']))
+                samples.append((self.name + "_count", labels, values['count']))
+        return samples
+
+
+class Registry(object):
+    """A collection of metrics exported together."""
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        :param metric: a :class:`scrape.metrics.Metric`
+        :return: the metric
+        """
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def exposition(self):
+        """
+        :rtype: string
+        :return: all the metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self.metrics)
+        return "".join(metric.exposition() + "\n" for metric in metrics)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("otodom_requests_total", "Number of requests made.", ["stage"])
+REQUEST_ERRORS = REGISTRY.counter(
+    "otodom_request_errors_total", "Number of requests that failed or returned an error status.", ["stage"])
+DOWNLOADED_BYTES = REGISTRY.counter("otodom_downloaded_bytes_total", "Number of bytes downloaded.", ["stage"])
+PARSED_BYTES = REGISTRY.counter("otodom_parsed_bytes_total", "Number of bytes parsed.", ["stage"])
+PARSE_ERRORS = REGISTRY.counter("otodom_parse_errors_total", "Number of failed parses.", ["stage"])
+STAGE_DURATION = REGISTRY.histogram(
+    "otodom_stage_duration_seconds", "Duration of fetch and parse stages in seconds.", ["stage"])
+CACHE_HITS = REGISTRY.counter("otodom_cache_hits_total", "Number of cache hits.", ["cache"])
+CACHE_MISSES = REGISTRY.counter("otodom_cache_misses_total", "Number of cache misses.", ["cache"])
+QUEUE_DEPTH = REGISTRY.gauge("otodom_queue_depth", "Number of items waiting in a queue.", ["queue"])
+
+
+def record_span(event):
+    """
+    An instrumentation hook updating the metrics of :data:`REGISTRY`, see
+    :meth:`scrape.instrumentation.register_hook`.
+
+    :param event: dict describing a finished stage
+    """
+    stage = event['stage']
+    STAGE_DURATION.observe(event['duration'], stage=stage)
+    failed = event['error'] is not None
+    if stage.startswith("http."):
+        REQUESTS.inc(stage=stage)
+        DOWNLOADED_BYTES.inc(event.get('bytes', 0), stage=stage)
+        if failed or event.get('status', 0) >= 400:
+            REQUEST_ERRORS.inc(stage=stage)
+    else:
+        PARSED_BYTES.inc(event.get('bytes', 0), stage=stage)
+        if failed:
+            PARSE_ERRORS.inc(stage=stage)
+
+
+def install():
+    """Starts feeding the metrics of :data:`REGISTRY` from the fetch and parse stages."""
+    uninstall()
+    register_hook(record_span)
+
+
+def uninstall():
+    """Stops feeding the metrics of :data:`REGISTRY`."""
+    unregister_hook(record_span)
+
+
+def write_to_file(path, registry=REGISTRY):
+    """
+    Writes the metrics in the Prometheus text format, for example for the node exporter textfile collector.
+    The file is replaced atomically.
+
+    :param path: path to the output file
+    :param registry: a :class:`scrape.metrics.Registry`
+    """
+    temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w") as metrics_file:
+        metrics_file.write(registry.exposition())
+    os.rename(temporary_path, path)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Serves the metrics in the Prometheus text format from a background thread.
+
+    :param port: port to listen on, 0 picks a free one
+    :param host: interface to listen on
+    :param registry: a :class:`scrape.metrics.Registry`
+    :return: the running HTTPServer, call its shutdown method to stop it
+    """
+    server = HTTPServer((host, port), MetricsRequestHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
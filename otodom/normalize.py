@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import re
+
+from otodom.lazy import LazyModule
+from otodom.utils import LRUCache, get_number_from_string
+
+dt = LazyModule('datetime')
+
+log = logging.getLogger(__file__)
+
+MEMO_SIZE = 1024
+
+BLANK_LINE_PATTERN = re.compile(r'^\s*$')
+TOTAL_FLOORS_PATTERN = re.compile(r"\w+\s(?P<total>\d+)")
+NINJA_PV_PATTERN = re.compile(r".*window\.ninjaPV\s=\s(?P<json_info>{.*?})")
+
+DETAIL_SEPARATOR = ": "
+
+MONTHS = {
+    'sty': 1,
+    'lut': 2,
+    'mar': 3,
+    'kwi': 4,
+    'maj': 5,
+    'cze': 6,
+    'lip': 7,
+    'sie': 8,
+    'wrz': 9,
+    'paź': 10,
+    'lis': 11,
+    'gru': 12,
+}
+
+_missing = object()
+
+
+def memoized(maxsize=MEMO_SIZE):
+    """
+    A decorator remembering the results of a function of hashable arguments in a :class:`scrape.utils.LRUCache`,
+    which is available as the memo attribute of the decorated function. The results are shared, so they should be
+    immutable. A lookup costs about as much as a few string operations, so it only pays off for functions doing
+    more than that, like the date parsers.
+
+    :param maxsize: the maximal number of remembered results
+    """
+    def decorator(func):
+        memo = LRUCache(maxsize)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            result = memo.get(key, _missing)
+            if result is _missing:
+                result = func(*args, **kwargs)
+                memo.set(key, result)
+            return result
+        wrapper.memo = memo
+        return wrapper
+    return decorator
+
+
+def is_blank(line):
+    """
+    :param line: string
+    :rtype: bool
+    :return: True if the line contains only whitespace
+    """
+    return BLANK_LINE_PATTERN.match(line) is not None
+
+
+def split_detail(line):
+    """
+    :param line: a detail line, for example 'kaucja: 800 zł'
+    :rtype: tuple(string, string)
+    :return: the detail name and value, not stripped, the value ends at the next separator
+    :raises IndexError: if the line has no value
+    """
+    parts = line.split(DETAIL_SEPARATOR)
+    return parts[0], parts[1]
+
+
+def get_month_number(value):
+    """
+    :param value: a polish month name, in any grammatical case
+    :rtype: int
+    :return: the month number, None if the name is not known
+    """
+    return MONTHS.get(value.lower()[:3])
+
+
+def _timestamp(year, month, day):
+    return int((dt.datetime(year=year, month=month, day=day) - dt.datetime(1970, 1, 1)).total_seconds())
+
+
+@memoized()
+def parse_date(date):
+    """
+    :param date: a date like '15.11.2016'
+    :rtype: int
+    :return: the unix timestamp of the date's midnight
+    """
+    date_parts = date.split('.')
+    return _timestamp(int(date_parts[2]), int(date_parts[1]), int(date_parts[0]))
+
+
+@memoized()
+def parse_month_date(date):
+    """
+    :param date: a date with a polish month name, like '1 lipca 2017'
+    :rtype: int
+    :return: the unix timestamp of the date's midnight
+    """
+    date_parts = date.split(' ')
+    return _timestamp(int(date_parts[2]), get_month_number(date_parts[1]), int(date_parts[0]))
+
+
+def parse_number(value, number_type, default=None):
+    """
+    :param value: a number as string, a comma can be used as the decimal separator
+    :param number_type: float or int
+    :param default: returned when the value is not a number
+    :return: the number
+    """
+    return get_number_from_string(value, number_type, default)
+
+
+def parse_float(value, default=None):
+    return get_number_from_string(value, float, default)
+
+
+def parse_int(value, default=None):
+    return get_number_from_string(value, int, default)
+
+
+def parse_total_floors(floor_data, default=''):
+    """
+    :param floor_data: the floor description, for example '(z 4)'
+    :rtype: string
+    :return: the number of floors in the building
+    """
+    match = TOTAL_FLOORS_PATTERN.search(floor_data)
+    return match.group("total") if match else default
+
+
+def get_memo_stats():
+    """
+    :rtype: dict
+    :return: the stats of every memoized function, see :meth:`scrape.utils.LRUCache.stats`
+    """
+    return {func.__name__: func.memo.stats() for func in (parse_date, parse_month_date)}
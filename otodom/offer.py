@@ -1,21 +1,51 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import datetime as dt
-import json
 import logging
 import re
 
-import requests
-from bs4 import BeautifulSoup
-from scrapper_helpers.utils import caching, key_sha1, replace_all, _int, _float, get_random_user_agent
-
-from otodom.utils import get_cookie_from, get_csrf_token, get_response_for_url
+from otodom import API_URL, BASE_URL
+from otodom.instrumentation import span
+from otodom.lazy import BeautifulSoup, LazyModule, caching
+from otodom.normalize import (
+    NINJA_PV_PATTERN, get_month_number, is_blank, parse_date, parse_float, parse_int, parse_month_date,
+    parse_total_floors, split_detail
+)
+from otodom.utils import (
+    LRUCache, get_cookie_from, get_csrf_token, get_response_for_url, get_status_for_url, map_concurrently,
+    wait_for_rate_limit
+)
+
+copy = LazyModule('copy')
+dt = LazyModule('datetime')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+metrics = LazyModule('otodom.metrics')
+requests = LazyModule('requests')
+helpers = LazyModule('scrapper_helpers.utils')
 
 log = logging.getLogger(__file__)
 
+PARSE_MEMO_SIZE = 256
+
+UNCHANGED = "unchanged"
+CHANGED = "changed"
+
+FINGERPRINT_NINJA_PV_PATTERN = re.compile(br"window\.ninjaPV\s=\s(?P<json_info>{.*?})")
+FINGERPRINT_DESCRIPTION_PATTERN = re.compile(br'itemprop="description">(?P<description>.*?)</div>', re.DOTALL)
+FINGERPRINT_GALLERY_PATTERN = re.compile(br'<a href="(?P<href>[^"]*)"[^>]*class="gallery-box-thumb-item"')
+# ninjaPV keys describing the visit instead of the offer
+VOLATILE_NINJA_PV_KEYS = ["ad_impressions", "ad_position", "user_status"]
+
+OFFER_ID_URL = BASE_URL + "/oferta/ID{0}.html"
+OFFER_ID_PATTERN = re.compile(r"/oferta/(?:[^/?#]*-)?ID(?P<offer_id>\w+)\.html")
+# statuses meaning the offer is gone, other errors leave its state unknown
+GONE_STATUSES = (404, 410)
+
+_parse_memo = LRUCache(PARSE_MEMO_SIZE)
 
-@caching(key_func=key_sha1)
+
+@caching
 def get_offer_phone_numbers(offer_id, cookie, csrf_token):
     """
     This method makes a request to the OtoDom API asking for the poster's phone number(s) and returns it.
@@ -27,18 +57,21 @@ def get_offer_phone_numbers(offer_id, cookie, csrf_token):
     :rtype: list(string)
     :return: A list of phone numbers as strings (no spaces, no '+48')
     """
-    url = "https://www.otodom.pl/ajax/misc/contact/phone/{0}/".format(offer_id)
+    url = "{0}/ajax/misc/contact/phone/{1}/".format(API_URL, offer_id)
     payload = "CSRFToken={0}".format(csrf_token)
     headers = {
         'cookie': "{0}".format(cookie),
         'content-type': "application/x-www-form-urlencoded",
-        'User-Agent': get_random_user_agent()
+        'User-Agent': helpers.get_random_user_agent()
     }
 
-    response = requests.request("POST", url, data=payload, headers=headers)
-    if response.status_code == 404:
-        return []
-    return json.loads(response.text)["value"]
+    wait_for_rate_limit()
+    with span('http.phone', url=url) as current:
+        response = requests.request("POST", url, data=payload, headers=headers)
+        current.set(status=response.status_code, bytes=len(response.content), elapsed=response.elapsed.total_seconds())
+        if response.status_code == 404:
+            return []
+        return json.loads(response.text)["value"]
 
 
 def get_offer_facebook_description(html_parser):
@@ -61,9 +94,10 @@ def get_offer_ninja_pv(html_content):
     :rtype: dict
     :return: ninjaPV data
     """
-    found = re.search(r".*window\.ninjaPV\s=\s(?P<json_info>{.*?})", html_content.decode('unicode-escape'))
-    ninja_pv = found.groupdict().get('json_info')
-    return json.loads(ninja_pv)
+    with span('offer.ninja_pv', bytes=len(html_content)):
+        found = NINJA_PV_PATTERN.search(html_content.decode('unicode-escape'))
+        ninja_pv = found.groupdict().get('json_info')
+        return json.loads(ninja_pv)
 
 
 def get_offer_floor(html_parser):
@@ -96,11 +130,7 @@ def get_offer_total_floors(html_parser, default_value=''):
     else:
         return default_value
     # extracting information about floor
-    match = re.search(r"\w+\s(?P<total>\d+)", floor_data)
-    total_floors = default_value
-    if match:
-        total_floors = match.groupdict().get("total")
-    return total_floors
+    return parse_total_floors(floor_data, default_value)
 
 
 def get_month_num_for_string(value):
@@ -112,21 +142,7 @@ def get_month_num_for_string(value):
     :return: Month number
     :rtype: int
     """
-    value = value.lower()[:3]
-    return {
-        'sty': 1,
-        'lut': 2,
-        'mar': 3,
-        'kwi': 4,
-        'maj': 5,
-        'cze': 6,
-        'lip': 7,
-        'sie': 8,
-        'wrz': 9,
-        'paź': 10,
-        'lis': 11,
-        'gru': 12,
-    }.get(value)
+    return get_month_number(value)
 
 
 def parse_available_from(date):
@@ -138,12 +154,7 @@ def parse_available_from(date):
     :return: Unix timestamp
     :rtype: int
     """
-    date_parts = date.split(' ')
-    month = get_month_num_for_string(date_parts[1].lower())
-    year = int(date_parts[2])
-    day = int(date_parts[0])
-    date_added = dt.datetime(year=year, day=day, month=month)
-    return int((date_added - dt.datetime(1970, 1, 1)).total_seconds())
+    return parse_month_date(date)
 
 
 def get_offer_apartment_details(html_parser):
@@ -158,12 +169,14 @@ def get_offer_apartment_details(html_parser):
     apartment_details = ''
     if found:
         apartment_details = found.text
-    details = [{d.split(": ")[0]: d.split(": ")[1]}
-               for d in str(apartment_details).split("\n") if d]
-    for i, detail in enumerate(details):
-        available_from = detail.get('Dostępne od')
-        if available_from:
-            details[i] = {list(detail.keys())[0]: parse_available_from(available_from)}
+    details = []
+    for line in str(apartment_details).split("\n"):
+        if not line:
+            continue
+        name, value = split_detail(line)
+        if name == 'Dostępne od' and value:
+            value = parse_available_from(value)
+        details.append({name: value})
     return details
 
 
@@ -268,8 +281,8 @@ def get_offer_geographical_coordinates(html_parser):
     :return: A tuple containing the latitude and longitude of the apartment
     """
     try:
-        latitude = _float(html_parser.find(itemprop="latitude").attrs["content"])
-        longitude = _float(html_parser.find(itemprop="longitude").attrs["content"])
+        latitude = parse_float(html_parser.find(itemprop="latitude").attrs["content"])
+        longitude = parse_float(html_parser.find(itemprop="longitude").attrs["content"])
     except AttributeError:
         latitude, longitude = None, None
     return latitude, longitude
@@ -286,12 +299,7 @@ def parse_date_to_timestamp(date):
     """
     if 'ponad' in date:
         date = (dt.datetime.now() - dt.timedelta(days=15)).date().strftime("%d.%m.%Y")
-    date_parts = date.split('.')
-    month = int(date_parts[1])
-    year = int(date_parts[2])
-    day = int(date_parts[0])
-    date_added = dt.datetime(year=year, day=day, month=month)
-    return int((date_added - dt.datetime(1970, 1, 1)).total_seconds())
+    return parse_date(date)
 
 
 def get_offer_details(html_parser):
@@ -302,16 +310,22 @@ def get_offer_details(html_parser):
     :rtype: list(dict)
     :return: A list of dictionaries containing information about the offer
     """
-    # [{d.split(': ')[0].strip(): d.split(': ')[1].strip()} for d in f.split("\n") if not re.match(r'^\s*$', d)]
     try:
         f = html_parser.find(class_="text-details").text
-        temp = [d for d in f.split("\n") if not re.match(r'^\s*$', d)]
-        output = [{d.split(': ')[0].strip(): d.split(': ')[1].strip()} for d in temp if "Data" not in d]
-        output.extend([{d.split(': ')[0].strip(): parse_date_to_timestamp(d.split(': ')[1].strip())} for d in temp
-                       if "Data" in d])
-        return output
     except AttributeError:
         return {}
+    output, dates = [], []
+    for line in f.split("\n"):
+        if is_blank(line):
+            continue
+        name, value = split_detail(line)
+        # dates are listed after all the other details
+        if "Data" in line:
+            dates.append({name.strip(): parse_date_to_timestamp(value.strip())})
+        else:
+            output.append({name.strip(): value.strip()})
+    output.extend(dates)
+    return output
 
 
 def get_offer_title(html_parser):
@@ -372,28 +386,216 @@ def get_flat_data(html_parser, ninja_pv):
         '3D_walkaround_link': get_offer_3d_walkaround_link(html_parser),
         'apartment_details': apartment_details,
         'additional_assets': build_offer_additonal_assets(get_offer_additional_assets(html_parser), apartment_details),
-        'surface': _float(ninja_pv.get("surface", '')),
-        'rooms': _int(ninja_pv.get("rooms", '')),
-        'floor': _int(get_offer_floor(html_parser)),
-        'total_floors': _int(get_offer_total_floors(html_parser)),
+        'surface': parse_float(ninja_pv.get("surface", '')),
+        'rooms': parse_int(ninja_pv.get("rooms", '')),
+        'floor': parse_int(get_offer_floor(html_parser)),
+        'total_floors': parse_int(get_offer_total_floors(html_parser)),
+    }
+
+
+def get_offer_fields(html_parser, ninja_pv):
+    result = {
+        'title': get_offer_title(html_parser),
+        'address': get_offer_address(html_parser),
+        'poster_name': get_offer_poster_name(html_parser),
+        'poster_type': ninja_pv.get("poster_type"),
+        'price': ninja_pv.get("ad_price"),
+        'currency': ninja_pv.get("price_currency"),
+        'city': ninja_pv.get("city_name"),
+        'district': ninja_pv.get("district_name", ""),
+        'voivodeship': ninja_pv.get("region_name"),
+        'geographical_coordinates': get_offer_geographical_coordinates(html_parser),
+        'phone_numbers': "",
+        'description': get_offer_description(html_parser),
+        'offer_details': get_offer_details(html_parser),
+        'photo_links': get_offer_photos_links(html_parser),
+        'video_link': get_offer_video_link(html_parser),
+        'facebook_description': get_offer_facebook_description(html_parser),
+        'meta': {
+            'cookie': "",
+            'csrf_token': "",
+            'context': {}
+        }
+    }
+
+    flat_data = get_flat_data(html_parser, ninja_pv)
+    if any(flat_data.values()):
+        result.update(flat_data)
+    return result
+
+
+def set_parse_memo_size(maxsize):
+    """
+    Sets how many parsed offers are remembered by :meth:`scrape.offer.parse_offer_markup`, 0 disables remembering.
+
+    :param maxsize: the maximal number of remembered offers
+    """
+    global _parse_memo
+    _parse_memo = LRUCache(maxsize)
+
+
+def get_parse_memo_stats():
+    """
+    :rtype: dict
+    :return: the hits, misses, size and hit rate of the parsed offers memo, see :meth:`scrape.utils.LRUCache.stats`
+    """
+    return _parse_memo.stats()
+
+
+def parse_offer_markup(content):
+    """
+    Parse the offer details out of the offer page, without making any requests.
+
+    The results are remembered by a hash of the content, so parsing the same bytes again, for example after a retry
+    or when the offer is found in many searches, only costs hashing and copying the result.
+
+    :param content: a requests.response.content object
+    :returns: A dictionary containing the offer details, see :meth:`scrape.offer.get_offer_information`. Phone numbers
+            and meta values are left empty, as they require additional requests.
+    """
+    if not isinstance(content, bytes):
+        return _parse_offer_markup(content)
+    memo = _parse_memo
+    key = hashlib.sha1(content).digest()
+    result = memo.get(key)
+    if result is None:
+        metrics.CACHE_MISSES.inc(cache="offer_parse")
+        result = _parse_offer_markup(content)
+        memo.set(key, result)
+    else:
+        metrics.CACHE_HITS.inc(cache="offer_parse")
+    # the caller is free to modify the result, so the remembered one is never returned
+    return copy.deepcopy(result)
+
+
+def _parse_offer_markup(content):
+    with span('offer.dom', bytes=len(content)):
+        html_parser = BeautifulSoup(content, "html.parser")
+    ninja_pv = get_offer_ninja_pv(content)
+    with span('offer.extract'):
+        result = get_offer_fields(html_parser, ninja_pv)
+    return result
+
+
+def get_offer_fingerprint(content):
+    """
+    This method returns a fingerprint of the offer, which changes when its price, description or photos change.
+    It is computed straight from the raw page, without building a DOM, so it is a lot cheaper than parsing it.
+
+    :param content: a requests.response.content object
+    :rtype: string
+    :return: a hex digest made of the ninjaPV data, the description and the gallery links
+    """
+    fingerprint = hashlib.sha1()
+    found = FINGERPRINT_NINJA_PV_PATTERN.search(content)
+    if found:
+        ninja_pv = json.loads(found.group('json_info').decode('unicode-escape'))
+        for key in VOLATILE_NINJA_PV_KEYS:
+            ninja_pv.pop(key, None)
+        fingerprint.update(json.dumps(ninja_pv, sort_keys=True).encode("utf-8"))
+    found = FINGERPRINT_DESCRIPTION_PATTERN.search(content)
+    fingerprint.update(b"\0" + (found.group('description') if found else b""))
+    fingerprint.update(b"\0" + b"\n".join(FINGERPRINT_GALLERY_PATTERN.findall(content)))
+    return fingerprint.hexdigest()
+
+
+def get_offer_delta(previous, current):
+    """
+    This method compares two versions of the scraped offer details, ignoring the meta values.
+
+    :param previous: dict, see :meth:`scrape.offer.get_offer_information`
+    :param current: dict, see :meth:`scrape.offer.get_offer_information`
+    :rtype: tuple(dict, list)
+    :return: the fields with new or changed values and the names of the fields that are no longer present
+    """
+    changes = {
+        field: value for field, value in current.items()
+        if field != 'meta' and (field not in previous or previous[field] != value)
     }
+    removed = sorted(field for field in previous if field != 'meta' and field not in current)
+    return changes, removed
+
+
+def apply_offer_delta(previous, update):
+    """
+    This method returns the offer details after applying an update to them.
+
+    :param previous: dict, see :meth:`scrape.offer.get_offer_information`
+    :param update: dict, see :meth:`scrape.offer.get_offer_update`
+    :rtype: dict
+    """
+    if update['status'] == UNCHANGED:
+        return previous
+    current = {field: value for field, value in previous.items() if field not in update['removed']}
+    current.update(update['changes'])
+    current['meta'] = dict(previous.get('meta', {}), fingerprint=update['fingerprint'])
+    return current
+
+
+def get_offer_update(url, previous, context=None, archive=None):
+    """
+    Check a known OtoDom offer for changes. The offer page is fetched, but it is only parsed when its fingerprint
+    differs from the one stored in the previous details.
+
+    :param url: a string containing a link to the offer
+    :param previous: a dictionary returned by :meth:`scrape.offer.get_offer_information` for this offer
+    :param context: the same context as used for the previous details, see :meth:`scrape.offer.get_offer_information`
+    :param archive: an optional :class:`scrape.archive.Archive`, the raw offer page will be stored in it
+
+    :rtype: dict
+    :returns: {'status': UNCHANGED, 'fingerprint': ...} if the offer didn't change, otherwise
+            {'status': CHANGED, 'fingerprint': ..., 'changes': {field: new value}, 'removed': [field]}, see
+            :meth:`scrape.offer.apply_offer_delta`
+    """
+    response = get_response_for_url(url)
+    content = response.content
+    if archive is not None:
+        archive.append(url, content, kind="offer")
+    fingerprint = get_offer_fingerprint(content)
+    if fingerprint == previous.get('meta', {}).get('fingerprint'):
+        return {'status': UNCHANGED, 'fingerprint': fingerprint}
+    changes, removed = get_offer_delta(previous, get_offer_information_from_response(response, context))
+    return {'status': CHANGED, 'fingerprint': fingerprint, 'changes': changes, 'removed': removed}
 
 
-def get_offer_information(url, context=None):
+def get_offer_information(url, context=None, archive=None, duplicates=None):
     """
     Scrape detailed information about an OtoDom offer.
 
     :param url: a string containing a link to the offer
     :param context: a dictionary(string, string) taken straight from the :meth:`scrape.category.get_category`
+    :param archive: an optional :class:`scrape.archive.Archive`, the raw offer page will be stored in it
+    :param duplicates: an optional :class:`scrape.dedup.DuplicateIndex`, see
+                       :meth:`scrape.offer.get_offer_information_from_response`
 
     :returns: A dictionary containing the scraped offer details
     """
     # getting response
     response = get_response_for_url(url)
+    if archive is not None:
+        archive.append(url, response.content, kind="offer")
+    return get_offer_information_from_response(response, context, duplicates)
+
+
+def get_offer_information_from_response(response, context=None, duplicates=None):
+    """
+    Scrape detailed information about an OtoDom offer out of an already fetched offer page.
+
+    :param response: a requests.response object
+    :param context: see :meth:`scrape.offer.get_offer_information`
+    :param duplicates: an optional :class:`scrape.dedup.DuplicateIndex`, the offer is added to it and if it duplicates
+                       an offer scraped before, its phone numbers aren't looked up and meta['duplicate_of'] is set to
+                       the key of the duplicated offer
+
+    :returns: A dictionary containing the scraped offer details
+    """
     content = response.content
-    html_parser = BeautifulSoup(content, "html.parser")
+    result = parse_offer_markup(content)
+    duplicate_of = None
+    if duplicates is not None:
+        duplicate_of = duplicates.add(result, key=(context or {}).get('offer_id') or response.url)
     # getting meta values
-    if context:
+    if context and duplicate_of is None:
         cookie = get_cookie_from(response)
         try:
             csrf_token = get_csrf_token(content)
@@ -410,39 +612,120 @@ def get_offer_information(url, context=None):
             phone_numbers = []
 
         phone_number_replace_dict = {u'\xa0': "", " ": "", "-": "", "+48": ""}
-        phone_numbers = sum([replace_all(num, phone_number_replace_dict).split(".") for num in phone_numbers], [])
+        phone_numbers = sum(
+            [helpers.replace_all(num, phone_number_replace_dict).split(".") for num in phone_numbers], [])
     else:
         cookie = ""
         csrf_token = ""
         phone_numbers = ""
-        context = {}
-
-    ninja_pv = get_offer_ninja_pv(content)
-    result = {
-        'title': get_offer_title(html_parser),
-        'address': get_offer_address(html_parser),
-        'poster_name': get_offer_poster_name(html_parser),
-        'poster_type': ninja_pv.get("poster_type"),
-        'price': ninja_pv.get("ad_price"),
-        'currency': ninja_pv.get("price_currency"),
-        'city': ninja_pv.get("city_name"),
-        'district': ninja_pv.get("district_name", ""),
-        'voivodeship': ninja_pv.get("region_name"),
-        'geographical_coordinates': get_offer_geographical_coordinates(html_parser),
-        'phone_numbers': phone_numbers,
-        'description': get_offer_description(html_parser),
-        'offer_details': get_offer_details(html_parser),
-        'photo_links': get_offer_photos_links(html_parser),
-        'video_link': get_offer_video_link(html_parser),
-        'facebook_description': get_offer_facebook_description(html_parser),
-        'meta': {
-            'cookie': cookie,
-            'csrf_token': csrf_token,
-            'context': context
-        }
+        context = context or {}
+
+    result['phone_numbers'] = phone_numbers
+    result['meta'] = {
+        'cookie': cookie,
+        'csrf_token': csrf_token,
+        'context': context,
+        'fingerprint': get_offer_fingerprint(content) if isinstance(content, bytes) else None
     }
-
-    flat_data = get_flat_data(html_parser, ninja_pv)
-    if any(flat_data.values()):
-        result.update(flat_data)
+    if duplicates is not None:
+        result['meta']['duplicate_of'] = duplicate_of
     return result
+
+
+def get_offers_information(offers, checkpoint=None, batch="default", archive=None, duplicates=None, seen=None):
+    """
+    Scrape detailed information about many OtoDom offers.
+
+    :param offers: list of dictionaries(string, string) taken straight from the :meth:`scrape.category.get_category`
+    :param checkpoint: an optional :class:`scrape.checkpoint.Checkpoint`, completed offers are recorded in it and
+                    aren't fetched again when the batch is repeated
+    :param batch: string identifying the batch of offers in the checkpoint
+    :param archive: an optional :class:`scrape.archive.Archive`, the raw offer pages will be stored in it
+    :param duplicates: an optional :class:`scrape.dedup.DuplicateIndex`, see
+                       :meth:`scrape.offer.get_offer_information_from_response`
+    :param seen: an optional :class:`scrape.bloom.BloomFilter` of offer IDs, the offers in it aren't fetched nor
+                 returned and the fetched offers are added to it, so it can be shared by many sweeps
+
+    :rtype: generator of dict
+    :returns: Dictionaries containing the scraped offer details, see :meth:`scrape.offer.get_offer_information`
+    """
+    completed_offers = checkpoint.get_offers(batch) if checkpoint is not None else {}
+    for context in offers:
+        offer_id = context['offer_id']
+        if offer_id in completed_offers:
+            yield completed_offers[offer_id]
+            continue
+        if seen is not None and offer_id in seen:
+            continue
+        result = get_offer_information(context['detail_url'], context=context, archive=archive, duplicates=duplicates)
+        if checkpoint is not None:
+            checkpoint.save_offer(batch, offer_id, result)
+        if seen is not None:
+            seen.add(offer_id)
+        yield result
+
+
+def get_offer_url(offer):
+    """
+    :param offer: an offer url, an offer dictionary from :meth:`scrape.category.get_category` or an offer ID from
+                  the offer url, for example '3iqMs'
+    :rtype: string
+    :return: the offer url
+    """
+    if isinstance(offer, dict):
+        return offer['detail_url']
+    offer = str(offer)
+    if "/" in offer:
+        return offer
+    return OFFER_ID_URL.format(offer)
+
+
+def get_offer_id_from_url(url):
+    """
+    :param url: an offer url, for example from :meth:`scrape.offer.get_offer_url`
+    :rtype: string
+    :return: the offer ID the url ends with, for example '3iqMs', None if it has none
+    """
+    match = OFFER_ID_PATTERN.search(url)
+    return match.group("offer_id") if match else None
+
+
+def is_offer_alive(status, location=None):
+    """
+    :param status: the HTTP status code of the offer page
+    :param location: the Location header of the offer page
+    :rtype: bool
+    :return: True if the offer is still listed, False if it was removed, None if the status doesn't tell
+    """
+    if status == 200:
+        return True
+    if status in GONE_STATUSES:
+        return False
+    if 300 <= status < 400:
+        # removed offers redirect to the search results, renamed ones to their new offer page
+        return bool(location) and "/oferta/" in location
+    return None
+
+
+def check_offer_alive(offer):
+    """
+    Checks whether an offer is still listed without downloading or parsing its page.
+
+    :param offer: see :meth:`scrape.offer.get_offer_url`
+    :rtype: bool
+    :return: see :meth:`scrape.offer.is_offer_alive`
+    """
+    status, location = get_status_for_url(get_offer_url(offer))
+    return is_offer_alive(status, location)
+
+
+def check_offers_alive(offers, concurrency=8):
+    """
+    Checks whether many offers are still listed, see :meth:`scrape.offer.check_offer_alive`.
+
+    :param offers: list of offer urls, offer dictionaries or offer IDs, see :meth:`scrape.offer.get_offer_url`
+    :param concurrency: number of concurrent requests, the shared rate limit still applies
+    :rtype: list(bool)
+    :return: the liveness of the offers, in the order of offers
+    """
+    return map_concurrently(check_offer_alive, offers, concurrency)
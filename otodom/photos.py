@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+
+from otodom.instrumentation import span
+from otodom.lazy import LazyModule
+from otodom.utils import wait_for_rate_limit
+
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+requests = LazyModule('requests')
+helpers = LazyModule('scrapper_helpers.utils')
+
+log = logging.getLogger(__file__)
+
+INDEX_FILE_NAME = "index.jsonl"
+DEFAULT_CONCURRENCY = 8
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+DEFAULT_EXTENSION = ".jpg"
+
+
+def get_photo_extension(url, content_type=None):
+    """
+    :param url: the photo url
+    :param content_type: the Content-Type header of the photo response
+    :rtype: string
+    :return: the file extension, for example '.jpg'
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in EXTENSIONS:
+        return EXTENSIONS[content_type]
+    extension = os.path.splitext(url.split("?")[0].split("#")[0])[1].lower()
+    return extension if extension in EXTENSIONS.values() or extension == ".jpeg" else DEFAULT_EXTENSION
+
+
+class PhotoStore(object):
+    """
+    A directory of offer photos, stored under the sha256 of their content, so a photo used by many offers is stored
+    once. Downloaded urls are recorded in an index file and never fetched again.
+
+    Photos are downloaded concurrently by a pool of threads kept until the store is closed, every thread keeping a
+    pooled connection per host, through the shared rate limit, see :meth:`scrape.utils.set_rate_limit`.
+    """
+
+    def __init__(self, root, concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param root: the directory the photos are stored in, it is created if it doesn't exist
+        :param concurrency: the number of concurrent downloads
+        """
+        self.root = root
+        self.concurrency = concurrency
+        self._paths = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sessions = []
+        self._pool = None
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        index_path = os.path.join(root, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as index_file:
+                for line in index_file:
+                    if line.endswith(b"\n"):
+                        entry = json.loads(line.decode("utf-8"))
+                        self._paths[entry['url']] = entry['path']
+        self._index_file = open(index_path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def get(self, url):
+        """
+        :param url: a photo url
+        :rtype: string
+        :return: the path of the downloaded photo, None if it wasn't downloaded
+        """
+        path = self._paths.get(url)
+        if path is None:
+            return None
+        path = os.path.join(self.root, path)
+        return path if os.path.exists(path) else None
+
+    def _get_session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers['User-Agent'] = helpers.get_random_user_agent()
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _fetch(self, url):
+        wait_for_rate_limit()
+        with span('http.photo', url=url) as current:
+            response = self._get_session().get(url)
+            current.set(status=response.status_code, bytes=len(response.content),
+                        elapsed=response.elapsed.total_seconds())
+        response.raise_for_status()
+        return response
+
+    def _store(self, url, response):
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        extension = get_photo_extension(url, response.headers.get('Content-Type'))
+        relative_path = os.path.join(digest[:2], digest + extension)
+        path = os.path.join(self.root, relative_path)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # created by another thread in the meantime
+                    pass
+            temporary_path = "{0}.{1}.tmp".format(path, threading.current_thread().ident)
+            with open(temporary_path, "wb") as photo_file:
+                photo_file.write(content)
+            os.rename(temporary_path, path)
+        return relative_path
+
+    def download(self, url):
+        """
+        Downloads a photo, unless it was downloaded before.
+
+        :param url: a photo url, for example from :meth:`scrape.offer.get_offer_photos_links`
+        :rtype: string
+        :return: the path of the photo, None if it couldn't be downloaded
+        """
+        path = self.get(url)
+        if path is not None:
+            return path
+        with self._lock:
+            pending = self._pending.get(url)
+            if pending is None:
+                pending = self._pending[url] = threading.Event()
+                downloading = True
+            else:
+                downloading = False
+        if not downloading:
+            # the same url is downloaded by another thread
+            pending.wait()
+            return self.get(url)
+        try:
+            relative_path = self._store(url, self._fetch(url))
+            with self._lock:
+                self._paths[url] = relative_path
+                self._index_file.write(json.dumps({'url': url, 'path': relative_path}).encode("utf-8") + b"\n")
+                self._index_file.flush()
+            return os.path.join(self.root, relative_path)
+        except (requests.RequestException, IOError, OSError) as error:
+            log.warning("Photo %s couldn't be downloaded: %s", url, error)
+            return None
+        finally:
+            with self._lock:
+                del self._pending[url]
+            pending.set()
+
+    def download_many(self, urls):
+        """
+        :param urls: an iterable of photo urls
+        :rtype: list(string)
+        :return: the paths of the photos, in the order of urls, None for the photos that couldn't be downloaded
+        """
+        if self.concurrency <= 1:
+            return [self.download(url) for url in urls]
+        return self._get_pool().map(self.download, list(urls), chunksize=1)
+
+    def _get_pool(self):
+        # the threads and their sessions are reused by the following calls, so are their connections
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def download_offer_photos(self, offers):
+        """
+        :param offers: an iterable of offers from :meth:`scrape.offer.get_offer_information`
+        :rtype: list(list(string))
+        :return: the paths of the photos of every offer, see :meth:`scrape.photos.PhotoStore.download_many`. Offers
+                 with meta['duplicate_of'] set have their photos skipped and get an empty list.
+        """
+        photo_links = [[] if (offer.get('meta') or {}).get('duplicate_of') else offer.get('photo_links') or []
+                       for offer in offers]
+        paths = iter(self.download_many(url for links in photo_links for url in links))
+        return [[next(paths) for _ in links] for links in photo_links]
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            sessions, self._sessions = self._sessions, []
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for session in sessions:
+            session.close()
+        self._index_file.close()
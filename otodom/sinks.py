@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import logging
+import sys
+import threading
+
+from otodom.lazy import LazyModule
+
+if sys.version_info < (3, 0):
+    from Queue import Queue
+else:
+    from queue import Queue
+
+metrics = LazyModule('otodom.metrics')
+
+log = logging.getLogger(__file__)
+
+FORMATS = ["jsonl", "jsonl.gz", "msgpack"]
+DEFAULT_MAX_PENDING = 1000
+
+_CLOSE = object()
+
+
+class Sink(object):
+    """A base class for outputs writing records one by one, as they are scraped."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, record):
+        """
+        :param record: a dict, for example the result of :meth:`scrape.offer.get_offer_information`
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class JSONLSink(Sink):
+    """Writes every record as a line of json."""
+
+    def __init__(self, path):
+        """
+        :param path: path to the output file
+        """
+        self.file = self.open(path)
+
+    def open(self, path):
+        return open(path, "wb")
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+
+    def close(self):
+        self.file.close()
+
+
+class GzipJSONLSink(JSONLSink):
+    """Writes every record as a line of json into a gzip compressed file."""
+
+    def open(self, path):
+        return gzip.open(path, "wb")
+
+
+class MsgpackSink(Sink):
+    """Writes the records as a stream of msgpack objects, requires the msgpack package."""
+
+    def __init__(self, path):
+        """
+        :param path: path to the output file
+        """
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The msgpack output format requires the msgpack package, pip install msgpack")
+        self.packer = msgpack.Packer(use_bin_type=True, default=str)
+        self.file = open(path, "wb")
+
+    def write(self, record):
+        self.file.write(self.packer.pack(record))
+
+    def close(self):
+        self.file.close()
+
+
+class BufferedSink(Sink):
+    """
+    Writes the records to another sink from a background thread. At most max_pending records wait to be written,
+    when there are more, :meth:`write` blocks until the writer catches up, which slows down the fetchers producing
+    the records instead of letting memory grow.
+    """
+
+    def __init__(self, sink, max_pending=DEFAULT_MAX_PENDING, name="sink"):
+        """
+        :param sink: the :class:`scrape.sinks.Sink` the records are written to
+        :param max_pending: the maximal number of records waiting to be written
+        :param name: the queue label of the otodom_queue_depth metric
+        """
+        self.sink = sink
+        self.name = name
+        self.error = None
+        self._queue = Queue(max_pending)
+        self._thread = threading.Thread(target=self._write_records)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_records(self):
+        while True:
+            record = self._queue.get()
+            if record is _CLOSE:
+                return
+            if self.error is None:
+                try:
+                    self.sink.write(record)
+                except Exception as error:
+                    log.exception("Writing to {0} failed".format(self.sink))
+                    self.error = error
+
+    def write(self, record):
+        if self.error is not None:
+            raise self.error
+        self._queue.put(record)
+        metrics.QUEUE_DEPTH.set(self._queue.qsize(), queue=self.name)
+
+    def close(self):
+        """Waits for all the pending records to be written and closes the underlying sink."""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        metrics.QUEUE_DEPTH.set(0, queue=self.name)
+        self.sink.close()
+        if self.error is not None:
+            raise self.error
+
+
+def get_format_from_path(path):
+    """
+    :param path: path to the output file
+    :rtype: string
+    :return: one of :data:`FORMATS` guessed from the extension, jsonl if it's unknown
+    """
+    if path.endswith(".gz"):
+        return "jsonl.gz"
+    if path.endswith((".msgpack", ".mpk")):
+        return "msgpack"
+    return "jsonl"
+
+
+def open_sink(path, output_format=None, max_pending=DEFAULT_MAX_PENDING):
+    """
+    Opens a sink writing records incrementally, from a background thread if max_pending is not 0.
+
+    :param path: path to the output file
+    :param output_format: one of :data:`FORMATS`, guessed from the path if None
+    :param max_pending: the maximal number of records waiting to be written, see :class:`scrape.sinks.BufferedSink`
+    :rtype: :class:`scrape.sinks.Sink`
+    """
+    output_format = output_format or get_format_from_path(path)
+    sink_classes = {
+        "jsonl": JSONLSink,
+        "jsonl.gz": GzipJSONLSink,
+        "msgpack": MsgpackSink,
+    }
+    if output_format not in sink_classes:
+        raise ValueError("Unknown output format {0}, use one of {1}".format(output_format, ", ".join(FORMATS)))
+    sink = sink_classes[output_format](path)
+    if not max_pending:
+        return sink
+    return BufferedSink(sink, max_pending)
+
+
+def read_records(path, input_format=None):
+    """
+    Reads back the records written by :meth:`scrape.sinks.open_sink`.
+
+    :param path: path to the file
+    :param input_format: one of :data:`FORMATS`, guessed from the path if None
+    :rtype: generator of dict
+    """
+    input_format = input_format or get_format_from_path(path)
+    if input_format == "msgpack":
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The msgpack format requires the msgpack package, pip install msgpack")
+        with open(path, "rb") as records_file:
+            for record in msgpack.Unpacker(records_file, raw=False):
+                yield record
+        return
+    if input_format not in FORMATS:
+        raise ValueError("Unknown format {0}, use one of {1}".format(input_format, ", ".join(FORMATS)))
+    with (gzip.open(path, "rb") if input_format == "jsonl.gz" else open(path, "rb")) as records_file:
+        for line in records_file:
+            if line.strip():
+                yield json.loads(line.decode("utf-8"))
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import re
+import threading
+
+from otodom.lazy import LazyModule
+from otodom.normalize import parse_float, parse_int
+
+sinks = LazyModule('otodom.sinks')
+helpers = LazyModule('scrapper_helpers.utils')
+
+log = logging.getLogger(__file__)
+
+RANGE_FILTER_PATTERN = re.compile(r"^\[filter_float_(?P<name>\w+):(?P<bound>from|to)\]$")
+# get_category range filters and the indexed fields they query
+RANGE_FIELDS = {
+    'price': 'price',
+    'price_per_m': 'price_per_m',
+    'm': 'surface',
+    'building_floors_num': 'total_floors',
+}
+NUMERIC_FIELDS = ("price", "price_per_m", "surface", "rooms", "floor", "total_floors")
+VALUE_FIELDS = ("city", "district", "voivodeship", "poster_type")
+MAX_ENUM_NUMBER = 10
+# get_category extras and media filters and the additional_assets flags they query
+ASSET_FLAGS = {
+    'balcony': 'balcony',
+    'garage': 'car_parking',
+    'basement': 'basement',
+    'garden': 'garden',
+    'terrace': 'terrace',
+    'lift': 'elevator',
+    'two_storey': 'duplex_apartment',
+    'separate_kitchen': 'kitchen',
+    'internet': 'internet',
+    'cable-television': 'cable_tv',
+}
+# get_category flag filters and the offer fields that have to be set
+PRESENCE_FLAGS = {
+    '[photos]': 'photo_links',
+    '[movie]': 'video_link',
+    '[walkaround_3dview]': '3D_walkaround_link',
+}
+
+
+def normalize_region(name):
+    """
+    :param name: a region name like 'Gdańsk' or a region filter value like 'gdansk_40'
+    :rtype: string
+    :return: the name normalized the way otodom does it in the urls, without the region ID, for example 'gdansk'
+    """
+    if not name:
+        return ""
+    # 'ł' has no decomposition, so it would be dropped instead of becoming 'l'
+    name = helpers.normalize_text(name.replace(u"ł", u"l").replace(u"Ł", u"L"))
+    prefix, _, suffix = name.rpartition("_")
+    return prefix if prefix and suffix.isdigit() else name
+
+
+def get_offer_key(offer):
+    """
+    :param offer: an offer dictionary, from :meth:`scrape.category.get_category` or
+                  :meth:`scrape.offer.get_offer_information`
+    :return: the value identifying the offer in a store, None if the offer can't be identified
+    """
+    context = offer.get('meta', {}).get('context') or {}
+    return offer.get('offer_id') or context.get('offer_id') or offer.get('detail_url') or context.get('detail_url')
+
+
+def _number(value, number_type):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return number_type(str(value))
+
+
+def get_indexed_values(offer):
+    """
+    This method returns the values of the offer the store indexes. Category search results only have some of them,
+    their city and district are taken from the location.
+
+    :param offer: an offer dictionary
+    :rtype: tuple(dict, set)
+    :return: the field values and the set of additional assets and presence flags the offer has
+    """
+    location = [part.strip() for part in (offer.get('location') or "").split(",")]
+    values = {
+        'price': _number(offer.get('price'), parse_float),
+        'surface': _number(offer.get('surface'), parse_float),
+        'rooms': _number(offer.get('rooms'), parse_int),
+        'floor': _number(offer.get('floor'), parse_int),
+        'total_floors': _number(offer.get('total_floors'), parse_int),
+        'city': normalize_region(offer.get('city') or location[0]),
+        'district': normalize_region(offer.get('district') or (location[1] if len(location) > 1 else "")),
+        'voivodeship': normalize_region(offer.get('voivodeship')),
+        'poster_type': offer.get('poster_type'),
+    }
+    if values['price'] is not None and values['surface']:
+        values['price_per_m'] = values['price'] / values['surface']
+    else:
+        values['price_per_m'] = None
+    flags = {flag for flag, value in (offer.get('additional_assets') or {}).items() if value}
+    flags.update(field for field in PRESENCE_FLAGS.values() if offer.get(field))
+    return values, flags
+
+
+class OfferStore(object):
+    """
+    A local, in-memory collection of scraped offers, indexed on the dimensions of the
+    :meth:`scrape.category.get_category` filters, so searches can be answered without accessing the network.
+
+    Numeric fields are kept in sorted lists searched with bisect, the rest in sets of offer positions, which are
+    intersected starting with the smallest one. A replaced offer is removed from all of them.
+    """
+
+    def __init__(self, offers=()):
+        """
+        :param offers: offers to add, see :meth:`scrape.store.OfferStore.add`
+        """
+        self._records = []
+        self._positions = {}
+        self._removed = set()
+        self._numeric = {field: {} for field in NUMERIC_FIELDS}
+        self._sorted = {}
+        self._values = {field: {} for field in VALUE_FIELDS}
+        self._flags = {}
+        self._lock = threading.RLock()
+        self.update(offers)
+
+    @classmethod
+    def from_file(cls, path, input_format=None):
+        """
+        :param path: a file written by :meth:`scrape.sinks.open_sink`
+        :param input_format: see :meth:`scrape.sinks.read_records`
+        :rtype: :class:`scrape.store.OfferStore`
+        """
+        return cls(sinks.read_records(path, input_format))
+
+    def __len__(self):
+        return len(self._records) - len(self._removed)
+
+    def __iter__(self):
+        with self._lock:
+            return iter([record for position, record in enumerate(self._records) if position not in self._removed])
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get(self, key, default=None):
+        """
+        :param key: the offer ID or detail url, see :meth:`scrape.store.get_offer_key`
+        :return: the stored offer
+        """
+        position = self._positions.get(key)
+        return default if position is None else self._records[position]
+
+    def add(self, offer):
+        """
+        Adds an offer to the store, replacing the stored offer with the same key.
+
+        :param offer: an offer dictionary, from :meth:`scrape.category.get_category` or
+                      :meth:`scrape.offer.get_offer_information`
+        """
+        values, flags = get_indexed_values(offer)
+        key = get_offer_key(offer)
+        with self._lock:
+            position = len(self._records)
+            self._records.append(offer)
+            if key is not None:
+                if key in self._positions:
+                    self._unindex(self._positions[key])
+                self._positions[key] = position
+            for field in NUMERIC_FIELDS:
+                if values[field] is not None:
+                    self._numeric[field][position] = values[field]
+                    self._sorted.pop(field, None)
+            for field in VALUE_FIELDS:
+                self._values[field].setdefault(values[field], set()).add(position)
+            for flag in flags:
+                self._flags.setdefault(flag, set()).add(position)
+
+    def _unindex(self, position):
+        values, flags = get_indexed_values(self._records[position])
+        self._removed.add(position)
+        for field in NUMERIC_FIELDS:
+            if self._numeric[field].pop(position, None) is not None:
+                self._sorted.pop(field, None)
+        for field in VALUE_FIELDS:
+            _discard(self._values[field], values[field], position)
+        for flag in flags:
+            _discard(self._flags, flag, position)
+
+    def update(self, offers):
+        """
+        :param offers: an iterable of offers, see :meth:`scrape.store.OfferStore.add`
+        """
+        for offer in offers:
+            self.add(offer)
+
+    def query(self, **filters):
+        """
+        Finds the stored offers matching the filters.
+
+        The following :meth:`scrape.category.get_category` filters are supported: the price, price per square meter,
+        surface and building floors ranges, '[filter_enum_rooms_num][]', '[filter_enum_floor_no][]' without cellar
+        and garret, '[filter_enum_extras_types][]' and '[filter_enum_media_types][]' values having an additional
+        assets flag (balcony, garage, basement, garden, terrace, lift, two_storey, separate_kitchen, internet,
+        cable-television), '[private_business]', '[photos]', '[movie]', '[walkaround_3dview]', 'description_fragment',
+        'city' and 'voivodeship'. 'district' can be used to filter by the district name. Empty filters are ignored.
+
+        :param filters: see :meth:`scrape.category.get_category`
+        :rtype: list(dict)
+        :return: the matching offers, in the order they were added
+        :raises ValueError: if a filter can't be answered from the scraped fields
+        """
+        with self._lock:
+            candidates, fragment = self._get_candidate_sets(filters), filters.get('description_fragment')
+            if candidates:
+                candidates.sort(key=len)
+                positions = candidates[0].intersection(*candidates[1:])
+            else:
+                positions = range(len(self._records))
+            records = [self._records[position] for position in sorted(positions) if position not in self._removed]
+        if fragment:
+            fragment = fragment.lower()
+            records = [record for record in records if fragment in (record.get('description') or "").lower()]
+        return records
+
+    def count(self, **filters):
+        """
+        :param filters: see :meth:`scrape.store.OfferStore.query`
+        :rtype: int
+        :return: the number of matching offers
+        """
+        return len(self.query(**filters))
+
+    def _get_candidate_sets(self, filters):
+        ranges, candidates = {}, []
+        for name, value in filters.items():
+            if value is None or value == "" or value == []:
+                continue
+            match = RANGE_FILTER_PATTERN.match(name)
+            if match and match.group("name") in RANGE_FIELDS:
+                bounds = ranges.setdefault(RANGE_FIELDS[match.group("name")], [None, None])
+                bounds[match.group("bound") == "to"] = float(value)
+            elif name == '[filter_enum_rooms_num][]':
+                candidates.append(self._get_enum_positions("rooms", value, "more"))
+            elif name == '[filter_enum_floor_no][]':
+                candidates.append(self._get_floor_positions(value))
+            elif name in ('[filter_enum_extras_types][]', '[filter_enum_media_types][]'):
+                for extra in _as_list(value):
+                    if extra not in ASSET_FLAGS:
+                        raise ValueError("The {0} value {1} is not supported".format(name, extra))
+                    candidates.append(self._flags.get(ASSET_FLAGS[extra], set()))
+            elif name in PRESENCE_FLAGS:
+                # 0 means the offers don't have to have it
+                if value:
+                    candidates.append(self._flags.get(PRESENCE_FLAGS[name], set()))
+            elif name == '[private_business]':
+                candidates.append(self._values['poster_type'].get(value, set()))
+            elif name in ('city', 'district', 'voivodeship'):
+                candidates.append(self._values[name].get(normalize_region(value), set()))
+            elif name != 'description_fragment':
+                raise ValueError("The {0} filter is not supported".format(name))
+        for field, (lower, upper) in ranges.items():
+            candidates.append(self._get_range_positions(field, lower, upper))
+        return candidates
+
+    def _get_sorted(self, field):
+        if field not in self._sorted:
+            pairs = sorted((value, position) for position, value in self._numeric[field].items())
+            self._sorted[field] = ([value for value, _ in pairs], [position for _, position in pairs])
+        return self._sorted[field]
+
+    def _get_range_positions(self, field, lower=None, upper=None):
+        values, positions = self._get_sorted(field)
+        start = 0 if lower is None else bisect.bisect_left(values, lower)
+        end = len(values) if upper is None else bisect.bisect_right(values, upper)
+        return set(positions[start:end])
+
+    def _get_enum_positions(self, field, enum_values, over_max):
+        positions = set()
+        for enum_value in _as_list(enum_values):
+            if enum_value == over_max:
+                positions.update(self._get_range_positions(field, MAX_ENUM_NUMBER + 1))
+            else:
+                number = int(enum_value)
+                positions.update(self._get_range_positions(field, number, number))
+        return positions
+
+    def _get_floor_positions(self, floors):
+        positions = set()
+        for floor in _as_list(floors):
+            if floor == "ground_floor":
+                positions.update(self._get_range_positions("floor", 0, 0))
+            elif floor == "floor_higher_10":
+                positions.update(self._get_range_positions("floor", MAX_ENUM_NUMBER + 1))
+            elif floor.startswith("floor_"):
+                positions.update(self._get_enum_positions("floor", floor[len("floor_"):], None))
+            else:
+                raise ValueError("The [filter_enum_floor_no][] value {0} is not supported".format(floor))
+        return positions
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple, set)) else [value]
+
+
+def _discard(index, value, position):
+    positions = index.get(value)
+    if positions is not None:
+        positions.discard(position)
+        if not positions:
+            del index[value]
@@ -1,30 +1,132 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import json
 import logging
 import re
 import sys
-import requests
+import threading
+import time
 try:
     from __builtin__ import unicode
 except ImportError:
     unicode = lambda x, *args: x
 
-from scrapper_helpers.utils import caching, normalize_text, key_sha1, get_random_user_agent
-
-from otodom import BASE_URL
+from otodom import API_URL, BASE_URL
+from otodom.instrumentation import span
+from otodom.lazy import LazyModule, caching
 
 if sys.version_info < (3, 2):
     from urllib import quote
 else:
     from urllib.parse import quote
 
+json = LazyModule('json')
+requests = LazyModule('requests')
+helpers = LazyModule('scrapper_helpers.utils')
+
 REGION_DATA_KEYS = ["city", "voivodeship", "[district_id]", "[street_id]"]
 
 log = logging.getLogger(__file__)
 
 
+class RateLimiter(object):
+    """A limit of requests per second shared by all the threads, requests over the limit wait for their turn."""
+
+    def __init__(self, requests_per_second):
+        """
+        :param requests_per_second: float, the maximal average number of requests per second
+        """
+        self.interval = 1.0 / requests_per_second
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            scheduled = max(now, self._next_request)
+            self._next_request = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+_rate_limiter = None
+
+
+class LRUCache(object):
+    """A thread-safe mapping keeping at most maxsize most recently used items, counting its hits and misses."""
+
+    def __init__(self, maxsize=128):
+        """
+        :param maxsize: the maximal number of items, 0 disables the cache
+        """
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            if self.maxsize <= 0:
+                return
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        :rtype: dict
+        :return: the number of hits, misses and items, and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._items),
+                'maxsize': self.maxsize,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+def set_rate_limit(requests_per_second):
+    """
+    Limits the number of requests made to otodom, across all the threads.
+
+    :param requests_per_second: float, or None to remove the limit
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+
+
+def wait_for_rate_limit():
+    """Blocks until the next request is allowed by :meth:`scrape.utils.set_rate_limit`."""
+    rate_limiter = _rate_limiter
+    if rate_limiter is not None:
+        rate_limiter.wait()
+
+
 def get_region_from_autosuggest(region_part):
     """
     This method makes a request to the OtoDom api, asking for the best fitting region for the supplied
@@ -37,23 +139,23 @@ def get_region_from_autosuggest(region_part):
     """
     if not region_part:
         return {}
-    url = u"https://www.otodom.pl/ajax/geo6/autosuggest/?data={0}".format(
-        normalize_text(region_part, lower=False, replace_spaces=''))
-    response = json.loads(get_response_for_url(url).text)[0]
+    url = u"{0}/ajax/geo6/autosuggest/?data={1}".format(
+        API_URL, helpers.normalize_text(region_part, lower=False, replace_spaces=''))
+    response = json.loads(get_response_for_url(url, stage='http.autosuggest').text)[0]
     region_type = response["level"]
     text = response["text"].replace("<strong>", "").replace("</strong>", "").split(", ")
 
     region_dict = {}
 
     if region_type == "CITY":
-        region_dict["city"] = u"{0}{1}{2}".format(normalize_text(text[0]), "_", response["city_id"])
+        region_dict["city"] = u"{0}{1}{2}".format(helpers.normalize_text(text[0]), "_", response["city_id"])
     elif region_type == "DISTRICT":
-        region_dict["city"] = u"{0}{1}{2}".format(normalize_text(text[1]), "_", response["city_id"])
+        region_dict["city"] = u"{0}{1}{2}".format(helpers.normalize_text(text[1]), "_", response["city_id"])
         region_dict["[district_id]"] = response["district_id"]
     elif region_type == "REGION":
-        region_dict["voivodeship"] = normalize_text(text[0])
+        region_dict["voivodeship"] = helpers.normalize_text(text[0])
     elif region_type == "STREET":
-        region_dict["city"] = u"{0}{1}{2}".format(normalize_text(text[0]), "_", response["city_id"])
+        region_dict["city"] = u"{0}{1}{2}".format(helpers.normalize_text(text[0]), "_", response["city_id"])
         region_dict["[street_id]"] = response["street_id"]
 
     return region_dict
@@ -91,9 +193,81 @@ def get_number_from_string(s, number_type, default):
         return default
 
 
+class SearchURL(object):
+    """
+    A template of the urls of all the pages of a search. The region is resolved and the filters are encoded once, so
+    getting the url of any page is cheap.
+    """
+
+    def __init__(self, main_category, detail_category, region, ads_per_page="", **filters):
+        """
+        :param main_category: see :meth:`scrape.category.get_category` for reference
+        :param detail_category: see :meth:`scrape.category.get_category` for reference
+        :param region: see :meth:`scrape.category.get_category` for reference
+        :param ads_per_page: "?nrAdsPerPage=72" can be used to lower the amount of requests
+        :param filters: see :meth:`scrape.category.get_category` for reference
+        """
+        # skip using autosuggest if any region data present in the filters
+        if any([region_key in filters for region_key in REGION_DATA_KEYS]):
+            region_data = get_region_from_filters(filters)
+        else:
+            region_data = get_region_from_autosuggest(region)
+
+        city_or_voivodeship = region_data["city"] if "city" in region_data else region_data[
+            "voivodeship"] if "voivodeship" in region_data else ""
+
+        if "[district_id]" in region_data:
+            filters["[district_id]"] = region_data["[district_id]"]
+
+        if "[street_id]" in region_data:
+            filters["[street_id]"] = region_data["[street_id]"]
+
+        # creating base url
+        url = "/".join([BASE_URL, main_category, detail_category, city_or_voivodeship])
+
+        # adding building type if exists in filters
+        if "building_type" in filters:
+            url = url + "/" + filters["building_type"]
+
+        # adding description fragment search if exists in filters
+        if "description_fragment" in filters:
+            url = url + "/q-" + "-".join(filters["description_fragment"].split())
+
+        # preparing the rest of filters for addition to the url
+        filter_list = []
+        for key, value in filters.items():
+            if isinstance(value, list):
+                for item in value:
+                    filter_list.append("search{}={}".format(quote(key), item))
+            else:
+                filter_list.append("search{}={}".format(quote(key), value))
+
+        # only the page number differs between the urls, it goes between these two parts
+        self._head = url + ads_per_page + "&"
+        self._tail = "".join("&" + item for item in filter_list)
+
+    def url(self, page=None):
+        """
+        :param page: page number
+        :rtype: string
+        :return: the url of the page
+        """
+        return self._head + ("page={0}".format(page) if page is not None else "") + self._tail
+
+    def urls(self, pages):
+        """
+        :param pages: an iterable of page numbers, for example range(2, pages_count + 1)
+        :rtype: list(string)
+        :return: the urls of the pages
+        """
+        head, tail = self._head, self._tail
+        return [head + "page={0}".format(page) + tail for page in pages]
+
+
 def get_url(main_category, detail_category, region, ads_per_page="", page=None, **filters):
     """
-    This method builds a ready-to-use url based on the input parameters.
+    This method builds a ready-to-use url based on the input parameters. Use :class:`scrape.utils.SearchURL` to build
+    the urls of many pages of the same search.
 
     :param main_category: see :meth:`scrape.category.get_category` for reference
     :param detail_category: see :meth:`scrape.category.get_category` for reference
@@ -104,54 +278,91 @@ def get_url(main_category, detail_category, region, ads_per_page="", page=None,
     :rtype: string
     :return: the url
     """
-    page = "page={0}".format(page) if page is not None else ""
-
-    # skip using autosuggest if any region data present in the filters
-    if any([region_key in filters for region_key in REGION_DATA_KEYS]):
-        region_data = get_region_from_filters(filters)
-    else:
-        region_data = get_region_from_autosuggest(region)
-
-    city_or_voivodeship = region_data["city"] if "city" in region_data else region_data[
-        "voivodeship"] if "voivodeship" in region_data else ""
-
-    if "[district_id]" in region_data:
-        filters["[district_id]"] = region_data["[district_id]"]
+    url = SearchURL(main_category, detail_category, region, ads_per_page, **filters).url(page)
+    log.info(url)
+    return url
 
-    if "[street_id]" in region_data:
-        filters["[street_id]"] = region_data["[street_id]"]
 
-    # creating base url
-    url = "/".join([BASE_URL, main_category, detail_category, city_or_voivodeship])
+@caching
+def get_response_for_url(url, stage='http.fetch'):
+    """
+    Safe to call from many threads at once, every call uses its own connection.
 
-    # adding building type if exists in filters
-    if "building_type" in filters:
-        url = url + "/" + filters["building_type"]
+    :param url: an url, most likely from the :meth:`scrape.utils.get_url` method
+    :param stage: name of the instrumentation stage the request is reported as, see
+                  :meth:`scrape.instrumentation.span`
+    :return: a requests.response object
+    """
+    wait_for_rate_limit()
+    with span(stage, url=url) as current:
+        response = requests.get(url, headers={'User-Agent': helpers.get_random_user_agent()})
+        current.set(status=response.status_code, bytes=len(response.content), elapsed=response.elapsed.total_seconds())
+    return response
 
-    # adding description fragment search if exists in filters
-    if "description_fragment" in filters:
-        url = url + "/q-" + "-".join(filters["description_fragment"].split())
 
-    # preparing the rest of filters for addition to the url
-    filter_list = []
-    for key, value in filters.items():
-        if isinstance(value, list):
-            for item in value:
-                filter_list.append("search{}={}".format(quote(key), item))
-        else:
-            filter_list.append("search{}={}".format(quote(key), value))
-    url = url + "&".join([ads_per_page, page] + filter_list)
-    log.info(url)
-    return url
+def iter_content_for_url(url, chunk_size=16384):
+    """
+    Downloads an url in chunks, so the content can be processed while it is still being downloaded.
+    Safe to call from many threads at once, every call uses its own connection.
 
+    :param url: an url, most likely from the :meth:`scrape.utils.get_url` method
+    :param chunk_size: maximal number of bytes in a chunk
+    :rtype: generator of bytes
+    :return: the chunks of the response content
+    """
+    wait_for_rate_limit()
+    with span('http.stream', url=url) as current:
+        response = requests.get(url, headers={'User-Agent': helpers.get_random_user_agent()}, stream=True)
+        downloaded = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                downloaded += len(chunk)
+                yield chunk
+        finally:
+            response.close()
+            current.set(status=response.status_code, bytes=downloaded, elapsed=response.elapsed.total_seconds())
+
+
+def get_status_for_url(url):
+    """
+    Fetches only the status of an url, without downloading the body. A HEAD request is used and redirects aren't
+    followed, servers refusing HEAD get a streamed GET that is closed right after the headers are read.
+    Safe to call from many threads at once.
 
-@caching(key_func=key_sha1)
-def get_response_for_url(url):
+    :param url: an url
+    :rtype: tuple(int, string)
+    :return: the HTTP status code and the Location header, None if it wasn't sent
     """
-    :param url: an url, most likely from the :meth:`scrape.utils.get_url` method
-    :return: a requests.response object
+    wait_for_rate_limit()
+    headers = {'User-Agent': helpers.get_random_user_agent()}
+    with span('http.head', url=url) as current:
+        response = requests.head(url, headers=headers, allow_redirects=False)
+        if response.status_code in (405, 501):
+            response = requests.get(url, headers=headers, allow_redirects=False, stream=True)
+            response.close()
+        current.set(status=response.status_code, bytes=0, elapsed=response.elapsed.total_seconds())
+    return response.status_code, response.headers.get('Location')
+
+
+def map_concurrently(func, items, concurrency=8):
     """
-    return requests.get(url, headers={'User-Agent': get_random_user_agent()})
+    This method calls func for every item from a pool of threads, all the otodom fetch and parse methods are safe to
+    be used this way.
+
+    :param func: a callable taking a single item
+    :param items: an iterable of items
+    :param concurrency: number of threads, 1 calls func in the current thread
+    :rtype: list
+    :return: the results of func, in the order of items
+    """
+    if concurrency <= 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
 
 
 def get_cookie_from(response):
@@ -170,6 +381,7 @@ def get_csrf_token(html_content):
     :rtype: string
     :return: the CSRF token as string
     """
-    found = re.match(r".*csrfToken\s+=(\\|\s)+'(?P<csrf_token>\w+).*", str(html_content))
-    csrf_token = found.groupdict().get('csrf_token')
-    return csrf_token
+    with span('offer.csrf_token', bytes=len(html_content)):
+        found = re.match(r".*csrfToken\s+=(\\|\s)+'(?P<csrf_token>\w+).*", str(html_content))
+        csrf_token = found.groupdict().get('csrf_token')
+        return csrf_token
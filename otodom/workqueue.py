@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from otodom.checkpoint import get_search_key
+from otodom.lazy import LazyModule
+
+json = LazyModule('json')
+sqlite3 = LazyModule('sqlite3')
+uuid = LazyModule('uuid')
+category = LazyModule('otodom.category')
+offer = LazyModule('otodom.offer')
+utils = LazyModule('otodom.utils')
+
+log = logging.getLogger(__file__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_token TEXT,
+    lease_expires REAL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, available_at);
+"""
+
+CATEGORY, OFFER = "category", "offer"
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+DEFAULT_LEASE_TIME = 300
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+# how long a worker waits for another one holding the database lock, in seconds
+DEFAULT_TIMEOUT = 30
+ADS_PER_PAGE = "?nrAdsPerPage=72"
+
+
+class Task(object):
+    """A leased unit of work, see :meth:`scrape.workqueue.WorkQueue.lease`."""
+
+    def __init__(self, id, kind, key, payload, attempts, token):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        self.token = token
+
+    def __repr__(self):
+        return "Task({0!r}, {1!r}, attempts={2})".format(self.kind, self.key, self.attempts)
+
+
+class WorkQueue(object):
+    """
+    A local sqlite queue of category pages and offers to scrape, shared by any number of worker threads and
+    processes, so a sweep can be split between them without doing anything twice.
+
+    Workers lease tasks for a limited time and acknowledge them once they are done. The tasks of a worker that crashed
+    are leased again once their lease expires, up to max_attempts times. Offers are queued once per offer ID and
+    category pages once per search and page, so queueing them again does nothing, see
+    :meth:`scrape.workqueue.get_offer_task_key`.
+    """
+
+    def __init__(self, path, lease_time=DEFAULT_LEASE_TIME, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param path: path to the sqlite database file, it will be created if it doesn't exist
+        :param lease_time: the default number of seconds a task is leased for
+        :param max_attempts: the number of leases after which a task that wasn't acknowledged is marked as failed
+        :param timeout: see :data:`scrape.workqueue.DEFAULT_TIMEOUT`
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # every statement is a transaction of its own, so leases are atomic between processes
+        self._connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """Returns the number of tasks that weren't completed or failed."""
+        return self._execute("SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)", (PENDING, LEASED))[0][0]
+
+    def close(self):
+        self._connection.close()
+
+    def _execute(self, query, parameters=()):
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def _insert(self, rows):
+        with self._lock:
+            changes = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO tasks (kind, key, payload) VALUES (?, ?, ?)",
+                [(kind, key, json.dumps(payload, sort_keys=True)) for kind, key, payload in rows])
+            return self._connection.total_changes - changes
+
+    def put(self, kind, key, payload):
+        """
+        :param kind: the type of the task, for example 'category' or 'offer'
+        :param key: string identifying the task among the tasks of its kind
+        :param payload: a json serializable value describing the task
+        :rtype: bool
+        :return: False if the task was already queued, even if it was completed since
+        """
+        return bool(self._insert([(kind, key, payload)]))
+
+    def put_search(self, main_category, detail_category, region, **filters):
+        """
+        Queues the first page of a search, its other pages are queued by the worker scraping it, see
+        :meth:`scrape.workqueue.process_queue`.
+
+        :param main_category: see :meth:`scrape.category.get_category` for reference
+        :param detail_category: see :meth:`scrape.category.get_category` for reference
+        :param region: see :meth:`scrape.category.get_category` for reference
+        :param filters: see :meth:`scrape.category.get_category` for reference
+        :rtype: bool
+        :return: False if the search was already queued
+        """
+        search = [main_category, detail_category, region, filters]
+        return self.put(CATEGORY, _get_page_key(get_search_key(*search), 1), {'page': 1, 'search': search})
+
+    def put_category_pages(self, search, urls):
+        """
+        :param search: string identifying the search, see :meth:`scrape.checkpoint.get_search_key`
+        :param urls: a dict of page numbers and urls of the pages
+        :rtype: int
+        :return: the number of pages that weren't queued before
+        """
+        return self._insert([(CATEGORY, _get_page_key(search, page), {'page': page, 'url': url})
+                             for page, url in sorted(urls.items())])
+
+    def put_offers(self, offers):
+        """
+        :param offers: an iterable of offers from :meth:`scrape.category.get_category` or of offer urls, the offers
+                       without an offer ID and url, like the ones from other domains, are skipped
+        :rtype: int
+        :return: the number of offers that weren't queued before
+        """
+        rows = []
+        for context in offers:
+            if not isinstance(context, dict):
+                context = {'detail_url': context}
+            key = get_offer_task_key(context)
+            if key is not None:
+                rows.append((OFFER, key, context))
+        return self._insert(rows)
+
+    def lease(self, kinds=None, lease_time=None):
+        """
+        Leases the oldest available task: a pending one, or one whose lease expired.
+
+        :param kinds: an optional list of the kinds of tasks to lease
+        :param lease_time: the number of seconds the task is leased for, see :meth:`scrape.workqueue.WorkQueue.extend`
+        :rtype: :class:`scrape.workqueue.Task`
+        :return: the leased task, None if there is no task available
+        """
+        now, token = time.time(), uuid.uuid4().hex
+        kinds_condition, kinds = ("AND kind IN ({0})".format(", ".join("?" * len(kinds))), list(kinds)) \
+            if kinds else ("", [])
+        self._execute(
+            "UPDATE tasks SET state = ?, lease_token = NULL WHERE state = ? AND lease_expires <= ? AND attempts >= ?",
+            (FAILED, LEASED, now, self.max_attempts))
+        # a single statement, so two workers never lease the same task
+        self._execute(
+            "UPDATE tasks SET state = ?, attempts = attempts + 1, lease_token = ?, lease_expires = ? "
+            "WHERE id = (SELECT id FROM tasks "
+            "WHERE (state = ? AND available_at <= ? OR state = ? AND lease_expires <= ?) {0} "
+            "ORDER BY id LIMIT 1)".format(kinds_condition),
+            [LEASED, token, now + (self.lease_time if lease_time is None else lease_time), PENDING, now, LEASED, now] +
+            kinds)
+        rows = self._execute("SELECT id, kind, key, payload, attempts FROM tasks WHERE lease_token = ?", (token,))
+        if not rows:
+            return None
+        task_id, kind, key, payload, attempts = rows[0]
+        return Task(task_id, kind, key, json.loads(payload), attempts, token)
+
+    def _update_leased(self, task, assignments, parameters):
+        # the token doesn't match once the lease expired and the task was leased again
+        with self._lock:
+            return self._connection.execute(
+                "UPDATE tasks SET {0} WHERE id = ? AND state = ? AND lease_token = ?".format(assignments),
+                list(parameters) + [task.id, LEASED, task.token]).rowcount == 1
+
+    def ack(self, task):
+        """
+        Marks a leased task as completed.
+
+        :param task: a :class:`scrape.workqueue.Task`
+        :rtype: bool
+        :return: False if the lease expired and the task was leased again or failed
+        """
+        return self._update_leased(task, "state = ?, lease_token = NULL", [DONE])
+
+    def release(self, task, delay=0):
+        """
+        Returns a leased task to the queue, to be retried after delay seconds, or marks it as failed if it was leased
+        max_attempts times.
+
+        :param task: a :class:`scrape.workqueue.Task`
+        :param delay: the number of seconds before the task can be leased again
+        :rtype: bool
+        :return: False if the lease expired and the task was leased again or failed
+        """
+        state = FAILED if task.attempts >= self.max_attempts else PENDING
+        return self._update_leased(task, "state = ?, lease_token = NULL, available_at = ?",
+                                   [state, time.time() + delay])
+
+    def extend(self, task, lease_time=None):
+        """
+        Extends the lease of a task that takes longer than expected.
+
+        :param task: a :class:`scrape.workqueue.Task`
+        :param lease_time: the number of seconds from now the task is leased for
+        :rtype: bool
+        :return: False if the lease expired and the task was leased again or failed
+        """
+        return self._update_leased(task, "lease_expires = ?",
+                                   [time.time() + (self.lease_time if lease_time is None else lease_time)])
+
+    def get_counts(self):
+        """
+        :rtype: dict(string, int)
+        :return: the number of pending, leased, done and failed tasks
+        """
+        counts = dict.fromkeys((PENDING, LEASED, DONE, FAILED), 0)
+        counts.update(self._execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+        return counts
+
+
+def get_offer_task_key(context):
+    """
+    :param context: an offer from :meth:`scrape.category.get_category`, or a dict with just its detail_url
+    :rtype: string
+    :return: the offer ID, taken from the url if the offer has none, so an offer queued by its url and by its ID is
+             queued once. The url if it has no offer ID, None if the offer has neither.
+    """
+    key, url = context.get('offer_id'), context.get('detail_url')
+    if not key and url:
+        key = offer.get_offer_id_from_url(url) or url
+    return u"{0}".format(key) if key else None
+
+
+def _get_page_key(search, page):
+    return u"{0}#{1}".format(search, page)
+
+
+def _process_category_task(queue, task, archive=None, seen=None):
+    payload = task.payload
+    url = payload.get('url')
+    if url is None:
+        main_category, detail_category, region, filters = payload['search']
+        search_url = utils.SearchURL(main_category, detail_category, region, ADS_PER_PAGE, **filters)
+        url = search_url.url(payload['page'])
+    parser, chunks = category.CategoryStreamParser(), []
+    chunks_iterator = utils.iter_content_for_url(url)
+    if archive is not None:
+        chunks_iterator = category.collect_chunks(chunks_iterator, chunks)
+    offers = list(category.iter_category_offers(chunks_iterator, parser, seen))
+    if archive is not None:
+        archive.append(url, b"".join(chunks), kind="category")
+    if not parser.successful:
+        log.warning("Search for category wasn't successful: %s", url)
+        return
+    queue.put_offers(offers)
+    if 'search' in payload and parser.pages_count > 1:
+        pages = range(2, parser.pages_count + 1)
+        queue.put_category_pages(task.key.rpartition("#")[0], dict(zip(pages, search_url.urls(pages))))
+
+
+def process_queue(queue, archive=None, duplicates=None, seen=None, lease_time=None, retry_delay=DEFAULT_RETRY_DELAY):
+    """
+    Scrapes the tasks of a queue until no task is available. Category pages queue their offers and, for the first
+    page of a search, the other pages. Many workers can process the same queue, each in its own thread or process.
+
+    :param queue: a :class:`scrape.workqueue.WorkQueue`
+    :param archive: an optional :class:`scrape.archive.Archive`, the raw pages will be stored in it
+    :param duplicates: see :meth:`scrape.offer.get_offers_information`
+    :param seen: see :meth:`scrape.offer.get_offers_information`, it holds the keys of
+                 :meth:`scrape.workqueue.get_offer_task_key`, the offers in it are acknowledged without fetching
+    :param lease_time: see :meth:`scrape.workqueue.WorkQueue.lease`
+    :param retry_delay: the number of seconds before a failed task can be leased again
+    :rtype: generator of dict
+    :return: the scraped offer details, see :meth:`scrape.offer.get_offer_information`. A task is acknowledged
+             before its result is returned, so a slow consumer doesn't let its lease expire.
+    """
+    while True:
+        task = queue.lease(lease_time=lease_time)
+        if task is None:
+            return
+        try:
+            if task.kind == CATEGORY:
+                _process_category_task(queue, task, archive, seen)
+                result = None
+            elif seen is not None and task.key in seen:
+                result = None
+            else:
+                context = task.payload if task.payload.get('offer_id') else None
+                result = offer.get_offer_information(task.payload['detail_url'], context=context, archive=archive,
+                                                     duplicates=duplicates)
+        except Exception as error:
+            log.warning("Task %r failed: %s", task, error)
+            queue.release(task, retry_delay)
+            continue
+        if not queue.ack(task):
+            log.warning("The lease of task %r expired before it was completed", task)
+        if result is not None:
+            if seen is not None:
+                seen.add(task.key)
+            yield result
@@ -10,4 +10,9 @@ setup(
     author_email='mail@limebrains.com',
     url='https://github.com/limebrains/pyotodom',
     packages=['otodom'],
+    entry_points={
+        'console_scripts': [
+            'otodom = otodom.cli:main',
+        ],
+    },
 )
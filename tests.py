@@ -1,19 +1,44 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import gzip
+import json
 import pytest
+import requests
 import pickle
+import random
+import subprocess
 import sys
+import threading
 from bs4 import BeautifulSoup
 
+import otodom.archive as archive
+import otodom.bloom as bloom
 import otodom.category as category
+import otodom.checkpoint as checkpoint
+import otodom.cli as cli
+import otodom.dedup as dedup
+import otodom.geo as geo
+import otodom.history as history
+import otodom.instrumentation as instrumentation
+import otodom.lazy as lazy
+import otodom.metrics as metrics
+import otodom.normalize as normalize
 import otodom.offer as offer
+import otodom.photos as photos
+import otodom.sinks as sinks
+import otodom.store as store
 import otodom.utils as utils
+import otodom.workqueue as workqueue
 
 if sys.version_info < (3, 3):
     from mock import mock
 else:
     from unittest import mock
+
+# seconds, the summed self import times of the otodom modules, a few times what they take on a laptop
+IMPORT_TIME_BUDGET = 0.25
+HEAVY_MODULES = ["requests", "bs4", "scrapper_helpers", "sqlite3"]
 REGIONS_TO_TEST = [
     "Gdań", "Sop", "Oliw", "Wrzeszcz", "czechowice", "Nowa Wieś", "pomorskie", "Książąt pomor sopot", ""
 ]
@@ -24,6 +49,12 @@ ACTUAL_REGIONS = [
 ]
 
 
+def stand_in_server(**kwargs):
+    """The stand-in server needs the Python 3 http.server, so it is only imported by the tests using it."""
+    from benchmarks.server import StandInServer
+    return StandInServer(**kwargs)
+
+
 @pytest.mark.parametrize('filters,expected_value', zip(ACTUAL_REGIONS, ACTUAL_REGIONS))
 def test_get_region_from_filters(filters, expected_value):
     assert utils.get_region_from_filters(filters) == expected_value
@@ -46,6 +77,33 @@ def test_get_url(main_category, detail_category, region, get_region_from_autosug
             assert utils.get_url(main_category, detail_category, region)
 
 
+def split_search_url(url):
+    # the filters follow the order of the keyword arguments, which isn't kept before Python 3.6
+    parts = url.split("&")
+    return parts[:2], sorted(parts[2:])
+
+
+@pytest.mark.parametrize("filters,ads_per_page,base,query", [
+    ({"city": "gdansk_40"}, "", "http://www.otodom.pl/wynajem/mieszkanie/gdansk_40", "&searchcity=gdansk_40"),
+    ({"city": "gdansk_40", "[district_id]": 30, "[filter_enum_extras_types][]": ["balcony", "basement"]},
+     "?nrAdsPerPage=72", "http://www.otodom.pl/wynajem/mieszkanie/gdansk_40?nrAdsPerPage=72",
+     "&searchcity=gdansk_40&search%5Bdistrict_id%5D=30&search%5Bfilter_enum_extras_types%5D%5B%5D=balcony"
+     "&search%5Bfilter_enum_extras_types%5D%5B%5D=basement"),
+    ({"voivodeship": "pomorskie", "building_type": "blok", "description_fragment": "duzy balkon"}, "",
+     "http://www.otodom.pl/wynajem/mieszkanie/pomorskie/blok/q-duzy-balkon",
+     "&searchvoivodeship=pomorskie&searchbuilding_type=blok&searchdescription_fragment=duzy balkon"),
+])
+def test_search_url(filters, ads_per_page, base, query):
+    search_url = utils.SearchURL("wynajem", "mieszkanie", "", ads_per_page, **filters)
+    assert split_search_url(search_url.url()) == split_search_url(base + "&" + query)
+    assert split_search_url(search_url.url(12)) == split_search_url(base + "&page=12" + query)
+    assert split_search_url(utils.get_url("wynajem", "mieszkanie", "", ads_per_page, 12, **filters)) == \
+        split_search_url(base + "&page=12" + query)
+    assert [split_search_url(url) for url in search_url.urls(range(1, 4))] == [
+        split_search_url(base + "&page=1" + query), split_search_url(base + "&page=2" + query),
+        split_search_url(base + "&page=3" + query)]
+
+
 def test_get_response_for_url():
     with mock.patch("otodom.utils.requests.get") as get:
         utils.get_response_for_url("")
@@ -69,7 +127,11 @@ def test_get_csrf_token(markup_path, expected_value):
         ("test_data/markup_offer", {
             'detail_url': "https://www.otodom.pl/oferta/wrzeszcz-garnizon-3-pokoje-65-m-kw-ID3j9gi.html#9dd7c45485",
             'offer_id': '3j9gi',
-            'poster': ""
+            'poster': "",
+            'price': 2900.0,
+            'surface': 65.0,
+            'rooms': 3,
+            'location': 'Gdańsk, Wrzeszcz,  Antoniego Słonimskiego'
         })
     ])
 def test_parse_category_offer(markup_path, expected_value):
@@ -100,20 +162,102 @@ def test_was_category_search_successful(markup_path, expected_value):
         assert category.was_category_search_successful(pickle.load(markup_file)) == expected_value
 
 
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+@pytest.mark.parametrize('markup_path', ["test_data/markup_offers", "test_data/markup_no_offers"])
+def test_scan_category_content(markup_path):
+    with open(markup_path, "rb") as markup_file:
+        markup = pickle.load(markup_file)
+    offers, pages_count = category.scan_category_content(markup)
+    assert [(offer['detail_url'], offer['offer_id']) for offer in offers] == [
+        (offer['detail_url'], offer['offer_id']) for offer in category.parse_category_content(markup)]
+    assert pages_count == category.get_category_number_of_pages(markup)
+
+
+def test_scan_category_pages_count():
+    markup = (b'<ul class="pager"><li class="pager-item current">3</li></ul>'
+              b'<ul class="pager"><li class="current">7</li></ul>')
+    assert category.scan_category_content(markup) == ([], 3)
+    assert category.get_category_number_of_pages(markup) == 3
+    parser = category.CategoryStreamParser()
+    assert list(category.iter_category_offers([markup[:40], markup[40:]], parser)) == []
+    assert parser.pages_count == 3
+    assert category.scan_category_content(b'<li class="currently">2</li>') == ([], 1)
+
+
+@pytest.mark.parametrize('markup_path', ["test_data/markup_offers", "test_data/markup_no_offers"])
+@pytest.mark.parametrize('chunk_size', [7, 4096, 1 << 20])
+def test_iter_category_offers(markup_path, chunk_size):
+    with open(markup_path, "rb") as markup_file:
+        markup = pickle.load(markup_file)
+    parser = category.CategoryStreamParser()
+    chunks = (markup[i:i + chunk_size] for i in range(0, len(markup), chunk_size))
+    assert list(category.iter_category_offers(chunks, parser)) == category.parse_category_content(markup)
+    assert parser.pages_count == category.get_category_number_of_pages(markup)
+    assert parser.successful == category.was_category_search_successful(markup)
+    assert parser.size == len(markup)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_get_category_stream(tmpdir):
+    with stand_in_server(pages=2) as server, mock.patch("otodom.category.SearchURL") as SearchURL,\
+            archive.Archive(str(tmpdir.join("archive"))) as category_archive:
+        SearchURL.return_value.url.side_effect = lambda page: "{0}/wynajem/mieszkanie/?page={1}".format(
+            server.url, page)
+        streamed = category.get_category("wynajem", "mieszkanie", "", stream=True, archive=category_archive)
+        assert streamed == category.get_category("wynajem", "mieszkanie", "")
+        assert [category_archive.read(entry) for entry in category_archive] == [server.category_markup] * 2
+
+
 def test_get_category():
-    with mock.patch("otodom.category.get_url") as get_url,\
+    with mock.patch("otodom.category.SearchURL") as SearchURL,\
             mock.patch("otodom.category.get_response_for_url") as get_response_for_url,\
             mock.patch("otodom.category.was_category_search_successful") as was_category_search_successful,\
             mock.patch("otodom.category.parse_category_content") as parse_category_content,\
             mock.patch("otodom.category.get_category_number_of_pages", return_value=1) as get_category_number_of_pages:
         category.get_category("", "", "")
-        assert get_url.called
+        assert SearchURL.return_value.url.called
         assert get_response_for_url.called
         assert was_category_search_successful.called
         assert parse_category_content.called
         assert get_category_number_of_pages.called
 
 
+def test_get_category_resumes_from_checkpoint(tmpdir):
+    with checkpoint.Checkpoint(str(tmpdir.join("checkpoint.db"))) as sweep_checkpoint,\
+            mock.patch("otodom.category.SearchURL") as SearchURL,\
+            mock.patch("otodom.category.get_response_for_url") as get_response_for_url,\
+            mock.patch("otodom.category.was_category_search_successful", return_value=True),\
+            mock.patch("otodom.category.get_category_number_of_pages", return_value=3),\
+            mock.patch("otodom.category.parse_category_content") as parse_category_content:
+        SearchURL.return_value.url.side_effect = lambda page: page
+        parse_category_content.side_effect = [[{'offer_id': '1'}], [{'offer_id': '2'}], IOError]
+        with pytest.raises(IOError):
+            category.get_category("wynajem", "mieszkanie", "", checkpoint=sweep_checkpoint, city="gdansk_40")
+        search = checkpoint.get_search_key("wynajem", "mieszkanie", "", {"city": "gdansk_40"})
+        assert sweep_checkpoint.get_last_page(search) == 2
+
+        get_response_for_url.reset_mock()
+        parse_category_content.side_effect = [[{'offer_id': '3'}]]
+        assert category.get_category("wynajem", "mieszkanie", "", checkpoint=sweep_checkpoint, city="gdansk_40") == [
+            {'offer_id': '1'}, {'offer_id': '2'}, {'offer_id': '3'}]
+        get_response_for_url.assert_called_once_with(3)
+
+
+def test_get_offers_information_resumes_from_checkpoint(tmpdir):
+    offers = [{'offer_id': '1', 'detail_url': 'a'}, {'offer_id': '2', 'detail_url': 'b'}]
+    with checkpoint.Checkpoint(str(tmpdir.join("checkpoint.db"))) as sweep_checkpoint,\
+            mock.patch("otodom.offer.get_offer_information") as get_offer_information:
+        get_offer_information.side_effect = [{'title': 'a'}, IOError]
+        with pytest.raises(IOError):
+            list(offer.get_offers_information(offers, checkpoint=sweep_checkpoint, batch="gdansk"))
+
+        get_offer_information.reset_mock()
+        get_offer_information.side_effect = [{'title': 'b'}]
+        assert list(offer.get_offers_information(offers, checkpoint=sweep_checkpoint, batch="gdansk")) == [
+            {'title': 'a'}, {'title': 'b'}]
+        get_offer_information.assert_called_once_with('b', context=offers[1], archive=None, duplicates=None)
+
+
 @pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
 @pytest.mark.parametrize('markup_path,expected_value', [
     (
@@ -368,3 +512,762 @@ def test_get_offer_information(url, context):
             assert get_offer_ninja_pv.called
 
 
+@pytest.mark.parametrize("processes", [1, 2])
+def test_reparse_archive(tmpdir, processes):
+    with open("test_data/offer", "rb") as markup_file:
+        content = pickle.load(markup_file)
+    with archive.Archive(str(tmpdir)) as offer_archive:
+        offer_archive.append("https://www.otodom.pl/oferta/1", content, fetched_at=1)
+        offer_archive.append("https://www.otodom.pl/kategoria", b"<html></html>", kind="category", fetched_at=2)
+        offer_archive.append("https://www.otodom.pl/oferta/1", content, fetched_at=3)
+        assert offer_archive.get("https://www.otodom.pl/oferta/1") == content
+    with archive.Archive(str(tmpdir)) as offer_archive:
+        assert len(offer_archive) == 3
+    reparsed = list(archive.reparse_archive(str(tmpdir), parser=offer.get_offer_ninja_pv, processes=processes))
+    assert [entry['fetched_at'] for entry, _ in reparsed] == [1, 3]
+    assert all(ninja_pv == offer.get_offer_ninja_pv(content) for _, ninja_pv in reparsed)
+
+
+def test_archive_drops_unindexed_data(tmpdir):
+    with archive.Archive(str(tmpdir)) as page_archive:
+        page_archive.append("https://www.otodom.pl/oferta/1", b"first")
+    # a crash between writing a body and its index line
+    with open(str(tmpdir.join(archive.DATA_FILE_NAME)), "ab") as data_file:
+        data_file.write(b"garbage")
+    with archive.Archive(str(tmpdir)) as page_archive:
+        entry = page_archive.append("https://www.otodom.pl/oferta/2", b"second")
+        assert entry['offset'] == page_archive.entries[0]['length']
+    with archive.Archive(str(tmpdir)) as page_archive:
+        assert [page_archive.read(entry) for entry in page_archive] == [b"first", b"second"]
+
+
+def test_archive_reader_keeps_unindexed_data(tmpdir):
+    with archive.Archive(str(tmpdir)) as page_archive:
+        page_archive.append("https://www.otodom.pl/oferta/1", b"first")
+        # a writer that wrote a body, but not its index line yet
+        with open(str(tmpdir.join(archive.DATA_FILE_NAME)), "ab") as data_file:
+            data_file.write(b"pending")
+        with archive.Archive(str(tmpdir), read_only=True) as reader:
+            assert [reader.read(entry) for entry in reader] == [b"first"]
+            with pytest.raises(IOError):
+                reader.append("https://www.otodom.pl/oferta/2", b"second")
+    assert tmpdir.join(archive.DATA_FILE_NAME).read_binary().endswith(b"pending")
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_instrumentation_hooks():
+    assert instrumentation.span("offer.dom") is instrumentation.NULL_SPAN
+    events = []
+    instrumentation.register_hook(events.append)
+    try:
+        with open("test_data/offer", "rb") as markup_file:
+            offer.parse_offer_markup(pickle.load(markup_file))
+        with mock.patch("otodom.utils.requests.get") as get:
+            get.return_value.status_code = 200
+            get.return_value.content = b"<html></html>"
+            utils.get_response_for_url("http://www.otodom.pl")
+    finally:
+        instrumentation.unregister_hook(events.append)
+    assert [event['stage'] for event in events] == ['offer.dom', 'offer.ninja_pv', 'offer.extract', 'http.fetch']
+    assert events[0]['bytes'] == 113134
+    assert events[-1]['url'] == "http://www.otodom.pl" and events[-1]['status'] == 200
+    assert all(event['duration'] >= 0 and event['error'] is None for event in events)
+    assert instrumentation.span("offer.dom") is instrumentation.NULL_SPAN
+
+
+def test_metrics_exposition(tmpdir):
+    registry = metrics.Registry()
+    requests_count = registry.counter("requests_total", "Requests.", ["stage"])
+    duration = registry.histogram("duration_seconds", "Duration.", buckets=[0.1, 1])
+    requests_count.inc(stage='http.fetch')
+    requests_count.inc(2, stage='http.fetch')
+    duration.observe(0.5)
+    expected = (
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{stage="http.fetch"} 3.0\n'
+        '# HELP duration_seconds Duration.\n'
+        '# TYPE duration_seconds histogram\n'
+        'duration_seconds_bucket{le="0.1"} 0.0\n'
+        'duration_seconds_bucket{le="1.0"} 1.0\n'
+        'duration_seconds_bucket{le="+Inf"} 1.0\n'
+        'duration_seconds_sum 0.5\n'
+        'duration_seconds_count 1.0\n'
+    )
+    assert registry.exposition() == expected
+    metrics.write_to_file(str(tmpdir.join("otodom.prom")), registry)
+    assert tmpdir.join("otodom.prom").read() == expected
+
+
+def test_caching_metrics(tmpdir):
+    calls = []
+
+    @lazy.caching
+    def fetch_page(url):
+        calls.append(url)
+        return url.upper()
+
+    hits, misses = metrics.CACHE_HITS.get(cache="fetch_page"), metrics.CACHE_MISSES.get(cache="fetch_page")
+    with mock.patch("scrapper_helpers.utils.DEBUG", True),\
+            mock.patch("scrapper_helpers.utils.CACHE_DIR", str(tmpdir)):
+        assert [fetch_page("a"), fetch_page("a"), fetch_page("b")] == ["A", "A", "B"]
+    assert calls == ["a", "b"]
+    assert metrics.CACHE_HITS.get(cache="fetch_page") - hits == 1
+    assert metrics.CACHE_MISSES.get(cache="fetch_page") - misses == 2
+
+
+def test_metrics_record_spans():
+    metrics.install()
+    try:
+        with mock.patch("otodom.utils.requests.get") as get:
+            get.return_value.status_code = 500
+            get.return_value.content = b"error"
+            utils.get_response_for_url("http://www.otodom.pl")
+    finally:
+        metrics.uninstall()
+    assert metrics.REQUEST_ERRORS.get(stage='http.fetch') >= 1
+    assert metrics.DOWNLOADED_BYTES.get(stage='http.fetch') >= 5
+    assert metrics.STAGE_DURATION.get(stage='http.fetch')['count'] >= 1
+
+
+def test_autosuggest_counted_once():
+    events = []
+    instrumentation.register_hook(events.append)
+    try:
+        with mock.patch("otodom.utils.requests.get") as get:
+            get.return_value.status_code = 200
+            get.return_value.content = b"[]"
+            get.return_value.text = '[{"level": "REGION", "text": "<strong>pomorskie</strong>"}]'
+            assert utils.get_region_from_autosuggest("pomorskie") == {'voivodeship': 'pomorskie'}
+    finally:
+        instrumentation.unregister_hook(events.append)
+    assert [event['stage'] for event in events] == ['http.autosuggest']
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, otodom.offer, otodom.category, otodom.utils;"
+        "otodom.utils.get_url('wynajem', 'mieszkanie', '', city='gdansk_40');"
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    process = subprocess.Popen([sys.executable, "-c", code],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    modules = stdout.split()
+    assert [module for module in HEAVY_MODULES if module in modules] == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires -X importtime")
+def test_import_time():
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import otodom.offer, otodom.category"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    # lines look like "import time:       232 |        232 |   otodom.utils"
+    rows = [line.split("|") for line in stderr.splitlines()]
+    self_times = [(fields[2].strip(), int(fields[0].split(":")[1]))
+                  for fields in rows if len(fields) == 3 and fields[0].split(":")[1].strip().isdigit()]
+    otodom_time = sum(self_time for module, self_time in self_times if module.split(".")[0] == "otodom") / 1e6
+    assert "otodom.offer" in dict(self_times) and otodom_time < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_concurrent_get_category():
+    with stand_in_server(pages=2, offers=4) as server,\
+            mock.patch("otodom.utils.BASE_URL", server.url),\
+            mock.patch("otodom.category.WHITELISTED_DOMAINS", ["127.0.0.1"]):
+        searches = [{'city': 'gdansk_40', '[district_id]': district_id} for district_id in range(8)]
+        results = utils.map_concurrently(
+            lambda filters: category.get_category("wynajem", "mieszkanie", "", **filters), searches, concurrency=8)
+        assert server.requests_count['category'] == 8 * 2
+        assert all(len(offers) == 2 * 4 for offers in results)
+        assert all(offer['detail_url'].startswith(server.url) for offers in results for offer in offers)
+
+
+@pytest.mark.parametrize("file_name,opener", [("offers.jsonl", open), ("offers.jsonl.gz", gzip.open)])
+def test_sinks(tmpdir, file_name, opener):
+    records = [{'offer_id': str(number), 'price': number, 'city': u'Gdańsk'} for number in range(50)]
+    with sinks.open_sink(str(tmpdir.join(file_name)), max_pending=2) as sink:
+        for record in records:
+            sink.write(record)
+    with opener(str(tmpdir.join(file_name)), "rb") as output_file:
+        assert [json.loads(line.decode("utf-8")) for line in output_file] == records
+
+
+def test_msgpack_sink(tmpdir):
+    msgpack = pytest.importorskip("msgpack")
+    path = str(tmpdir.join("offers.msgpack"))
+    records = [{'offer_id': str(number), 'price': number, 'city': u'Gdańsk'} for number in range(50)]
+    with sinks.open_sink(path, max_pending=2) as sink:
+        for record in records:
+            sink.write(record)
+    with open(path, "rb") as output_file:
+        assert list(msgpack.Unpacker(output_file, raw=False)) == records
+    assert list(sinks.read_records(path)) == records
+
+
+def test_buffered_sink_backpressure():
+    written, release = [], threading.Event()
+
+    class SlowSink(sinks.Sink):
+        def write(self, record):
+            release.wait()
+            written.append(record)
+
+        def close(self):
+            pass
+
+    sink = sinks.BufferedSink(SlowSink(), max_pending=2)
+    producer = threading.Thread(target=lambda: [sink.write(number) for number in range(10)])
+    producer.start()
+    producer.join(0.2)
+    # one record is being written and two are waiting, the producer is blocked
+    assert producer.is_alive() and written == []
+    release.set()
+    producer.join()
+    sink.close()
+    assert written == list(range(10))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+@pytest.mark.parametrize("concurrency", ["2", "3"])
+def test_cli(tmpdir, concurrency):
+    output_path, profile_path = str(tmpdir.join("offers.jsonl")), str(tmpdir.join("profile"))
+    with stand_in_server(pages=1) as server,\
+            mock.patch("otodom.utils.BASE_URL", server.url),\
+            mock.patch("otodom.offer.API_URL", server.url),\
+            mock.patch("otodom.category.WHITELISTED_DOMAINS", ["127.0.0.1"]):
+        assert cli.main([
+            "wynajem/mieszkanie/", "--filter", "city=gdansk_40", "--limit", "3", "--concurrency", concurrency,
+            "--rate-limit", "100", "--output", output_path, "--profile", profile_path
+        ]) == 0
+        utils.set_rate_limit(None)
+    with open(output_path) as output_file:
+        offers = [json.loads(line) for line in output_file]
+    assert len(offers) == 3
+    assert all(offer['phone_numbers'] == ['500600700'] for offer in offers)
+    assert sorted(tmpdir.join("profile").listdir()) == [
+        tmpdir.join("profile", "category.prof"), tmpdir.join("profile", "offer.prof")]
+
+
+def test_cli_backpressure():
+    started, written, ahead = [], [], []
+
+    class SlowSink(object):
+        def write(self, record):
+            threading.Event().wait(0.005)
+            written.append(record)
+            ahead.append(len(started) - len(written))
+
+        def close(self):
+            pass
+
+    def get_offer_information(url, context=None, archive=None):
+        started.append(url)
+        return context
+
+    offers = [{'offer_id': str(number), 'detail_url': str(number)} for number in range(30)]
+    with mock.patch("otodom.category.get_category", return_value=offers),\
+            mock.patch("otodom.offer.get_offer_information", side_effect=get_offer_information),\
+            mock.patch("otodom.cli.open_sink", return_value=SlowSink()):
+        assert cli.main(["wynajem/mieszkanie/", "--concurrency", "2", "--output", "offers.jsonl"]) == 0
+    assert sorted(written, key=lambda offer: int(offer["offer_id"])) == offers
+    # at most 2 * concurrency offers are scraped ahead of the sink
+    assert max(ahead) <= 4
+
+
+def test_stage_profiler_serializes_calls(tmpdir):
+    profiler, active, overlaps = cli.StageProfiler(str(tmpdir.join("profile"))), [], []
+
+    def stage():
+        active.append(None)
+        overlaps.append(len(active))
+        threading.Event().wait(0.01)
+        active.pop()
+
+    assert utils.map_concurrently(lambda _: profiler.run("offer", stage), range(4), concurrency=2) == [None] * 4
+    assert max(overlaps) == 1
+    profiler.dump()
+    assert tmpdir.join("profile", "offer.prof").check()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_parse_offer_markup_memo():
+    with open("test_data/offer", "rb") as markup_file:
+        content = pickle.load(markup_file)
+    offer.set_parse_memo_size(2)
+    try:
+        first = offer.parse_offer_markup(content)
+        first['price'] = 0
+        with mock.patch("otodom.offer.BeautifulSoup") as BeautifulSoup:
+            second = offer.parse_offer_markup(content)
+            assert not BeautifulSoup.called
+        assert second['price'] == 379
+        offer.parse_offer_markup(content + b" ")
+        offer.parse_offer_markup(content + b"  ")
+        offer.parse_offer_markup(content)
+        stats = offer.get_parse_memo_stats()
+        assert (stats['hits'], stats['misses'], stats['size']) == (1, 4, 2)
+        assert stats['hit_rate'] == 0.2
+    finally:
+        offer.set_parse_memo_size(offer.PARSE_MEMO_SIZE)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_get_offer_update():
+    with open("test_data/offer", "rb") as markup_file:
+        content = pickle.load(markup_file)
+    url = "https://www.otodom.pl/oferta/gdansk-apartament-olivaseaside-mieszkanie-na-doby-ID3iqMs.html"
+    with mock.patch("otodom.offer.get_response_for_url") as get_response_for_url:
+        get_response_for_url.return_value.content = content
+        previous = offer.get_offer_information(url)
+        assert previous['meta']['fingerprint'] == offer.get_offer_fingerprint(content)
+
+        with mock.patch("otodom.offer.parse_offer_markup") as parse_offer_markup:
+            update = offer.get_offer_update(url, previous)
+            assert not parse_offer_markup.called
+        assert update == {'status': offer.UNCHANGED, 'fingerprint': previous['meta']['fingerprint']}
+        assert offer.apply_offer_delta(previous, update) is previous
+
+        get_response_for_url.return_value.content = content.replace(b'"ad_price":379', b'"ad_price":399')
+        update = offer.get_offer_update(url, previous)
+    assert update['status'] == offer.CHANGED
+    assert (update['changes'], update['removed']) == ({'price': 399}, [])
+    current = offer.apply_offer_delta(previous, update)
+    assert current['price'] == 399 and current['meta']['fingerprint'] == update['fingerprint']
+
+
+@pytest.mark.parametrize("status,location,expected", [
+    (200, None, True),
+    (404, None, False),
+    (410, None, False),
+    (301, "https://www.otodom.pl/sprzedaz/mieszkanie/gdansk/", False),
+    (301, "https://www.otodom.pl/oferta/gdansk-mieszkanie-ID3iqMt.html", True),
+    (302, None, False),
+    (500, None, None),
+])
+def test_is_offer_alive(status, location, expected):
+    assert offer.is_offer_alive(status, location) is expected
+
+
+def test_get_offer_url():
+    url = "https://www.otodom.pl/oferta/gdansk-mieszkanie-ID3iqMs.html"
+    assert offer.get_offer_url(url) == url
+    assert offer.get_offer_url({'detail_url': url, 'offer_id': '1'}) == url
+    assert offer.get_offer_url("3iqMs") == offer.OFFER_ID_URL.format("3iqMs")
+
+
+def test_check_offers_alive():
+    statuses = {"a": (200, None), "b": (404, None), "c": (301, "/sprzedaz/")}
+    with mock.patch("otodom.offer.get_status_for_url") as get_status_for_url:
+        get_status_for_url.side_effect = lambda url: statuses[url.rsplit("/", 1)[-1]]
+        assert offer.check_offers_alive(["http://x/a", {'detail_url': "http://x/b"}, "http://x/c"]) == [
+            True, False, False]
+        assert offer.check_offers_alive(["http://x/a"], concurrency=1) == [True]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_get_status_for_url():
+    with stand_in_server() as server:
+        url = server.url + "/oferta/gdansk-mieszkanie-ID3iqMs.html"
+        assert utils.get_status_for_url(url) == (200, None)
+        assert server.requests_count["offer"] == 1
+    with mock.patch("otodom.utils.requests") as requests:
+        requests.head.return_value.status_code = 405
+        requests.get.return_value.status_code = 301
+        requests.get.return_value.headers = {'Location': '/sprzedaz/'}
+        requests.get.return_value.elapsed.total_seconds.return_value = 0.1
+        assert utils.get_status_for_url("http://x/oferta/a.html") == (301, '/sprzedaz/')
+        assert requests.get.call_args[1]['stream'] is True
+        assert requests.get.return_value.close.called
+
+
+@pytest.mark.parametrize("date,expected_value", [
+    ("15.11.2016", 1479168000),
+    ("01.02.2017", 1485907200),
+])
+def test_parse_date(date, expected_value):
+    assert normalize.parse_date(date) == offer.parse_date_to_timestamp(date) == expected_value
+
+
+@pytest.mark.parametrize("date,expected_value", [
+    (u"1 lipca 2017", 1498867200),
+    (u"15 Września 2016", 1473897600),
+])
+def test_parse_month_date(date, expected_value):
+    assert normalize.parse_month_date(date) == offer.parse_available_from(date) == expected_value
+
+
+def test_normalize_memoized():
+    normalize.parse_date.memo.clear()
+    assert normalize.parse_date("15.11.2016") == normalize.parse_date("15.11.2016") == 1479168000
+    assert normalize.get_memo_stats()['parse_date']['hits'] == 1
+    assert normalize.memoized()(normalize.parse_number)("1,5", float, default=0) == 1.5
+    assert normalize.split_detail(u"kaucja: 800 zł") == (u"kaucja", u"800 zł")
+    assert normalize.split_detail(u"a: b: c") == (u"a", u"b")
+    with pytest.raises(IndexError):
+        normalize.split_detail(u"kaucja")
+    assert normalize.parse_float("65,5") == 65.5
+    assert normalize.parse_int("4,5") is None
+    assert normalize.parse_total_floors("(z 4)") == "4"
+    assert normalize.get_month_number(u"Październik") == 10
+
+
+STORE_OFFERS = [
+    {'offer_id': '1', 'price': 2500, 'surface': 50.0, 'rooms': 2, 'floor': 0, 'city': u"Gdańsk", 'district': "Oliwa",
+     'additional_assets': {'balcony': True, 'elevator': False}, 'description': u"Wygodne mieszkanie"},
+    {'offer_id': '2', 'price': 3500.0, 'surface': 70.0, 'rooms': 3, 'floor': 12, 'city': u"Łódź",
+     'additional_assets': {'balcony': True, 'elevator': True}, 'photo_links': ["a.jpg"]},
+    {'offer_id': '3', 'detail_url': "https://www.otodom.pl/oferta/a.html", 'price': 1800.0, 'surface': 30.0,
+     'rooms': 2, 'location': u"Gdańsk, Wrzeszcz,  Antoniego Słonimskiego", 'poster': ""},
+]
+
+
+@pytest.mark.parametrize("filters,expected_ids", [
+    ({}, ['1', '2', '3']),
+    ({'[filter_float_price:to]': 3000}, ['1', '3']),
+    ({'[filter_float_price:from]': 2000, '[filter_float_price:to]': ""}, ['1', '2']),
+    ({'[filter_float_price_per_m:from]': 55}, ['3']),
+    ({'[filter_float_m:from]': 40, '[filter_float_m:to]': 60}, ['1']),
+    ({'[filter_enum_rooms_num][]': ['2']}, ['1', '3']),
+    ({'[filter_enum_floor_no][]': ['ground_floor', 'floor_higher_10']}, ['1', '2']),
+    ({'[filter_enum_extras_types][]': ['balcony', 'lift']}, ['2']),
+    ({'[photos]': 1}, ['2']),
+    ({'[photos]': 0}, ['1', '2', '3']),
+    ({'city': 'gdansk_40', '[filter_float_price:to]': 3000}, ['1', '3']),
+    ({'city': 'lodz_1004'}, ['2']),
+    ({'district': u"Wrzeszcz"}, ['3']),
+    ({'description_fragment': "wygodne"}, ['1']),
+])
+def test_offer_store_query(filters, expected_ids):
+    offer_store = store.OfferStore(STORE_OFFERS)
+    assert [offer['offer_id'] for offer in offer_store.query(**filters)] == expected_ids
+
+
+def test_offer_store(tmpdir):
+    path = str(tmpdir.join("offers.jsonl.gz"))
+    with sinks.open_sink(path) as sink:
+        for store_offer in STORE_OFFERS:
+            sink.write(store_offer)
+    offer_store = store.OfferStore.from_file(path)
+    assert len(offer_store) == 3 and '2' in offer_store
+
+    offer_store.add(dict(STORE_OFFERS[1], price=2000.0))
+    assert len(offer_store) == 3
+    assert offer_store.get('2')['price'] == 2000.0
+    assert [offer['offer_id'] for offer in offer_store.query(**{'[filter_float_price:to]': 3000})] == ['1', '3', '2']
+    assert offer_store.count(**{'[filter_float_price:from]': 3000}) == 0
+    # the replaced offer is dropped from the indexes, not only hidden
+    for _ in range(3):
+        offer_store.add(dict(STORE_OFFERS[1], price=2000.0))
+    assert len(offer_store._numeric['price']) == 3
+    assert sum(len(positions) for positions in offer_store._values['city'].values()) == 3
+
+    with pytest.raises(ValueError):
+        offer_store.query(**{'[filter_enum_market][]': ['primary']})
+    with pytest.raises(ValueError):
+        offer_store.query(**{'[filter_enum_floor_no][]': ['garret']})
+
+
+def get_geo_points(count=2000, seed=3):
+    generator = random.Random(seed)
+    return [(generator.uniform(54.3, 54.6), generator.uniform(18.4, 18.8), point) for point in range(count)]
+
+
+@pytest.mark.parametrize("use_numpy", [False, pytest.param(True, marks=pytest.mark.skipif(
+    geo.get_numpy() is None, reason="requires numpy"))])
+def test_geo_index(use_numpy):
+    points = get_geo_points()
+    geo_index = geo.GeoIndex(cell_size=0.02, use_numpy=use_numpy)
+    for latitude, longitude, point in points:
+        geo_index.insert(latitude, longitude, point)
+    assert len(geo_index) == len(points)
+    generator = random.Random(4)
+    for _ in range(10):
+        latitude, longitude = generator.uniform(54.2, 54.7), generator.uniform(18.3, 18.9)
+        distances = sorted(
+            (geo.haversine(latitude, longitude, point_latitude, point_longitude), point)
+            for point_latitude, point_longitude, point in points)
+        assert [point for _, point in geo_index.within_radius(latitude, longitude, 2.0)] == [
+            point for distance, point in distances if distance <= 2.0]
+        assert [point for _, point in geo_index.nearest(latitude, longitude, 5)] == [
+            point for _, point in distances[:5]]
+        assert sorted(geo_index.within_bbox(latitude - 0.02, longitude - 0.03, latitude + 0.02, longitude + 0.03)) == [
+            point for point_latitude, point_longitude, point in points
+            if latitude - 0.02 <= point_latitude <= latitude + 0.02 and
+            longitude - 0.03 <= point_longitude <= longitude + 0.03]
+
+
+def test_geo_index_offers():
+    offers = [
+        {'offer_id': '1', 'geographical_coordinates': (54.4092043, 18.570687700000008)},
+        {'offer_id': '2', 'geographical_coordinates': (54.3520, 18.6466)},
+        {'offer_id': '3', 'geographical_coordinates': (None, None)},
+    ]
+    geo_index = geo.GeoIndex(offers[:1])
+    assert geo_index.nearest(54.35, 18.65) == [(pytest.approx(8.35, abs=0.01), offers[0])]
+    assert geo_index.add(offers[1]) and not geo_index.add(offers[2])
+    assert [offer['offer_id'] for _, offer in geo_index.nearest(54.35, 18.65, 3)] == ['2', '1']
+    assert geo.GeoIndex().nearest(54.35, 18.65) == []
+
+
+def test_geo_index_nearest_far_away():
+    geo_index = geo.GeoIndex(use_numpy=False)
+    geo_index.insert(54.3520, 18.6466, 'gdansk')
+    geo_index.insert(54.5189, 18.5305, 'gdynia')
+    with mock.patch("otodom.geo._get_ring", wraps=geo._get_ring) as get_ring:
+        assert [item for _, item in geo_index.nearest(50.0647, 19.9450, 2)] == ['gdansk', 'gdynia']
+    assert get_ring.call_count == 1
+
+
+def test_price_history(tmpdir):
+    path = str(tmpdir.join("prices"))
+    monday = history.get_period_start(1500000000)
+    with history.PriceHistory(path) as price_history:
+        assert price_history.record('1', 3000, timestamp=monday)
+        assert not price_history.record('1', 3000.0, timestamp=monday + history.DAY)
+        assert price_history.record('1', 3200, timestamp=monday + history.WEEK + history.DAY)
+        assert price_history.record_offer({'offer_id': '2', 'price': 2000, 'currency': 'PLN'}, monday)
+        assert price_history.record_removed('2', monday + 2 * history.WEEK)
+        assert not price_history.record_removed('3', monday)
+        assert price_history.record('4', 5000, timestamp=monday)
+        assert price_history.record('4', 5100, timestamp=monday + history.DAY)
+    with open(path, "ab") as history_file:
+        history_file.write(b"\0\0\0")
+
+    price_history = history.PriceHistory(path)
+    assert len(price_history) == 6
+    assert price_history.get_history('1') == [
+        (monday, 3000.0, 'PLN'), (monday + history.WEEK + history.DAY, 3200.0, 'PLN')]
+    assert price_history.get_price('1', monday + history.WEEK) == (3000.0, 'PLN')
+    assert price_history.get_price('2') is None
+    assert price_history.get_changes(monday + history.DAY, monday + history.WEEK) == [
+        ('4', monday + history.DAY, 5100.0, 'PLN')]
+
+    offers = {
+        '1': {'surface': 50.0, 'district': u"Oliwa"},
+        '2': {'surface': 40.0, 'district': u"Oliwa"},
+        '4': {'surface': 100.0, 'district': u"Zaspa"},
+    }
+    assert price_history.aggregate(offers.get, end=monday + 3 * history.WEEK) == {
+        ('oliwa', monday): 55.0,
+        ('oliwa', monday + history.WEEK): 57.0,
+        ('oliwa', monday + 2 * history.WEEK): 57.0,
+        ('oliwa', monday + 3 * history.WEEK): 64.0,
+        ('zaspa', monday): 51.0,
+        ('zaspa', monday + history.WEEK): 51.0,
+        ('zaspa', monday + 2 * history.WEEK): 51.0,
+        ('zaspa', monday + 3 * history.WEEK): 51.0,
+    }
+    end = monday + 3 * history.WEEK
+    for name, statistic in history.STATISTICS.items():
+        expected = price_history.aggregate(offers.get, end=end, statistic=statistic)
+        assert price_history.aggregate(offers.get, end=end, statistic=name) == pytest.approx(expected)
+        with mock.patch("otodom.history.get_numpy", return_value=None):
+            assert price_history.aggregate(offers.get, end=end, statistic=name) == expected
+    assert price_history.aggregate(offers.get, end=end, statistic="count")[('oliwa', monday)] == 2
+    with pytest.raises(ValueError):
+        price_history.aggregate(offers.get, statistic="mode")
+    price_history.close()
+
+
+def get_dedup_offer():
+    with open("test_data/offer", "rb") as markup_file:
+        return offer.parse_offer_markup(pickle.load(markup_file))
+
+
+def test_duplicate_index():
+    original = get_dedup_offer()
+    words = original['description'].split()
+    reposted = dict(original, price=original['price'] + 10,
+                    description=" ".join(words[:-3] + ["Zapraszamy", "do", "kontaktu!"]))
+    shuffled = dict(original, description=" ".join(random.Random(0).sample(words, len(words))))
+    moved = dict(reposted, geographical_coordinates=(54.5, 18.5))
+
+    duplicates = dedup.DuplicateIndex()
+    assert duplicates.add(original, key='1') is None
+    assert duplicates.find_duplicates(reposted) == ['1']
+    assert duplicates.add(reposted, key='2') == '1'
+    assert duplicates.add(shuffled, key='3') is None
+    assert duplicates.add(moved, key='4') is None
+    assert duplicates.add(original, key='2') == '1'
+    assert duplicates.get_clusters() == [['1', '2']]
+    assert duplicates.add({}, key='5') is None and '5' not in duplicates
+    with pytest.raises(ValueError):
+        duplicates.add(original)
+    reshuffled = dict(original, offer_id='7', description=" ".join(random.Random(1).sample(words, len(words))))
+    assert list(duplicates.filter([dict(reposted, offer_id='6'), reshuffled])) == [reshuffled]
+
+
+def test_minhash_similarity():
+    hasher = dedup.MinHasher(num_perm=256)
+    tokens = {str(number) for number in range(100)}
+    other_tokens = {str(number) for number in range(20, 120)}
+    similarity = dedup.get_similarity(hasher.signature(tokens), hasher.signature(other_tokens))
+    assert similarity == pytest.approx(80 / 120.0, abs=0.1)
+    assert hasher.signature(set()) is None
+
+
+def test_get_offers_information_skips_duplicates():
+    with open("test_data/offer", "rb") as markup_file:
+        content = pickle.load(markup_file)
+    offers = [{'offer_id': '1', 'detail_url': 'a'}, {'offer_id': '2', 'detail_url': 'b'}]
+    with mock.patch("otodom.offer.get_response_for_url") as get_response_for_url,\
+            mock.patch("otodom.offer.get_cookie_from", return_value=""),\
+            mock.patch("otodom.offer.get_offer_phone_numbers", return_value=["123"]) as get_offer_phone_numbers:
+        get_response_for_url.return_value.content = content
+        results = list(offer.get_offers_information(offers, duplicates=dedup.DuplicateIndex()))
+    assert [result['meta']['duplicate_of'] for result in results] == [None, '1']
+    assert [result['phone_numbers'] for result in results] == [["123"], ""]
+    get_offer_phone_numbers.assert_called_once_with('1', "", mock.ANY)
+
+
+@pytest.mark.parametrize("url,content_type,expected_value", [
+    ("https://img.otodom.pl/a/image;s=1280x1024", "image/png", ".png"),
+    ("https://img.otodom.pl/a/image.webp?x=1", None, ".webp"),
+    ("https://img.otodom.pl/a/image;s=1280x1024", "application/octet-stream", ".jpg"),
+])
+def test_get_photo_extension(url, content_type, expected_value):
+    assert photos.get_photo_extension(url, content_type) == expected_value
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_photo_store(tmpdir):
+    root = str(tmpdir.join("photos"))
+    with stand_in_server() as server:
+        urls = [server.url + "/photo/1.jpg", server.url + "/photo/2.jpg", server.url + "/photo/1.jpg"]
+        with photos.PhotoStore(root, concurrency=3) as photo_store:
+            paths = photo_store.download_many(urls)
+            assert paths[0] == paths[1] == paths[2] and paths[0].endswith(".jpg")
+            assert server.requests_count["category"] == 2
+            with open(paths[0], "rb") as photo_file:
+                assert photo_file.read() == server.category_markup
+            offers = [{'photo_links': urls[:1]}, {'photo_links': []}, {'photo_links': urls[1:]}]
+            assert photo_store.download_offer_photos(offers) == [paths[:1], [], paths[1:]]
+            offers.append({'photo_links': urls, 'meta': {'duplicate_of': '1'}})
+            assert photo_store.download_offer_photos(offers)[-1] == []
+            with mock.patch.object(photo_store, "_fetch", side_effect=requests.ConnectionError):
+                assert photo_store.download(server.url + "/photo/3.jpg") is None
+        with photos.PhotoStore(root) as photo_store:
+            assert len(photo_store) == 2 and photo_store.get(urls[1]) == paths[1]
+            photo_store.download(urls[1])
+        assert server.requests_count["category"] == 2
+        with photos.PhotoStore(str(tmpdir.join("other")), concurrency=3) as photo_store:
+            for number in range(4, 10):
+                photo_store.download_many([server.url + "/photo/{0}.jpg".format(number)] * 3)
+            # the threads of the store and their sessions are reused between the calls
+            assert len(photo_store._sessions) <= 3
+    assert len(tmpdir.join("photos").listdir()) == 2
+
+
+def test_bloom_filter(tmpdir):
+    seen = bloom.BloomFilter(capacity=1000, error_rate=0.01)
+    assert seen.num_bits == 9592 and seen.num_hashes == 7
+    assert seen.add("abc") and not seen.add("abc") and "abc" in seen and len(seen) == 1
+    seen.add(48326376)
+    assert "48326376" in seen and "abd" not in seen
+    for number in range(999):
+        seen.add("offer-{0}".format(number))
+    false_positives = sum("other-{0}".format(number) in seen for number in range(10000))
+    assert false_positives < 200 and seen.get_error_rate() == pytest.approx(0.01, abs=0.002)
+
+    path = str(tmpdir.join("seen.bloom"))
+    seen.save(path)
+    loaded = bloom.BloomFilter.load(path)
+    assert loaded.to_bytes() == seen.to_bytes() and "offer-998" in loaded
+    with pytest.raises(ValueError):
+        bloom.BloomFilter.from_bytes(b"OTBF")
+
+    other = bloom.BloomFilter(capacity=1000, error_rate=0.01)
+    other.add("xyz")
+    loaded.update(other)
+    assert "xyz" in loaded and "abc" in loaded
+    with pytest.raises(ValueError):
+        loaded.update(bloom.BloomFilter(capacity=10))
+    offers = [{'offer_id': 'abc'}, {'offer_id': 'new'}, {'detail_url': ''}]
+    assert list(other.filter(offers)) == offers and list(other.filter(offers)) == offers[2:]
+
+
+def test_bloom_filter_skips_seen_offers():
+    with open("test_data/markup_offers", "rb") as markup_file:
+        markup = pickle.load(markup_file)
+    offers = category.parse_category_content(markup)
+    seen = bloom.BloomFilter(capacity=100)
+    seen.add(offers[0]['offer_id'])
+    assert list(category.iter_category_offers([markup], seen=seen)) == offers[1:]
+    with mock.patch("otodom.offer.get_offer_information", return_value={}) as get_offer_information:
+        assert list(offer.get_offers_information(offers[:2], seen=seen)) == [{}]
+        assert list(offer.get_offers_information(offers[:2], seen=seen)) == []
+    get_offer_information.assert_called_once_with(offers[1]['detail_url'], context=offers[1], archive=None,
+                                                  duplicates=None)
+
+
+def test_work_queue(tmpdir):
+    path = str(tmpdir.join("queue.db"))
+    with workqueue.WorkQueue(path, lease_time=60, max_attempts=2) as queue:
+        offers = [{'offer_id': '1', 'detail_url': 'a'}, 'b', {'offer_id': '1', 'detail_url': 'c'}, {}]
+        assert queue.put_offers(offers) == 2
+        assert queue.put_search("wynajem", "mieszkanie", "gda", **{'[filter_float_price:to]': 1100})
+        assert not queue.put_search("wynajem", "mieszkanie", "gda", **{'[filter_float_price:to]': 1100})
+        assert len(queue) == 3
+
+        first = queue.lease()
+        assert (first.kind, first.key, first.attempts) == ("offer", "1", 1)
+        assert first.payload == {'offer_id': '1', 'detail_url': 'a'}
+        second = queue.lease(kinds=["offer"])
+        assert second.key == "b" and queue.lease(kinds=["offer"]) is None
+        assert queue.ack(first) and not queue.ack(first)
+        assert queue.release(second)
+        assert queue.lease(kinds=["offer"]).attempts == 2
+        third = queue.lease()
+        assert third.payload['search'][3] == {'[filter_float_price:to]': 1100}
+        assert queue.extend(third)
+        assert queue.put_offers([{'offer_id': '1'}, "https://www.otodom.pl/oferta/gdansk-ID1.html"]) == 0
+        assert queue.get_counts() == {'pending': 0, 'leased': 2, 'done': 1, 'failed': 0}
+
+    with workqueue.WorkQueue(path, lease_time=0, max_attempts=2) as queue, mock.patch("time.time") as time:
+        time.return_value = 10 ** 10
+        # the leases of a crashed worker expire and the tasks are leased again, up to max_attempts times
+        retried = queue.lease()
+        assert retried.key == third.key and retried.attempts == 2 and not queue.ack(third)
+        assert queue.lease() is None and not queue.release(retried)
+        assert queue.get_counts() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 2} and len(queue) == 0
+
+
+@pytest.mark.parametrize("url,expected_value", [
+    ("https://www.otodom.pl/oferta/gdansk-apartament-ID3iqMs.html#a7099545ba", "3iqMs"),
+    ("https://www.otodom.pl/oferta/ID3iqMs.html", "3iqMs"),
+    ("https://www.otodom.pl/oferta/gdansk-apartament.html", None),
+])
+def test_get_offer_id_from_url(url, expected_value):
+    assert offer.get_offer_id_from_url(url) == expected_value
+    assert workqueue.get_offer_task_key({'detail_url': url}) == (expected_value or url)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_process_queue(tmpdir):
+    seen = bloom.BloomFilter(capacity=100)
+    with stand_in_server(pages=2) as server, workqueue.WorkQueue(str(tmpdir.join("queue.db"))) as queue,\
+            mock.patch("otodom.utils.BASE_URL", server.url),\
+            mock.patch("otodom.category.WHITELISTED_DOMAINS", ["127.0.0.1"]),\
+            mock.patch("otodom.offer.get_offer_information", side_effect=lambda url, **_: {'url': url}) as get_info:
+        offers = category.parse_category_content(server.category_markup)
+        seen.add(offers[0]['offer_id'])
+        queue.put_search("wynajem", "mieszkanie", "", city="gdansk_40")
+        queue.put_offers(offers[1:2])
+        worker = workqueue.process_queue(queue, seen=seen)
+        results = [next(worker)]
+        # the task is acknowledged before its result is returned
+        assert queue.get_counts()['leased'] == 0
+        results.extend(worker)
+        assert server.requests_count["category"] == 2
+        assert results == [{'url': offer_details['detail_url']} for offer_details in offers[1:]]
+        assert queue.get_counts() == {'pending': 0, 'leased': 0, 'done': len(offers) + 1, 'failed': 0}
+        get_info.assert_any_call(offers[1]['detail_url'], context=offers[1], archive=None, duplicates=None)
+        assert all(offer_details['offer_id'] in seen for offer_details in offers)
+
+        queue.put_offers(["c"])
+        with mock.patch("otodom.offer.get_offer_information", side_effect=requests.ConnectionError):
+            assert list(workqueue.process_queue(queue)) == []
+        assert queue.get_counts()['pending'] == 1 and queue.lease() is None